@@ -3,79 +3,279 @@
 #!/usr/bin/env python3
 
 
+import configparser
+import io
 import logging
 import os
+import shutil
 import sys
+import tempfile
 import time
 import traceback
-import yappi
 if sys.version_info < (3, 0):
     sys.stderr.write("ERROR: Python 2.x is not supported - Python >= 3.0 required\n")
     sys.exit(1)
 
 from init import init
-from classification.BirdClassifier import classify_birds
-from classification.classification import Classification, Tf
 from aux.err import err_exit
+from aux.local_open import configure_local_open, is_local, local_read
 from aux.timec import timec
-from aux.url_open import url_open
+from aux.retry import configure_retry
+from aux.stage_metrics import StageMetrics
+from aux.url_open import configure_url_open
 
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
+# Modules importing TensorFlow, TF Hub, OpenCV and yappi are only imported once the arguments
+# have been parsed, so that e.g. --help and argument errors do not pay for them.
+
 
 def _get_args(config, _time, _profile):
     args = None
     try:
         args = {
                 'nm_top_results': int(config.get('classifier', 'nm_top_results')),
+                'score_softmax': config.getboolean('classifier', 'score_softmax'),
+                'score_threshold': config.get('classifier', 'score_threshold'),
                 'multiprocessing_threshold': int(config.get('classifier',
                     'multiprocessing_threshold')),
+                'batch_size': int(config.get('classifier', 'batch_size')),
+                'max_batch_wait_ms': int(config.get('classifier', 'max_batch_wait_ms')),
+                'decode_threads': int(config.get('classifier', 'decode_threads')),
+                'decode_lookahead': int(config.get('classifier', 'decode_lookahead')),
+                'nm_downloads': int(config.get('classifier', 'nm_downloads')),
+                'local_readahead_mb': int(config.get('classifier', 'local_readahead_mb')),
+                'task_queue_size': int(config.get('classifier', 'task_queue_size')),
                 'tfhub_cache_dir': config.get('classifier', 'tfhub_cache_dir'),
                 'url_model': config.get('bird-classifier', 'url_model'),
                 'url_labels': config.get('bird-classifier', 'url_labels'),
+                'labels_ttl': int(config.get('bird-classifier', 'labels_ttl')),
+                'model_dir': config.get('bird-classifier', 'model_dir'),
+                'backend': config.get('bird-classifier', 'backend'),
+                'inference': config.get('bird-classifier', 'inference'),
+                'tflite_quantization': config.get('bird-classifier', 'tflite_quantization'),
+                'max_in_flight': int(config.get('classifier', 'max_in_flight')),
+                'journal_sync_ms': int(config.get('classifier', 'journal_sync_ms')),
+                'nm_workers': config.get('classifier', 'nm_workers'),
+                'worker_memory_mb': int(config.get('classifier', 'worker_memory_mb')),
+                'pool_adjust_interval_ms': int(config.get('classifier',
+                    'pool_adjust_interval_ms')),
+                'chunk_target_ms': int(config.get('classifier', 'chunk_target_ms')),
+                'max_chunk_size': int(config.get('classifier', 'max_chunk_size')),
+                'dedup': config.getboolean('classifier', 'dedup'),
+                'dedup_perceptual': config.getboolean('classifier', 'dedup_perceptual'),
+                'dedup_perceptual_distance': int(config.get('classifier',
+                    'dedup_perceptual_distance')),
+                'dedup_max_entries': int(config.get('classifier', 'dedup_max_entries')),
+                'tf_intra_op_threads': config.get('classifier', 'tf_intra_op_threads'),
+                'tf_inter_op_threads': config.get('classifier', 'tf_inter_op_threads'),
+                'max_request_images': int(config.get('service', 'max_request_images')),
+                'cache_path': config.get('result-cache', 'path'),
+                'cache_max_size_mb': int(config.get('result-cache', 'max_size_mb')),
+                'cache_ttl': int(config.get('result-cache', 'ttl')),
+                'http_timeout': float(config.get('http', 'timeout')),
+                'http_max_connections_per_host': int(config.get('http',
+                    'max_connections_per_host')),
+                'http_keep_alive': config.getboolean('http', 'keep_alive'),
+                'http2': config.getboolean('http', 'http2'),
+                'retry_max_retries': int(config.get('retry', 'max_retries')),
+                'retry_base_delay_ms': int(config.get('retry', 'base_delay_ms')),
+                'retry_max_delay_ms': int(config.get('retry', 'max_delay_ms')),
+                'retry_breaker_failures': int(config.get('retry', 'breaker_failures')),
+                'retry_breaker_reset_s': float(config.get('retry', 'breaker_reset_s')),
+                'cluster_chunk_size': int(config.get('cluster', 'chunk_size')),
+                'cluster_chunks_per_worker': int(config.get('cluster', 'chunks_per_worker')),
+                'cluster_heartbeat_s': float(config.get('cluster', 'heartbeat_s')),
+                'cluster_worker_timeout_s': float(config.get('cluster', 'worker_timeout_s')),
                 }
-    except configparser.NoOptionError as e:
+    except (configparser.NoOptionError, configparser.NoSectionError) as e:
         err_msg = "Invalid config file"
         logging.exception(err_msg)
         raise Exception("%s: %s" % (err_msg, e))
+    args['score_threshold'] = float(args['score_threshold']) if args['score_threshold'] else None
+    if args['backend'] not in ['tensorflow', 'tflite']:
+        raise Exception("Invalid config file: unknown backend '{}'".format(args['backend']))
+    if args['inference'] not in ['eager', 'graph', 'xla']:
+        raise Exception("Invalid config file: unknown inference '{}'".format(args['inference']))
+    if args['tflite_quantization'] not in ['float32', 'float16', 'int8']:
+        raise Exception("Invalid config file: unknown tflite_quantization '{}'".format(
+            args['tflite_quantization']))
+    # Left empty, these are chosen by the PoolScheduler.
+    for x in ['nm_workers', 'tf_intra_op_threads', 'tf_inter_op_threads']:
+        args[x] = int(args[x]) if args[x] else None
     args['time'] = _time
     args['profile'] = _profile
+    # Set to a directory for the worker processes to save their profiles to.
+    args['profile_dir'] = None
     return args
 
+def _print_profile():
+    import yappi
+    yappi.get_func_stats().print_all()
+    yappi.get_thread_stats().print_all()
+
+def _print_worker_profiles(profile_dir):
+    from aux.profiling import merge_profiles
+    try:
+        stats = merge_profiles(profile_dir, stream=sys.stderr)
+        if stats is None:
+            print("No worker profiles - the tasks were classified in the main process",
+                    file=sys.stderr)
+        else:
+            stats.sort_stats('cumulative').print_stats(_PROFILE_LINES)
+    finally:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+
+# The number of functions of the merged worker profiles to print.
+_PROFILE_LINES = 40
+
+def _report_stages(metrics, cli_args):
+    if cli_args.time:
+        print(metrics.table(), file=sys.stderr)
+    if cli_args.metrics_file:
+        metrics.write(cli_args.metrics_file)
+
+def _serve(args, host, port):
+    from classification.BirdClassifierService import BirdClassifierService
+    service = BirdClassifierService(args, host, port)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.shutdown()
+
+def _load_labels(args):
+    from classification.BirdClassifier import load_labels
+    from classification.classification import ClassificationFatalException
+    try:
+        return load_labels(args)
+    except ClassificationFatalException:
+        logging.error("Failed to load labels - writing label ids instead of names")
+        return None
+
+def _open_writer(args, cli_args):
+    from classification.ResultWriter import is_binary, open_writer
+    out = sys.stdout.buffer if is_binary(cli_args.format) else sys.stdout
+    try:
+        return open_writer(cli_args.format, out, _load_labels(args), args['nm_top_results'])
+    except ImportError as e:
+        err_exit(msg="--format {} needs a missing package: {}".format(cli_args.format, e))
+
+def _open_journal(args, cli_args):
+    if not cli_args.journal:
+        return None
+    from classification.BirdClassifier import open_journal
+    return open_journal(cli_args.journal, args, cli_args.resume)
+
+def _close_journal(journal):
+    if journal is not None:
+        journal.close()
+        logging.info("Journal: %s", str(journal))
+
+def _work(args, address, cli_args):
+    from classification.BirdClassifierCluster import run_worker
+    metrics = StageMetrics()
+    with timec() as t:
+        nm_answered = run_worker(args, *address, metrics)
+    logging.info("Answered %d image(s) in %.4fs", nm_answered, t())
+    if cli_args.time:
+        print(metrics.table(), file=sys.stderr)
+
+def _warmup(args):
+    from classification.BirdClassifier import warmup
+    with timec() as t:
+        model_format = warmup(args)
+    print(f"Exported model ({model_format}) to {args['model_dir']} in {t():.4f}s")
+
 def main():
     try:
         with timec() as t:
-            config, data, _time, _profile, show = init()
+            config, data, cli_args = init()
 
-            args = _get_args(config, _time, _profile)
+            args = _get_args(config, cli_args.time, cli_args.profile)
 
-            if _profile:
+            if cli_args.profile:
+                import yappi
                 yappi.set_clock_type("cpu")
                 yappi.start()
 
+            with timec() as t_import:
+                from classification.BirdClassifier import classify_birds, classify_birds_stream
+                from classification.classification import Tf
+            if cli_args.time: logging.debug(f"Time taken for imports: {t_import():.4f}s")
+
             Tf.init(args['tfhub_cache_dir'])
-            results = classify_birds(data, config, args)
-
-            if _profile:
-                yappi.get_func_stats().print_all()
-                yappi.get_thread_stats().print_all()
-
-            if show:
-                import timg
-                from PIL import Image
-                import requests
-                obj = timg.Renderer()
-                for res in results:
-                    img = Image.open(requests.get(res.image, stream=True).raw)
-                    obj.load_image(img)
-                    obj.resize(120,40)
-                    obj.render(timg.Ansi8HblockMethod)
-                    print(str(res))
-            else:
-                for res in results:
-                    print(str(res))
-        if _time:
+            configure_url_open(args['http_timeout'], args['http_max_connections_per_host'],
+                    args['http2'], args['http_keep_alive'])
+            configure_local_open(args['local_readahead_mb'])
+            configure_retry(args['retry_max_retries'], args['retry_base_delay_ms'],
+                    args['retry_max_delay_ms'], args['retry_breaker_failures'],
+                    args['retry_breaker_reset_s'])
+            if cli_args.command == 'serve':
+                _serve(args, cli_args.host, cli_args.port)
+                return
+            if cli_args.command == 'warmup':
+                _warmup(args)
+                return
+            if cli_args.command == 'worker':
+                _work(args, cli_args.connect, cli_args)
+                return
+
+            metrics = StageMetrics()
+            if cli_args.profile_workers:
+                args['profile_dir'] = tempfile.mkdtemp(prefix="classifier-profile-")
+            journal = _open_journal(args, cli_args)
+            try:
+                if cli_args.listen:
+                    from classification.BirdClassifierCluster import classify_birds_distributed
+                    results = classify_birds_distributed(data, args, *cli_args.listen,
+                            not cli_args.unordered, journal)
+                elif cli_args.stream:
+                    results = classify_birds_stream(data, config, args, not cli_args.unordered,
+                            metrics, journal)
+                else:
+                    results = classify_birds(data, config, args, metrics, journal)
+
+                # Streamed results are only classified while they are written below.
+                streamed = cli_args.stream or cli_args.listen
+                if cli_args.profile and not streamed:
+                    _print_profile()
+
+                writer = _open_writer(args, cli_args)
+                if cli_args.show:
+                    import timg
+                    from PIL import Image
+                    import requests
+                    obj = timg.Renderer()
+                    for res in results:
+                        if is_local(res.image):
+                            img = Image.open(io.BytesIO(local_read(res.image)))
+                        else:
+                            img = Image.open(requests.get(res.image, stream=True).raw)
+                        obj.load_image(img)
+                        obj.resize(120,40)
+                        obj.render(timg.Ansi8HblockMethod)
+                        writer.write([res])
+                        writer.flush()
+                else:
+                    with timec() as t_write:
+                        writer.write(results)
+                writer.close()
+            finally:
+                # Also on errors and interrupts, so that the answers so far are kept.
+                _close_journal(journal)
+            # Streamed results are classified while they are written.
+            if cli_args.time and not cli_args.show and not streamed:
+                logging.debug(f"Time taken for writing results: {t_write():.4f}s")
+
+            if cli_args.profile and streamed:
+                _print_profile()
+            _report_stages(metrics, cli_args)
+            if cli_args.profile_workers:
+                _print_worker_profiles(args['profile_dir'])
+        if cli_args.time:
             logging.debug(f"Time taken for application: {t():.4f}s")
     except Exception as e:
         logging.exception("Unexpected error - exiting")
@@ -1,62 +1,191 @@
-# http://stackoverflow.com/a/894284 (zzzeek).
+"""Log the records of all processes to one file, without holding them up."""
 
-from logging.handlers import RotatingFileHandler
-import multiprocessing, threading, logging, sys, traceback
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import queue
+import threading
+import time
+import weakref
 
 
-class MultiprocessingLog(logging.Handler):
-    def __init__(self, name, mode, maxsize, rotate):
-        logging.Handler.__init__(self)
+class MultiprocessingLog(QueueHandler):
+    """
+    Log handler writing the records of the process creating it and of the processes it forks to
+    one file.
 
+    Every process formats its records itself and buffers them, and puts them to a bounded
+    multiprocessing queue in batches: of batch_size records, after flush_interval_ms, or at once
+    for warnings and errors. A QueueListener thread of the creating process writes each batch to
+    the file in one write.
+
+    When the queue is full, the file cannot keep up; debug records are then sampled, 1 in
+    debug_sample_rate kept (none with 0), and the number dropped is logged once there is room
+    again. Other records are never dropped: the process waits for room for them, which slows it
+    down to the pace of the file.
+
+    A process flushes its buffer when it exits. The listener is stopped before the queues of
+    the creating process are closed at exit; records logged after that are written directly.
+    """
+
+    def __init__(self, name, mode, maxsize, rotate, batch_size=64, flush_interval_ms=100,
+            queue_size=256, debug_sample_rate=10):
+        # Created first, so that logging.shutdown() closes it last: reopened after being closed,
+        # the file would be truncated again.
         self._handler = RotatingFileHandler(name, mode, maxsize, rotate)
-        self.queue = multiprocessing.Queue(-1)
-
-        thread = threading.Thread(target=self.receive)
-        thread.daemon = True
-        thread.start()
-
-    def setFormatter(self, fmt):
-        logging.Handler.setFormatter(self, fmt)
-        self._handler.setFormatter(fmt)
-
-    def receive(self):
-        while True:
-            try:
-                record = self.queue.get()
-                self._handler.emit(record)
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except EOFError:
-                break
-            except:
-                traceback.print_exc(file=sys.stderr)
-
-    def send(self, _str):
-        self.queue.put_nowait(_str)
-
-    def _format_record(self, record):
-        # Ensure that exc_info and args
-        # have been stringified. Removes any chance of
-        # unpickleable things inside and possibly reduces
-        # message size sent over the pipe.
-        if record.args:
-            record.msg = record.msg % record.args
-            record.args = None
-        if record.exc_info:
-            dummy = self.format(record)
-            record.exc_info = None
-
-        return record
-
-    def emit(self, record):
+        QueueHandler.__init__(self, multiprocessing.Queue(queue_size))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.debug_sample_rate = debug_sample_rate
+        self.nm_dropped = 0
+        self._file_closed = False
+        self._listener = _BatchListener(self.queue, self._handler)
+        self._listener.start()
+        self._pid = os.getpid()
+        # Run at exit before the finalizers closing the queues, which have a lower priority.
+        multiprocessing.util.Finalize(self, self._stop_listener, exitpriority=20)
+        self._reset()
+        _handlers.add(self)
+
+    def _reset(self):
+        # Records as (level, formatted record), and the process whose flusher thread runs.
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._nm_debug_seen = 0
+        self._nm_unreported = 0
+        self._next_report = 0
+        self._flusher_pid = None
+
+    def prepare(self, record):
+        return record.levelno, self.format(record)
+
+    def enqueue(self, entry):
+        if self._listener is None and os.getpid() == self._pid:
+            self._write([entry[1]])
+            return
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+        with self._buffer_lock:
+            self._buffer += [entry]
+            full = len(self._buffer) >= self.batch_size
+        if full or entry[0] >= logging.WARNING:
+            self.flush()
+
+    def _start_flusher(self):
+        with self._buffer_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._run_flusher, daemon=True).start()
+        if os.getpid() != self._pid:
+            # Forked processes exit without logging.shutdown(), but not without finalizers.
+            multiprocessing.util.Finalize(self, self.flush, args=(True,), exitpriority=20)
+
+    def _run_flusher(self):
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self, final=False):
+        """
+        Put the records buffered by this process to the queue. The final flush of a process
+        also reports the debug records dropped that are not reported yet.
+        """
+        # Flushes are taken in turn, so that batches are put in the order they were buffered.
+        with self._flush_lock:
+            self._flush(final)
+
+    def _flush(self, final):
+        with self._buffer_lock:
+            entries, self._buffer = self._buffer, []
+        if self._listener is None and os.getpid() == self._pid:
+            if entries:
+                self._write([ text for _, text in entries ])
+            return
+        if not entries and not self._nm_unreported:
+            return
         try:
-            _str = self._format_record(record)
-            self.send(_str)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            self.handleError(record)
+            self.queue.put_nowait([ text for _, text in entries ] + self._drop_report())
+            self._nm_unreported = 0
+            return
+        except queue.Full:
+            pass
+        batch = []
+        for level, text in entries:
+            if level < logging.INFO:
+                self._nm_debug_seen += 1
+                if not self.debug_sample_rate or self._nm_debug_seen % self.debug_sample_rate:
+                    self.nm_dropped += 1
+                    self._nm_unreported += 1
+                    continue
+            batch += [text]
+        # Reported at most once per interval while the queue stays full, rather than per batch.
+        report = []
+        if final or time.monotonic() >= self._next_report:
+            report = self._drop_report()
+            self._nm_unreported = 0
+            self._next_report = time.monotonic() + _DROP_REPORT_INTERVAL
+        if batch or report:
+            self.queue.put(batch + report)
+
+    def _drop_report(self):
+        if not self._nm_unreported:
+            return []
+        return [self.format(logging.LogRecord("root", logging.WARNING, __file__, 0,
+            "Dropped %d debug record(s) - the log could not keep up", (self._nm_unreported,),
+            None))]
+
+    def _write(self, lines):
+        # Records logged after close() are dropped: the file would be reopened and truncated.
+        if self._file_closed:
+            return
+        self._handler.emit(logging.makeLogRecord({'msg': "\n".join(lines),
+            'levelno': logging.INFO}))
+
+    def _stop_listener(self):
+        if os.getpid() != self._pid or self._listener is None:
+            return
+        self.flush(final=True)
+        self._listener.stop()
+        self._listener = None
+
+    def _reset_after_fork(self):
+        # The buffer holds records of the parent, which it flushes itself.
+        self._reset()
 
     def close(self):
-        self._handler.close()
-        logging.Handler.close(self)
+        if os.getpid() == self._pid:
+            self._stop_listener()
+            self._file_closed = True
+            self._handler.close()
+        else:
+            self.flush(final=True)
+        QueueHandler.close(self)
+
+
+class _BatchListener(QueueListener):
+    """Write each batch of formatted records taken from the queue to a handler in one write."""
+
+    def handle(self, batch):
+        handler = self.handlers[0]
+        handler.emit(logging.makeLogRecord({'msg': "\n".join(batch), 'levelno': logging.INFO}))
+
+    def enqueue_sentinel(self):
+        # The queue is bounded, so wait for room for it.
+        self.queue.put(self._sentinel)
+
+
+# Seconds between reports of dropped debug records while the queue stays full.
+_DROP_REPORT_INTERVAL = 1
+
+_handlers = weakref.WeakSet()
+
+def _reset_after_fork():
+    for handler in _handlers:
+        handler._reset_after_fork()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,23 @@
+"""Write files aside and rename them, so that a reader never sees part of one."""
+
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Open a file to write path through. It is written aside, as {path}.{pid}.tmp, and renamed to
+    path once closed, so that a process reading path, or a scraper, never sees part of it. When
+    writing fails, the file is removed and path is left as it was.
+    """
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
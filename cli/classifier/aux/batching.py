@@ -0,0 +1,48 @@
+"""Collect items from a queue into batches."""
+
+import queue
+import time
+
+
+def get_batch(source, batch_size, max_batch_wait_ms, stop=None, item_size=None):
+    """
+    Get a batch of at most batch_size items from a queue.
+
+    Blocks until the first item arrives, then waits at most max_batch_wait_ms for the batch to
+    fill up. Works with both queue.Queue and multiprocessing.Queue.
+
+    Parameters:
+        source (Queue): The queue to get items from
+        batch_size (int): The maximum number of items in a batch
+        max_batch_wait_ms (int): The maximum time to wait for a batch to fill up after the first
+                                 item has arrived
+        stop (object): A sentinel value; when received it is returned as the last item of the
+                       batch and no more items are collected
+        item_size (function): Get the size of an item, e.g. len for items that are lists, for
+                              batch_size to bound the total size of the items instead of their
+                              number
+
+    Returns:
+        batch ([object]): A list of 1 to batch_size items, or of items of a total size of at
+                          least 1 and at most batch_size plus the size of the last item
+    """
+
+    batch = [source.get()]
+    if batch[0] is stop:
+        return batch
+    size = item_size(batch[0]) if item_size else 1
+    deadline = time.monotonic() + max_batch_wait_ms / 1000
+    while size < batch_size:
+        timeout = deadline - time.monotonic()
+        try:
+            if timeout > 0:
+                item = source.get(timeout=timeout)
+            else:
+                item = source.get_nowait()
+        except queue.Empty:
+            break
+        batch += [item]
+        if item is stop:
+            break
+        size += item_size(item) if item_size else 1
+    return batch
@@ -0,0 +1,84 @@
+"""Histograms of observed values, exportable in the Prometheus text format."""
+
+import bisect
+import threading
+
+
+class Histogram:
+    """
+    Count observed values, e.g. latencies in seconds, in buckets with fixed upper bounds.
+
+    Quantiles are estimated as the upper bound of the bucket they fall in, which is exact
+    enough to tell a 10ms latency from a 100ms one without keeping every observation.
+    """
+
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+            30)
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Add an observed value."""
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def merge(self, other):
+        """Add the observations of another histogram with the same buckets."""
+        if other.buckets != self.buckets:
+            raise ValueError("Cannot merge histograms with different buckets")
+        with self._lock:
+            self.counts = [ a + b for a, b in zip(self.counts, other.counts) ]
+            self.count += other.count
+            self.sum += other.sum
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1) of the observed values."""
+        with self._lock:
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + [float('inf')], self.counts):
+                seen += count
+                if count and seen >= rank:
+                    return bound
+            return 0.0
+
+    def to_prometheus(self):
+        """Render the histogram in the Prometheus text exposition format."""
+        with self._lock:
+            lines = [
+                    "# HELP {} {}".format(self.name, self.description),
+                    "# TYPE {} histogram".format(self.name),
+                    ]
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float('inf')], self.counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines += ['{}_bucket{{le="{}"}} {}'.format(self.name, le, cumulative)]
+            lines += ["{}_sum {}".format(self.name, self.sum)]
+            lines += ["{}_count {}".format(self.name, self.count)]
+        return "\n".join(lines) + "\n"
+
+    def __getstate__(self):
+        # Histograms are passed between processes; the lock is not.
+        with self._lock:
+            state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "{}: count {}, mean {:.4f}, p50 <= {}, p95 <= {}, p99 <= {}".format(self.name,
+                self.count, self.sum / self.count if self.count else 0.0, self.quantile(0.5),
+                self.quantile(0.95), self.quantile(0.99))
@@ -0,0 +1,168 @@
+"""Pool of keep-alive HTTP connections, shared by the threads of a process."""
+
+import http.client
+import importlib.util
+import io
+import logging
+import ssl
+import threading
+import urllib.parse
+import urllib.request
+
+
+class HttpResponse:
+    """A fully read response, with the parts of the http.client.HTTPResponse interface used."""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._body = io.BytesIO(body)
+
+    def getcode(self):
+        return self.status
+
+    def read(self, *args):
+        return self._body.read(*args)
+
+    def readlines(self):
+        return self._body.readlines()
+
+    def close(self):
+        self._body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HttpPool:
+    """
+    Make GET requests over keep-alive connections, kept per host and reused across requests.
+
+    At most max_connections_per_host requests are made to a host at a time; other threads
+    wait for their turn. Every connection has a timeout, so that a host that stops answering
+    fails the request instead of stalling it forever.
+
+    With http2, requests are made by an httpx client instead, which multiplexes them over one
+    connection per host where the host supports HTTP/2. httpx and h2 are then needed.
+
+    Connections must not be shared between processes: call reset() in a forked process.
+    """
+
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 10
+    # Errors on a reused connection that mean the host closed it while it was idle.
+    STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+    def __init__(self, timeout=30, max_connections_per_host=8, http2=False):
+        self.timeout = timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.http2 = http2
+        if http2 and (importlib.util.find_spec('httpx') is None or
+                importlib.util.find_spec('h2') is None):
+            logging.warning("HTTP/2 needs the httpx and h2 packages - using HTTP/1.1")
+            self.http2 = False
+        self.user_agent = "Python-urllib/%s" % urllib.request.__version__
+        self._ssl_context = ssl.create_default_context()
+        self.reset()
+
+    def reset(self):
+        """Drop all connections, without closing them, e.g. in a forked process."""
+
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._httpx_client = None
+
+    def _slot(self, host):
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._slots[host]
+
+    def _connection(self, host):
+        with self._lock:
+            idle = self._idle.get(host)
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = host
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout,
+                    context=self._ssl_context), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _release(self, host, connection):
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.max_connections_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _request(self, host, path, headers):
+        while True:
+            connection, reused = self._connection(host)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except HttpPool.STALE_ERRORS:
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(host, connection)
+            return response, body
+
+    def _get_http2(self, url, headers):
+        import httpx
+        with self._lock:
+            if self._httpx_client is None:
+                self._httpx_client = httpx.Client(http2=True, timeout=self.timeout,
+                        follow_redirects=True, headers={'User-Agent': self.user_agent},
+                        limits=httpx.Limits(max_keepalive_connections=None,
+                            max_connections=None))
+            client = self._httpx_client
+        try:
+            response = client.get(url, headers=headers)
+        except httpx.TransportError as err:
+            raise ConnectionError(str(err)) from err
+        return HttpResponse(str(response.url), response.status_code, response.reason_phrase,
+                response.headers, response.content)
+
+    def get(self, url, headers=None):
+        """
+        Get a URL, following redirects.
+
+        Error statuses are returned like any other; it is up to the caller to check them.
+        Raises ValueError for URLs that are not HTTP(S), and OSError or
+        http.client.HTTPException when the request fails.
+        """
+
+        headers = dict({'User-Agent': self.user_agent}, **(headers or {}))
+        for _ in range(HttpPool.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.netloc:
+                raise ValueError("Not an HTTP(S) URL: '{}'".format(url))
+            host = (parts.scheme, parts.netloc)
+            with self._slot(host):
+                if self.http2:
+                    return self._get_http2(url, headers)
+                path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+                response, body = self._request(host, path, headers)
+            location = response.getheader('Location')
+            if response.status not in HttpPool.REDIRECT_CODES or not location:
+                return HttpResponse(url, response.status, response.reason, response.headers,
+                        body)
+            url = urllib.parse.urljoin(url, location)
+        raise http.client.HTTPException("Too many redirects for '{}'".format(url))
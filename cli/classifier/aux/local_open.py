@@ -0,0 +1,239 @@
+"""Read images from local files, directories, globs and tar/zip archives."""
+
+import collections
+import glob
+import logging
+import mmap
+import os
+import re
+import struct
+import tarfile
+import threading
+import zipfile
+import zlib
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tif', '.tiff')
+ARCHIVE_EXTENSIONS = ('.tar', '.zip')
+
+_URL = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*://")
+_FILE_URL_PREFIX = "file://"
+_GLOB_CHARACTERS = re.compile(r"[*?[]")
+
+# Bytes of an archive asked to be read ahead of the member read last.
+_readahead = 16 * 1024**2
+
+
+def configure_local_open(readahead_mb):
+    """Set how far ahead archives are read while their members are read in order."""
+
+    global _readahead
+    _readahead = readahead_mb * 1024**2
+
+
+def is_local(name):
+    """Check whether an image name is a local path or file:// URL rather than a URL to fetch."""
+
+    return not _URL.match(name) or name.startswith(_FILE_URL_PREFIX)
+
+
+def _path(name):
+    return name[len(_FILE_URL_PREFIX):] if name.startswith(_FILE_URL_PREFIX) else name
+
+
+def _is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _is_archive(name):
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def expand(name):
+    """
+    Expand an input line into the names of the images it stands for, lazily.
+
+    URLs and paths to files are images themselves. A directory stands for the images under it,
+    a glob for what its matches stand for, and a tar or zip archive for the images in it, named
+    <archive path>/<member name>. Directories and globs are expanded in sorted order, archives
+    in the order of their members, so that they are read sequentially.
+    """
+
+    if not name or not is_local(name):
+        yield name
+        return
+    path = _path(name)
+    if os.path.isdir(path):
+        for directory, subdirectories, files in os.walk(path):
+            subdirectories.sort()
+            for file in sorted(files):
+                file_path = os.path.join(directory, file)
+                if _is_archive(file):
+                    yield from _archive_members(file_path)
+                elif _is_image(file):
+                    yield file_path
+    elif _is_archive(path) and os.path.isfile(path):
+        yield from _archive_members(path)
+    elif _GLOB_CHARACTERS.search(path) and not os.path.exists(path):
+        matches = sorted(glob.glob(path, recursive=True))
+        if not matches:
+            logging.warning("No files match '%s'", path)
+        for match in matches:
+            yield from expand(match)
+    else:
+        yield path
+
+
+def _archive_members(path):
+    try:
+        return _archive(path).members()
+    except OSError as e:
+        logging.warning("Error reading archive '%s': %s", path, e)
+        return []
+
+
+def local_read(name):
+    """
+    Read the raw bytes of a local image: a file, read in one go, or a member of an archive,
+    read from a memory map of the archive. Raises OSError when it cannot be read.
+    """
+
+    path = _path(name)
+    archive, member = _split_archive(path)
+    if archive is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    return _archive(archive).read(member)
+
+
+def local_version(name):
+    """
+    Get a string that changes whenever a local image may have changed: its size and
+    modification time, with its place in the archive for archive members. Raises OSError when
+    the image does not exist.
+    """
+
+    path = _path(name)
+    archive, member = _split_archive(path)
+    if archive is None:
+        st = os.stat(path)
+        return "{}:{}".format(st.st_size, st.st_mtime_ns)
+    st = os.stat(archive)
+    offset, size, _ = _archive(archive).entry(member)
+    return "{}:{}:{}:{}".format(st.st_size, st.st_mtime_ns, offset, size)
+
+
+def _split_archive(path):
+    """Split the path of an archive member into (archive path, member name), or (None, None)."""
+
+    head = path
+    while True:
+        head, tail = os.path.split(head)
+        if not head or not tail:
+            return None, None
+        if _is_archive(head) and os.path.isfile(head):
+            return head, path[len(head) + 1:].replace(os.sep, "/")
+
+
+class _Archive:
+    """
+    Archive memory-mapped, and indexed by member name as (data offset, size, zip compression).
+
+    Members stored as they are, and those of zip archives deflated, are read straight from the
+    memory map, from any number of threads. As members are read, the next readahead bytes are
+    asked to be read in ahead of time, so that reads in member order do not wait on the disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+            self.index = (self._zip_index() if path.lower().endswith(".zip")
+                    else self._tar_index())
+        except (ValueError, struct.error, tarfile.TarError, zipfile.BadZipFile) as e:
+            raise OSError("Not a valid archive: {}".format(e))
+        self._readahead_end = 0
+        self._lock = threading.Lock()
+        self._zipfile = None
+
+    def _tar_index(self):
+        with tarfile.open(self.path, 'r:') as tar:
+            return { member.name: (member.offset_data, member.size, None)
+                    for member in tar if member.isfile() and _is_image(member.name) }
+
+    def _zip_index(self):
+        index = {}
+        with zipfile.ZipFile(self.path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not _is_image(info.filename):
+                    continue
+                # The data follows the local header, whose name and extra field lengths may
+                # differ from those of the central directory.
+                name_length, extra_length = struct.unpack_from("<HH", self.map,
+                        info.header_offset + 26)
+                index[info.filename] = (info.header_offset + 30 + name_length + extra_length,
+                        info.compress_size, info.compress_type)
+        return index
+
+    def members(self):
+        """Get the names of the images of the archive, in the order they are stored in."""
+
+        return [ self.path + "/" + member for member, _ in sorted(self.index.items(),
+            key=lambda x: x[1][0]) ]
+
+    def entry(self, member):
+        try:
+            return self.index[member]
+        except KeyError:
+            raise FileNotFoundError("No image '{}' in archive '{}'".format(member, self.path))
+
+    def read(self, member):
+        offset, size, compression = self.entry(member)
+        self._read_ahead(offset + size)
+        if compression in (None, zipfile.ZIP_STORED):
+            return self.map[offset:offset + size]
+        if compression == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(self.map[offset:offset + size], -zlib.MAX_WBITS)
+        # Other compressions are rare for images, which hardly compress.
+        with self._lock:
+            if self._zipfile is None:
+                self._zipfile = zipfile.ZipFile(self.path)
+            return self._zipfile.read(member)
+
+    def _read_ahead(self, end):
+        if not hasattr(mmap, 'MADV_WILLNEED') or not _readahead:
+            return
+        # Asked again once half of the bytes read ahead are read, in one call for all of them.
+        with self._lock:
+            if end <= self._readahead_end - _readahead // 2:
+                return
+            start = max(self._readahead_end, end) // mmap.PAGESIZE * mmap.PAGESIZE
+            self._readahead_end = stop = min(end + _readahead, len(self.map))
+        if start < stop:
+            self.map.madvise(mmap.MADV_WILLNEED, start, stop - start)
+
+
+# Every memory map keeps a file descriptor open, so only the archives used last are kept open.
+# Reads are in order, so an archive is seldom opened again once left.
+_MAX_OPEN_ARCHIVES = 64
+
+_archives = collections.OrderedDict()
+_archives_lock = threading.Lock()
+
+
+def _archive(path):
+    """Get the indexed archive at a path, opening it on first use."""
+
+    with _archives_lock:
+        archive = _archives.get(path)
+        if archive is None:
+            archive = _archives[path] = _Archive(path)
+            # The map of an archive dropped while being read is closed once the read is done.
+            while len(_archives) > _MAX_OPEN_ARCHIVES:
+                _archives.popitem(last=False)
+        else:
+            _archives.move_to_end(path)
+        return archive
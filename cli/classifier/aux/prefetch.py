@@ -0,0 +1,68 @@
+"""Run a function on items ahead of their use, in a small pool of threads."""
+
+import concurrent.futures
+import contextlib
+import queue
+import threading
+
+
+class Prefetcher:
+    """
+    Run a function on the items submitted, in a pool of threads, while the caller does other
+    work until it needs the results of the futures returned.
+
+    This pays off when the function releases the GIL, as OpenCV does, and so does the work of
+    the caller, e.g. a model call. How far the threads run ahead is up to the caller, by how
+    many items it submits before waiting on their results. With no threads, submit() runs the
+    function itself. With stats, a Throughput, the time the threads spend waiting for items to
+    be submitted is counted as stalled.
+    """
+
+    def __init__(self, function, nm_threads, stats=None):
+        self.function = function
+        self.stats = stats
+        self._queue = queue.Queue()
+        self._threads = [ threading.Thread(target=self._run, daemon=True)
+                for _ in range(nm_threads) ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item):
+        """Queue an item, and get a future for the result of the function on it."""
+
+        future = concurrent.futures.Future()
+        if self._threads:
+            self._queue.put((item, future))
+        else:
+            self._call(item, future)
+        return future
+
+    def _call(self, item, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.function(item))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _run(self):
+        while True:
+            with self.stats.stalled() if self.stats else contextlib.nullcontext():
+                entry = self._queue.get()
+            if entry is None:
+                break
+            self._call(*entry)
+
+    def close(self):
+        """Wait for the items submitted to be handled, and stop the threads."""
+
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
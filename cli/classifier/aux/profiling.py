@@ -0,0 +1,37 @@
+"""Profile processes one by one, and merge their profiles."""
+
+import cProfile
+import os
+import pstats
+
+
+PROFILE_SUFFIX = ".prof"
+
+
+def run_profiled(function, directory, name):
+    """
+    Run a function under cProfile, and save its profile to directory as name.prof, also when
+    it raises. Returns what the function returns.
+    """
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        profiler.dump_stats(os.path.join(directory, name + PROFILE_SUFFIX))
+
+
+def merge_profiles(directory, stream=None):
+    """
+    Merge the profiles saved to a directory by run_profiled(), so that the time spent in a
+    function is summed over all processes.
+
+    Returns:
+        stats (pstats.Stats): The merged profiles, printing to stream, or None if there are none
+    """
+
+    paths = sorted( os.path.join(directory, name) for name in os.listdir(directory)
+            if name.endswith(PROFILE_SUFFIX) )
+    if not paths:
+        return None
+    return pstats.Stats(*paths, stream=stream)
@@ -0,0 +1,180 @@
+"""Persistent cache of results computed from the content of URLs."""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from aux.local_open import is_local, local_read, local_version
+from aux.url_open import url_open
+
+
+class ResultCache:
+    """
+    Cache results on disk in an SQLite database.
+
+    Results are stored by a hash of the content they were computed from, together with a
+    signature of how they were computed (e.g. the model used), so that the same content under
+    different URLs shares one result. Each URL maps to the hash of the content last fetched from
+    it. A URL that was checked less than ttl seconds ago is answered without any request; an
+    older one is revalidated with a conditional request using its ETag/Last-Modified. Local
+    files are revalidated every time by their size and modification time instead, which needs
+    no read.
+
+    Results are evicted least recently used first once their total size exceeds max_size bytes.
+    """
+
+    def __init__(self, path, signature, max_size, ttl):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.signature = signature
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, "
+                "content_hash TEXT, etag TEXT, last_modified TEXT, checked REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (content_hash TEXT, "
+                "signature TEXT, result TEXT, size INTEGER, accessed REAL, "
+                "PRIMARY KEY (content_hash, signature))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def _result(self, content_hash):
+        row = self._db.execute("SELECT result FROM results WHERE content_hash = ? AND "
+                "signature = ?", (content_hash, self.signature)).fetchone()
+        if row is None:
+            return None
+        self._db.execute("UPDATE results SET accessed = ? WHERE content_hash = ? AND "
+                "signature = ?", (time.time(), content_hash, self.signature))
+        return json.loads(row[0])
+
+    def _store_url(self, key):
+        self._db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)",
+                (key['url'], key['content_hash'], key['etag'], key['last_modified'], time.time()))
+
+    def _evict(self):
+        excess = self._size - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for content_hash, signature, size in self._db.execute("SELECT content_hash, "
+                "signature, size FROM results ORDER BY accessed"):
+            evicted += [(content_hash, signature)]
+            excess -= size
+            self._size -= size
+            if excess <= 0:
+                break
+        self._db.executemany("DELETE FROM results WHERE content_hash = ? AND signature = ?",
+                evicted)
+        logging.debug("Evicted %d result(s) from cache", len(evicted))
+
+    def fetch(self, url, attempt=0, block=True):
+        """
+        Fetch the result for a URL, or the content of the URL when there is no result for it.
+
+        Raises UrlOpenFatalException when the URL has to be fetched and cannot be, or OSError
+        for a local file. attempt and block are passed on to url_open(), which raises
+        UrlOpenRetryException when the URL should be fetched again later without block.
+
+        Returns:
+            (result, data, key): The cached result, or None together with the fetched content
+                                 and the key to store its result under with store()
+        """
+
+        if is_local(url):
+            return self._fetch_local(url)
+        with self._lock:
+            row = self._db.execute("SELECT content_hash, etag, last_modified, checked FROM urls "
+                    "WHERE url = ?", (url,)).fetchone()
+            if row is not None and time.time() - row[3] < self.ttl:
+                result = self._result(row[0])
+                if result is not None:
+                    self.hits += 1
+                    return result, None, None
+
+        headers = {}
+        if row is not None and row[1]:
+            headers['If-None-Match'] = row[1]
+        if row is not None and row[2]:
+            headers['If-Modified-Since'] = row[2]
+        response = url_open(url, headers, attempt, block)
+        if response.getcode() == 304:
+            with self._lock:
+                result = self._result(row[0])
+                if result is not None:
+                    self.hits += 1
+                    self.revalidations += 1
+                    self._store_url({'url': url, 'content_hash': row[0], 'etag': row[1],
+                        'last_modified': row[2]})
+                    self._db.commit()
+                    return result, None, None
+            response = url_open(url, attempt=attempt, block=block)
+        return self._fetched(url, response.read(), response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+
+    def _fetch_local(self, path):
+        # The version of a local file stands in for its ETag.
+        version = local_version(path)
+        with self._lock:
+            row = self._db.execute("SELECT content_hash, etag FROM urls WHERE url = ?",
+                    (path,)).fetchone()
+            if row is not None and row[1] == version:
+                result = self._result(row[0])
+                if result is not None:
+                    self.hits += 1
+                    return result, None, None
+        return self._fetched(path, local_read(path), version, None)
+
+    def _fetched(self, url, data, etag, last_modified):
+        key = {
+                'url': url,
+                'content_hash': hashlib.sha256(data).hexdigest(),
+                'etag': etag,
+                'last_modified': last_modified,
+                }
+        with self._lock:
+            result = self._result(key['content_hash'])
+            if result is not None:
+                self.hits += 1
+                self._store_url(key)
+                self._db.commit()
+                return result, None, None
+            self.misses += 1
+        return None, data, key
+
+    def store(self, key, result):
+        """Store the result computed from the content fetched for a key."""
+
+        result = json.dumps(result)
+        with self._lock:
+            row = self._db.execute("SELECT size FROM results WHERE content_hash = ? AND "
+                    "signature = ?", (key['content_hash'], self.signature)).fetchone()
+            if row is not None:
+                self._size -= row[0]
+            self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                    (key['content_hash'], self.signature, result, len(result), time.time()))
+            self._size += len(result)
+            self._store_url(key)
+            self._evict()
+            self._db.commit()
+
+    def close(self):
+        """Commit and close the cache."""
+
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def __str__(self):
+        return "{} hit(s) ({} revalidated), {} miss(es)".format(self.hits, self.revalidations,
+                self.misses)
@@ -0,0 +1,108 @@
+"""Retry policy with jittered exponential backoff, and circuit breakers per host."""
+
+import logging
+import os
+import random
+import threading
+import time
+
+
+class RetryPolicy:
+    """
+    Decide how long to wait before retrying a failed request.
+
+    The n-th retry waits a random time between 0 and base_delay_ms * 2^n, capped at
+    max_delay_ms ("full jitter"). Spreading the retries out keeps the requests that failed
+    together, e.g. when a host went down for a moment, from all being retried together.
+    """
+
+    def __init__(self, max_retries=4, base_delay_ms=250, max_delay_ms=8000):
+        self.max_retries = max_retries
+        self.base_delay_ms = base_delay_ms
+        self.max_delay_ms = max_delay_ms
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Get the seconds to wait before retry number attempt + 1, at least retry_after seconds
+        if the host asked for that, within max_delay_ms.
+        """
+
+        max_delay = min(self.max_delay_ms, self.base_delay_ms * 2**attempt) / 1000
+        delay = random.uniform(0, max_delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return min(delay, self.max_delay_ms / 1000)
+
+
+class CircuitBreaker:
+    """
+    Fail requests to a host fast once it is down, instead of waiting on every one of them.
+
+    A host is marked down after failures consecutive failed requests. While down, requests to
+    it are not made. After reset_s seconds a single request is let through: the host is up
+    again if it succeeds, and down for another reset_s seconds if it fails.
+    """
+
+    def __init__(self, failures=5, reset_s=30):
+        self.failures = failures
+        self.reset_s = reset_s
+        self.nm_fast_failures = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the state of all hosts."""
+
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def allow(self, host):
+        """Check whether a request to a host may be made."""
+
+        with self._lock:
+            nm_failures, down_until = self._hosts.get(host, (0, None))
+            if down_until is None:
+                return True
+            now = time.monotonic()
+            if now < down_until:
+                self.nm_fast_failures += 1
+                return False
+            # Let one request through to find out whether the host is back.
+            self._hosts[host] = (nm_failures, now + self.reset_s)
+            return True
+
+    def record(self, host, success):
+        """Record the outcome of a request to a host."""
+
+        with self._lock:
+            if success:
+                if self._hosts.pop(host, (0, None))[1] is not None:
+                    logging.info("Host '%s' is up again", host)
+                return
+            nm_failures, down_until = self._hosts.get(host, (0, None))
+            nm_failures += 1
+            if nm_failures >= self.failures:
+                if down_until is None:
+                    logging.warning("Host '%s' is down after %d failed requests - failing its "
+                            "requests for %ds", host, nm_failures, self.reset_s)
+                down_until = time.monotonic() + self.reset_s
+            self._hosts[host] = (nm_failures, down_until)
+
+
+policy = RetryPolicy()
+breaker = CircuitBreaker()
+
+
+def _reset_after_fork():
+    # The lock may have been held by another thread at the fork.
+    breaker.reset()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def configure_retry(max_retries, base_delay_ms, max_delay_ms, breaker_failures,
+        breaker_reset_s):
+    """Set the retry policy and circuit breakers of this process and the processes it starts."""
+
+    global policy, breaker
+    policy = RetryPolicy(max_retries, base_delay_ms, max_delay_ms)
+    breaker = CircuitBreaker(breaker_failures, breaker_reset_s)
@@ -0,0 +1,66 @@
+"""Latency histograms of the stages an image goes through, aggregated across processes."""
+
+from contextlib import contextmanager
+from time import perf_counter
+
+from aux.atomic_write import atomic_write
+from aux.histogram import Histogram
+
+
+class StageMetrics:
+    """
+    Time every stage of classifying an image in a Histogram of its own.
+
+    fetch, decode and resize are timed per image; tensor (building the input of the model),
+    model (the model call) and scoring (getting the top n results) per batch. Each process
+    times the stages it runs, and the StageMetrics of all processes are summed with merge().
+    """
+
+    STAGES = {
+            'fetch': "Time taken to download or read an image, or to find it in the cache.",
+            'decode': "Time taken to decode an image.",
+            'resize': "Time taken to resize a decoded image to the model input size.",
+            'tensor': "Time taken to build the input tensor of a batch.",
+            'model': "Time taken by a model call on a batch.",
+            'scoring': "Time taken to get the top n results of a batch.",
+            }
+    # Decoding a small image or scoring a batch takes well under a millisecond.
+    BUCKETS = (0.0001, 0.00025, 0.0005) + Histogram.LATENCY_BUCKETS
+
+    def __init__(self):
+        self.histograms = { stage: Histogram("classifier_{}_seconds".format(stage), description,
+            StageMetrics.BUCKETS) for stage, description in StageMetrics.STAGES.items() }
+
+    @contextmanager
+    def time(self, stage):
+        """Measure the time spent in a stage."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[stage].observe(perf_counter() - start)
+
+    def merge(self, other):
+        """Add the observations of another StageMetrics, e.g. of another process."""
+        for stage, histogram in self.histograms.items():
+            histogram.merge(other.histograms[stage])
+
+    def to_prometheus(self):
+        """Render the histograms in the Prometheus text exposition format."""
+        return "".join(histogram.to_prometheus() for histogram in self.histograms.values())
+
+    def write(self, path):
+        """Write the histograms to a file in the Prometheus text format, e.g. for node_exporter."""
+        with atomic_write(path) as f:
+            f.write(self.to_prometheus())
+
+    def table(self):
+        """Summarize the stages in a table, with quantiles as the bucket bounds they are under."""
+        lines = ["{:<8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format("stage", "count",
+            "total s", "mean ms", "p50 ms<=", "p95 ms<=", "p99 ms<=")]
+        for stage, histogram in self.histograms.items():
+            mean = histogram.sum / histogram.count if histogram.count else 0.0
+            lines += ["{:<8} {:>8} {:>10.3f} {:>10.3f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                stage, histogram.count, histogram.sum, mean * 1000,
+                *( histogram.quantile(q) * 1000 for q in [0.5, 0.95, 0.99] ))]
+        return "\n".join(lines)
@@ -0,0 +1,51 @@
+"""Throughput counters for pipeline stages."""
+
+from contextlib import contextmanager
+from time import perf_counter
+import threading
+
+
+class Throughput:
+    """
+    Count the items handled by a pipeline stage and where its time went.
+
+    Busy time is the time spent working on items, summed over all threads of the stage.
+    Stalled time is the time spent waiting on a neighbouring stage, e.g. for input to arrive
+    or for room in an output queue. A stage that is mostly stalled waiting for input is fed
+    too slowly; a stage that is mostly stalled on output is faster than the one after it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy_time = 0.0
+        self.stalled_time = 0.0
+        self._start = perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def busy(self, nm_items=1):
+        """Measure the time spent working on nm_items items."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.busy_time += perf_counter() - start
+                self.count += nm_items
+
+    @contextmanager
+    def stalled(self):
+        """Measure the time spent waiting on another stage."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stalled_time += perf_counter() - start
+
+    def __str__(self):
+        elapsed = perf_counter() - self._start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        return "{}: {} item(s) in {:.4f}s ({:.2f}/s), busy {:.4f}s, stalled {:.4f}s".format(
+                self.name, self.count, elapsed, rate, self.busy_time, self.stalled_time)
@@ -1,42 +1,153 @@
-"""Simple wrapper for urllib.request.urlopen to make it retry on non-fatal failures."""
+"""
+Open URLs over pooled keep-alive connections, retrying on failures that may be temporary.
 
+HTTP(S) URLs are fetched through an HttpPool shared by the threads of the process. Other URLs,
+and URLs that go through a proxy, are opened with urllib.request.urlopen().
+"""
+
+import http.client
 import logging
-import time
+import os
+import socket
 import ssl
+import time
+import urllib.parse
 import urllib.request
 
+from aux import retry
+from aux.http_pool import HttpPool
+
 
 class UrlOpenFatalException(Exception):
     """Exception signifying an error no reason to retry for."""
 
 
-def url_open(url):
-    """Call urllib.request.urlopen() and retry on non-fatal failures."""
+class UrlOpenRetryException(Exception):
+    """Exception signifying that a URL should be opened again after a delay."""
+
+    def __init__(self, delay, attempt):
+        Exception.__init__(self, delay, attempt)
+        self.delay = delay
+        self.attempt = attempt
+
+
+# Statuses answered by hosts that are overloaded or briefly unavailable.
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+_timeout = 30
+_pool = HttpPool(_timeout)
+
+
+def _reset_after_fork():
+    # Connections of the parent are not to be shared with it.
+    if _pool is not None:
+        _pool.reset()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def configure_url_open(timeout, max_connections_per_host, http2=False, keep_alive=True):
+    """
+    Set how URLs are opened in this process and the processes it starts from now on.
+
+    Parameters:
+        timeout (float): Seconds to wait for a host to connect or to send more data
+        max_connections_per_host (int): Requests made to the same host at a time
+        http2 (bool): Use HTTP/2 where hosts support it
+        keep_alive (bool): Keep connections open to reuse them, rather than opening a new one
+                           per request with urllib
+    """
 
-    response = None
-    retry = 1
-    retry_max = 5
-    retry_wait = 1
+    global _timeout, _pool
+    _timeout = timeout
+    _pool = HttpPool(timeout, max_connections_per_host, http2) if keep_alive else None
 
+
+def _open(url, headers):
+    scheme = urllib.parse.urlsplit(url).scheme
+    if _pool is not None and scheme in ('http', 'https') and \
+            not urllib.request.getproxies().get(scheme):
+        return _pool.get(url, headers)
+    try:
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                timeout=_timeout)
+    except urllib.error.HTTPError as err:
+        return err
+
+
+def _is_permanent(err):
+    """Check whether a request error will not go away by retrying, e.g. an unknown host."""
+
+    reason = getattr(err, 'reason', err)
+    return isinstance(reason, (socket.gaierror, ssl.SSLCertVerificationError))
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def url_open(url, headers=None, attempt=0, block=True):
+    """
+    Open a URL and retry on failures that may be temporary.
+
+    Connection errors, timeouts, broken responses and the statuses in RETRY_STATUSES are
+    retried up to retry.policy.max_retries times, with jittered exponential backoff. Requests
+    to a host that retry.breaker has marked down fail at once.
+
+    Extra request headers can be given, e.g. for a conditional request. A 304 Not Modified
+    answer to such a request is returned like any other response; other error statuses are
+    fatal.
+
+    Parameters:
+        url (str): The URL to open
+        headers (dict): Extra request headers
+        attempt (int): The number of times the URL has been tried already
+        block (bool): Wait between retries. Otherwise UrlOpenRetryException is raised when the
+                      URL should be retried, for the caller to do other work meanwhile
+
+    Returns:
+        response: A response with read(), readlines(), getcode() and headers
+    """
+
+    host = urllib.parse.urlsplit(url).netloc
     while True:
-        rerun = False
+        if not retry.breaker.allow(host):
+            logging.debug("Host of URL '%s' is down - not opening it", url)
+            raise UrlOpenFatalException
 
+        retry_after = None
         try:
-            response = urllib.request.urlopen(url)
-        except (ValueError, ssl.SSLError, urllib.error.HTTPError, urllib.error.URLError) as err:
+            response = _open(url, headers or {})
+        except ValueError as err:
             logging.warning("Error opening URL '%s': %s", url, err)
             raise UrlOpenFatalException
-        except Exception:
-            if retry == retry_max:
-                logging.warning("Opening URL '%s' failed after %d retries", url, retry_max)
+        except (OSError, http.client.HTTPException) as err:
+            retry.breaker.record(host, False)
+            if _is_permanent(err):
+                logging.warning("Error opening URL '%s': %s", url, err)
                 raise UrlOpenFatalException
-            logging.debug("Error opening URL '%s' - making retry %d/%d", url, retry, retry_max,
-                    exc_info=True)
-            retry += 1
-            rerun = True
-            time.sleep(retry_wait)
-
-        if not rerun:
-            break
+            error = err
+        else:
+            code = response.getcode()
+            retry.breaker.record(host, code < 500 and code != 429)
+            if code < 400:
+                return response
+            response.close()
+            error = "HTTP Error {}: {}".format(code, response.reason)
+            if code not in RETRY_STATUSES:
+                logging.warning("Error opening URL '%s': %s", url, error)
+                raise UrlOpenFatalException
+            retry_after = _retry_after(response)
 
-    return response
+        if attempt >= retry.policy.max_retries:
+            logging.warning("Opening URL '%s' failed after %d retries: %s", url, attempt, error)
+            raise UrlOpenFatalException
+        delay = retry.policy.delay(attempt, retry_after)
+        attempt += 1
+        logging.debug("Error opening URL '%s': %s - making retry %d/%d in %.3fs", url, error,
+                attempt, retry.policy.max_retries, delay)
+        if not block:
+            raise UrlOpenRetryException(delay, attempt)
+        time.sleep(delay)
@@ -1,13 +1,30 @@
 """Classify birds from images."""
 
 
+import collections
+import contextlib
+import itertools
 import logging
 import configparser
 import multiprocessing
-import tensorflow
-
+import queue
+import resource
+import threading
+import numpy as np
+
+from aux.batching import get_batch
+from aux.prefetch import Prefetcher
+from aux.profiling import run_profiled
+from aux.result_cache import ResultCache
+from aux.stage_metrics import StageMetrics
+from aux.throughput import Throughput
 from aux.timec import timec
-from classification.classification import Classification, ClassificationFatalException
+from classification.classification import (Classification, ClassificationFatalException,
+        ClassificationResult, Tf)
+from classification.Deduplicator import Deduplicator, PerceptualIndex
+from classification.ImageDownloader import ImageDownloader
+from classification.Journal import Journal
+from classification.PoolScheduler import PoolScheduler
 
 
 class _StopAllException(Exception):
@@ -19,140 +36,421 @@ class _StopTaskException(Exception):
 
 
 class _BirdClassifier:
-    """Handle BirdClassifierTasks."""
+    """Handle BirdClassifierTasks, timing the stages they go through in metrics."""
 
-    def __init__(self, args):
+    def __init__(self, args, metrics=None):
         self.args = args
+        self.metrics = metrics if metrics is not None else StageMetrics()
+        self.decode_stats = Throughput("decode")
+        self.inference_stats = Throughput("inference")
+        self.nm_model_calls = 0
+        self.batch_buffer = None
+        self.perceptual_answers = PerceptualIndex(args['dedup_max_entries'],
+                args['dedup_perceptual_distance']) if args['dedup_perceptual'] else None
+        self.nm_perceptual_duplicates = 0
 
     def load(self, args):
+        """
+        Load the model. The labels are not needed to classify, as answers are kept as label ids;
+        they are loaded by whoever writes the answers out.
+        """
+
+        Tf.set_threads(self.args['tf_intra_op_threads'], self.args['tf_inter_op_threads'])
         bird_model = None
         try:
             with timec() as t:
-                bird_model = Classification.load_model(self.args['url_model'])
+                bird_model = self.load_model()
             if self.args['time']: logging.debug(f"Time taken for model load: {t():.4f}s")
         except ClassificationFatalException:
             logging.error("Failed to load model - stopping")
             raise _StopAllException
-        bird_labels = None
+        return bird_model
+
+    def load_model(self):
+        """Load the model with the backend of the arguments: tensorflow or tflite."""
+
+        if self.args['backend'] == 'tflite':
+            quantization = self.args['tflite_quantization']
+            return Classification.load_tflite_model(self.args['url_model'],
+                    self.args['model_dir'], Classification.tflite_path(self.args['url_model'],
+                        quantization, self.args['tfhub_cache_dir']), quantization,
+                    self.args['tf_intra_op_threads'])
+        return Classification.load_model(self.args['url_model'], self.args['model_dir'],
+                self.args['inference'], self.args['batch_size'])
+
+    def prepare_task(self, task):
+        """Load and format the image of a task, using its downloaded data when present."""
+
         try:
-            with timec() as t:
-                bird_labels = Classification.load_labels(self.args['url_labels'])
-            if self.args['time']: logging.debug(f"Time taken for labels load: {t():.4f}s")
+            if task.data is None:
+                with self.metrics.time('fetch'):
+                    image_array = Classification.load_image(task.image)
+            else:
+                image_array = Classification.image_array(task.data)
+            return Classification.format_image(image_array, self.metrics)
         except ClassificationFatalException:
-            logging.error("Failed to load labels - stopping")
-            raise _StopAllException
-        return bird_model, bird_labels
+            raise _StopTaskException
 
-    def handle_task(self, task, bird_model, bird_labels):
+    def call_model(self, images, bird_model):
+        """Run the model once on a list of formatted images."""
+
+        # The batch buffer is reused by every call; the tensor is done with once call() returns.
+        if self.batch_buffer is None or len(self.batch_buffer) < len(images):
+            size = Classification.IMAGE_SIZE
+            self.batch_buffer = np.empty((max(len(images), self.args['batch_size']), size, size,
+                3), dtype=np.float32)
+        with self.metrics.time('tensor'):
+            image_tensor = Classification.generate_tensor(images, self.batch_buffer)
+        with timec() as t, self.metrics.time('model'):
+            # Unless inference is eager, call() runs a function traced at load time, instead of
+            # dispatching every op of the model eagerly.
+            model_raw_output = bird_model.call(image_tensor).numpy()
+        self.nm_model_calls += 1
+        if self.args['time']:
+            first = "first " if self.nm_model_calls == 1 else ""
+            logging.debug(f"Time taken for {first}model call (batch of {len(images)}): {t():.4f}s")
+        return model_raw_output
+
+    def classify(self, images, bird_model):
+        """
+        Classify a list of formatted images.
+
+        The images are sent through the model in a single call. Should that call fail, each
+        image is retried on its own so that one bad image does not fail the rest of the batch.
+
+        Returns:
+            results ([(np.ndarray, np.ndarray)]): The label ids and scores of the top n results
+                                                  per image, or None for images that could not
+                                                  be classified
+        """
+
+        tf = Tf.get()
         try:
-            image_array = Classification.load_image(task.image)
-            image = Classification.format_image(image_array)
-            image_tensor = Classification.generate_tensor(image)
+            model_raw_outputs = self.call_model(images, bird_model)
+        except tf.errors.InvalidArgumentError:
+            if len(images) == 1:
+                return [None]
+            logging.debug("Model call failed for batch of %d - retrying one by one", len(images))
+            return [ self.classify([image], bird_model)[0] for image in images ]
+
+        with self.metrics.time('scoring'):
+            label_ids, scores, nm_results = Classification.top_n(model_raw_outputs,
+                    self.args['nm_top_results'], softmax=self.args['score_softmax'],
+                    threshold=self.args['score_threshold'])
+        return [ (label_ids[i, :k], scores[i, :k]) for i, k in enumerate(nm_results.tolist()) ]
+
+    def prepare(self, task):
+        """Load and format the image of a task, or return None if that fails."""
+
+        try:
+            with self.decode_stats.busy():
+                return self.prepare_task(task)
+        except _StopTaskException:
+            logging.debug("Stopping task %s", str(task))
+        except Exception:
+            logging.exception("Unexpected error when handling task %s", str(task))
+        return None
+
+    def respond(self, tasks, images, bird_model):
+        """
+        Classify the formatted images of a list of tasks and return one response per task, in
+        the same order. Tasks whose image is None get a response without classifications.
+        """
+
+        results = [(None, None)] * len(tasks)
+        prepared = [ i for i, image in enumerate(images) if image is not None ]
+        copies = {}
+        if self.perceptual_answers is not None:
+            prepared, copies, hashes = self._perceptual_unique(images, prepared, results)
+        if prepared:
             try:
-                with timec() as t:
-                    # call() calls the model on new inputs:
-                    # "In this case call just reapplies all ops in the graph to the new inputs
-                    # (e.g. build a new computational graph from the provided inputs)."
-                    model_raw_output = bird_model.call(image_tensor).numpy()
-                if self.args['time']: logging.debug(f"Time taken for model call: {t():.4f}s")
-            except tensorflow.python.framework.errors_impl.InvalidArgumentError:
-                raise _StopTaskException
-            birds_names_with_results_ordered = Classification.order_by_result_score(
-                    model_raw_output, bird_labels)
-
-            return [ Classification.get_top_n_result(i, birds_names_with_results_ordered)
-                    for i in range(1, self.args['nm_top_results'] + 1) ]
-        except ClassificationFatalException:
-            raise _StopTaskException
+                with self.inference_stats.busy(len(prepared)):
+                    classified = self.classify([ images[i] for i in prepared ], bird_model)
+                for i, result in zip(prepared, classified):
+                    if result is not None:
+                        results[i] = result
+            except Exception:
+                logging.exception("Unexpected error when handling batch of %d task(s)",
+                        len(prepared))
+        for i, j in copies.items():
+            results[i] = results[j]
+        if self.perceptual_answers is not None:
+            for i in prepared:
+                if results[i][0] is not None and hashes[i]:
+                    self.perceptual_answers.add(hashes[i], results[i])
+
+        return [ _BirdClassifierResponse(task.index, task.image, label_ids, scores)
+                for task, (label_ids, scores) in zip(tasks, results) ]
+
+    def _perceptual_unique(self, images, prepared, results):
+        """
+        Leave out of the indices of prepared images those that look the same as another image,
+        by their dHash: either one classified before, whose results are set in results, or one
+        earlier in the batch, which they are copies of. Flat images, whose hash is 0 whatever
+        their color, are always classified.
+
+        Returns:
+            prepared ([int]): The indices of the images left to classify
+            copies ({int: int}): The index of the image each copy is a copy of
+            hashes ({int: int}): The dHash of every image
+        """
+
+        unique = []
+        copies = {}
+        hashes = {}
+        for i in prepared:
+            key = hashes[i] = Classification.dhash(images[i])
+            if not key:
+                unique += [i]
+                continue
+            answer = self.perceptual_answers.find(key)
+            first = [ j for j in unique if hashes[j] and PerceptualIndex.distance(key,
+                hashes[j]) <= self.perceptual_answers.max_distance ]
+            if answer is not None:
+                results[i] = answer
+            elif first:
+                copies[i] = first[0]
+            else:
+                unique += [i]
+        self.nm_perceptual_duplicates += len(prepared) - len(unique)
+        return unique, copies, hashes
+
+    def log_stats(self):
+        """
+        Log the throughput of the stages run by this process and its peak memory use, and the
+        images found to look the same as another.
+        """
+
+        if self.nm_perceptual_duplicates:
+            logging.info("%d perceptual duplicate(s) saved", self.nm_perceptual_duplicates)
+
+        if self.args['time']:
+            for stats in [self.decode_stats, self.inference_stats]:
+                if stats.count:
+                    logging.debug("Throughput of %s", str(stats))
+            logging.debug("Peak RSS: %d KiB", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
 
 class _BirdClassifierMain(_BirdClassifier):
-    """Handle BirdClassifierTasks in the main process."""
+    """
+    Handle BirdClassifierTasks in the main process.
 
-    def __init__(self, tasks, args):
-        _BirdClassifier.__init__(self, args)
+    The images of a batch are decoded in a pool of decode_threads threads while the model runs
+    on the batches before it, at most decode_lookahead batches ahead, as OpenCV and TensorFlow
+    both release the GIL. The decode threads are stalled waiting for downloads or for the
+    model to catch up; the model is stalled waiting for decodes.
+    """
+
+    def __init__(self, tasks, args, cache=None, metrics=None):
+        _BirdClassifier.__init__(self, args, metrics)
         self.tasks = tasks
+        self.cache = cache
 
     def run(self):
+        """Yield the answers to the tasks as they complete, a batch at a time."""
+
         try:
-            bird_model, bird_labels = self.load(self.args)
+            bird_model = self.load(self.args)
         except _StopAllException:
-            return [ _BirdClassifierResponse(x, "fixme", None) for x in range(len(self.tasks)) ]
-
-        answers = []
-        for task in self.tasks:
-            answer = None
-            try:
-                answer = _BirdClassifierResponse(task.index, task.image,
-                        self.handle_task(task, bird_model, bird_labels))
-            except _StopTaskException:
-                logging.debug("Stopping task %s", str(task))
-                answer = _BirdClassifierResponse(task.index, task.image, None)
-            except Exception:
-                logging.exception("Unexpected error when handling task %s", str(task))
-                answer = _BirdClassifierResponse(task.index, task.image, None)
-            answers += [answer]
+            yield from ( _BirdClassifierResponse(x, "fixme") for x in range(len(self.tasks)) )
+            return
 
+        # Answers complete, not yielded yet; duplicates are answered while downloading.
+        answers = collections.deque()
+        batch = []
+        dedup = _deduplicator(self.args)
+        answer = lambda task: answers.extend(_with_duplicates(dedup, [_BirdClassifierResponse(
+            task.index, task.image, task.label_ids, task.scores)]))
+        tasks = ( task for task in self.tasks
+                if _is_unique(dedup, task, task.image, "URL", answer) )
+        downloader = ImageDownloader(self.args['nm_downloads'], self.cache, self.metrics)
+        # Batches as (tasks, futures of their images), oldest first.
+        decoding = collections.deque()
+        with Prefetcher(self.prepare, self.args['decode_threads'], self.decode_stats) as decoder:
+            for task, data in downloader.download(tasks):
+                while answers:
+                    yield answers.popleft()
+                if data is not None and not _is_unique(dedup, task,
+                        Deduplicator.content_key(data), "content", answer):
+                    continue
+                if data is None:
+                    answers += _with_duplicates(dedup, [_BirdClassifierResponse(task.index,
+                        task.image, task.label_ids, task.scores)])
+                    continue
+                task.data = data
+                batch += [task]
+                if len(batch) == self.args['batch_size']:
+                    decoding.append((batch, [ decoder.submit(x) for x in batch ]))
+                    batch = []
+                    while len(decoding) > self.args['decode_lookahead']:
+                        answers += _with_duplicates(dedup, self._handle_decoding(downloader,
+                            *decoding.popleft(), bird_model))
+            if batch:
+                decoding.append((batch, [ decoder.submit(x) for x in batch ]))
+            while decoding:
+                answers += _with_duplicates(dedup, self._handle_decoding(downloader,
+                    *decoding.popleft(), bird_model))
+                while answers:
+                    yield answers.popleft()
+
+        yield from answers
+
+        if dedup is not None:
+            logging.info("Deduplication: %s", str(dedup))
+        if self.args['time']:
+            logging.debug("Throughput of %s", str(downloader.stats))
+            logging.debug("Download retries: %d", downloader.nm_retries)
+        self.log_stats()
+
+    def _handle_decoding(self, downloader, tasks, images, bird_model):
+        with self.inference_stats.stalled():
+            images = [ image.result() for image in images ]
+        answers = self.respond(tasks, images, bird_model)
+        for task, answer in zip(tasks, answers):
+            downloader.store(task.cache_key, answer)
         return answers
 
 
-class _BirdClassifierWorker(multiprocessing.Process, _BirdClassifier):
-    """Worker process to handle BirdClassifierTasks in parallel."""
+class _BirdClassifierProcess(multiprocessing.Process, _BirdClassifier):
+    """
+    Process handling a stage of the BirdClassifierTasks.
 
-    def __init__(self, name, task_queue, result_queue, args):
+    Once done, the process puts its StageMetrics to the metrics queue, for the parent to merge.
+    With a profile_dir, it is profiled, and its profile saved there under the process name.
+    """
+
+    def __init__(self, name, metrics_queue, args):
         multiprocessing.Process.__init__(self)
         _BirdClassifier.__init__(self, args)
         self.name = name
+        self.metrics_queue = metrics_queue
+
+    def run(self):
+        multiprocessing.current_process().name = self.name
+        self._debug_log("Running")
+        if self.args['profile_dir']:
+            run_profiled(self.handle, self.args['profile_dir'], self.name)
+        else:
+            self.handle()
+        self.metrics_queue.put(self.metrics)
+
+    def handle(self):
+        """Handle tasks until told to stop."""
+        raise NotImplementedError
+
+    def _debug_log(self, msg, *args, **kwargs):
+        logging.debug("%s: " + msg, multiprocessing.current_process().name, *args, **kwargs)
+
+
+class _BirdClassifierWorker(_BirdClassifierProcess):
+    """
+    Worker process to decode and format the images of BirdClassifierTasks in parallel.
+
+    Tasks arrive in chunks. The tasks of a chunk whose images are formatted are passed on to the
+    _BirdClassifierServer together, and those whose image cannot be decoded are answered
+    together.
+    """
+
+    def __init__(self, name, task_queue, image_queue, result_queue, metrics_queue, args):
+        _BirdClassifierProcess.__init__(self, name, metrics_queue, args)
         self.task_queue = task_queue
+        self.image_queue = image_queue
         self.result_queue = result_queue
 
-    def _debug_log(self, msg, *args, **kwargs):
-        logging.debug("%s: %s", multiprocessing.current_process().name, msg, *args, **kwargs)
+    def handle(self):
+        while True:
+            with self.decode_stats.stalled():
+                chunk = self.task_queue.get()
+            if chunk is None:
+                self._debug_log("Exiting")
+                self.log_stats()
+                break
+            decoded = []
+            failed = []
+            for task in chunk:
+                self._debug_log("Got task %s", str(task))
+                with timec() as t:
+                    task.pixels = self.prepare(task)
+                task.decode_time = t()
+                task.data = None
+                if task.pixels is None:
+                    response = _BirdClassifierResponse(task.index, task.image, None)
+                    response.decode_time = task.decode_time
+                    failed += [response]
+                else:
+                    decoded += [task]
+            if failed:
+                self.result_queue.put(failed)
+            if decoded:
+                with self.decode_stats.stalled():
+                    self.image_queue.put(decoded)
+
+
+class _BirdClassifierServer(_BirdClassifierProcess):
+    """
+    Inference process to classify the images formatted by the _BirdClassifierWorkers.
 
-    def _answer(self, answer):
-        self.task_queue.task_done()
-        self.result_queue.put(answer)
+    This is the only process that loads the model, so that the memory and startup
+    time they take is paid once instead of once per worker. Images are classified in batches of
+    at most batch_size, and the responses to the chunks taken at a time are put together.
+    """
 
-    def run(self):
-        multiprocessing.current_process().name = self.name
-        self._debug_log("Running")
+    def __init__(self, name, image_queue, result_queue, metrics_queue, args):
+        _BirdClassifierProcess.__init__(self, name, metrics_queue, args)
+        self.image_queue = image_queue
+        self.result_queue = result_queue
 
-        # Note: This should be shared memory resources between the processes.
-        # multiprocessing.shared_memory, introduced in Python3.8, could potentially be used here.
+    def handle(self):
+        # Without a model, keep answering so that no task is left without a response.
         try:
-            bird_model, bird_labels = self.load(self.args)
+            bird_model = self.load(self.args)
         except _StopAllException:
-            return
+            bird_model = None
 
+        batch_size = self.args['batch_size']
         while True:
-            task = None
-            response = None
-            try:
-                task = self.task_queue.get()
-                if task is None:
-                    self._debug_log("Exiting")
-                    self.task_queue.task_done()
-                    break
-                self._debug_log("Got task %s", str(task))
-                response = _BirdClassifierResponse(task.index, task.image,
-                        self.handle_task(task, bird_model, bird_labels))
-                self._answer(response)
-            except _StopTaskException:
-                self._debug_log("Stopping task %s", str(task))
-                response = _BirdClassifierResponse(task.index, task.image, None)
-                self._answer(response)
-            except Exception:
-                logging.exception("Unexpected error when handling task %s", str(task))
-                response = _BirdClassifierResponse(task.index, task.image, None)
-                self._answer(response)
+            with self.inference_stats.stalled():
+                chunks = get_batch(self.image_queue, batch_size, self.args['max_batch_wait_ms'],
+                        item_size=len)
+            stop = chunks[-1] is None
+            if stop:
+                chunks.pop()
+            tasks = [ task for chunk in chunks for task in chunk ]
+            responses = []
+            for i in range(0, len(tasks), batch_size):
+                batch = tasks[i:i + batch_size]
+                self._debug_log("Got batch of %d task(s): %s", len(batch),
+                        ", ".join(str(task) for task in batch))
+                if bird_model is None:
+                    images = [None] * len(batch)
+                else:
+                    images = [ task.pixels for task in batch ]
+                with timec() as t:
+                    batch_responses = self.respond(batch, images, bird_model)
+                for task, response in zip(batch, batch_responses):
+                    response.decode_time = task.decode_time
+                    response.inference_time = t() / len(batch)
+                responses += batch_responses
+            if responses:
+                self.result_queue.put(responses)
+            if stop:
+                self._debug_log("Exiting")
+                self.log_stats()
+                break
 
 
 class _BirdClassifierTask:
     """Bird classification task definition."""
 
-    def __init__(self, index, image):
+    def __init__(self, index, image, data=None):
         self.index = index
         self.image = image
+        self.data = data
+        self.pixels = None
+        self.label_ids = None
+        self.scores = None
+        self.cache_key = None
+        self.decode_time = None
 
     def __str__(self):
         return "({}, {})".format(self.index, self.image)
@@ -162,83 +460,556 @@ class _BirdClassifierResponse:
     """
     Bird classification answer.
 
-    This has the format (index, [top n results]) where the latter will be None when a
-    classification could not be fetched.
+    The top n results are kept as label ids and float32 scores, highest score first, or as None
+    when a classification could not be fetched. Label names are only looked up when the answer
+    is written out. The time taken to decode and to classify the image are kept for the
+    PoolScheduler, when known.
+
+    Answers are passed between processes by the million, so they are kept small: slots instead
+    of a dict, and the arrays pickled as raw bytes.
     """
 
-    def __init__(self, index, image, classifications):
+    __slots__ = ('index', 'image', 'label_ids', 'scores', 'decode_time', 'inference_time')
+
+    def __init__(self, index, image, label_ids=None, scores=None):
         self.index = index
         self.image = image
-        self.classifications = classifications
+        self.label_ids = label_ids
+        self.scores = scores
+        self.decode_time = None
+        self.inference_time = None
+
+    def __getstate__(self):
+        classified = self.label_ids is not None
+        return (self.index, self.image, self.label_ids.tobytes() if classified else None,
+                self.scores.tobytes() if classified else None, self.decode_time,
+                self.inference_time)
+
+    def __setstate__(self, state):
+        self.index, self.image, label_ids, scores, self.decode_time, self.inference_time = state
+        self.label_ids = None if label_ids is None else np.frombuffer(label_ids, np.int32)
+        self.scores = None if scores is None else np.frombuffer(scores, np.float32)
+
+    def classifications(self, labels):
+        """Get the results as ClassificationResults named by labels, or None."""
+
+        if self.label_ids is None:
+            return None
+        return [ ClassificationResult(labels[label_id], score)
+                for label_id, score in zip(self.label_ids.tolist(), self.scores.tolist()) ]
 
     def __str__(self):
-        classifications = None
-        if not self.classifications:
-            classifications = [str(self.classifications)]
+        results = None
+        if self.label_ids is None or not len(self.label_ids):
+            results = ["None" if self.label_ids is None else "[]"]
         else:
-            classifications = [ str(x) for x in self.classifications ]
-        return "{}\n    {}".format(self.image, "\n    ".join(classifications))
+            results = [ "({}, {})".format(label_id, score)
+                    for label_id, score in zip(self.label_ids.tolist(), self.scores.tolist()) ]
+        return "{}\n    {}".format(self.image, "\n    ".join(results))
 
     def __lt__(self, other):
         return self.index < other.index
 
 
-def _classify_birds_main(image_urls, args):
+class BirdClassifierResults:
+    """
+    Answers to a list of image URLs, kept column-wise in the order of the URLs.
+
+    Instead of an object per answer, the label ids and scores of the top n results of all
+    answers are kept in two (nm_images, n) arrays, with the number of results of each answer in
+    a third; -1 for images that could not be classified. Answers are put in place by their index
+    as they arrive, so they need no sorting. Iterating gives _BirdClassifierResponses viewing
+    the arrays.
+    """
+
+    def __init__(self, image_urls, nm_top_results):
+        self.images = image_urls
+        self.label_ids = np.zeros((len(image_urls), nm_top_results), dtype=np.int32)
+        self.scores = np.zeros((len(image_urls), nm_top_results), dtype=np.float32)
+        self.nm_results = np.full(len(image_urls), -1, dtype=np.int16)
+
+    def add(self, response):
+        """Put the results of a response in place."""
+
+        if response.label_ids is not None:
+            k = len(response.label_ids)
+            self.label_ids[response.index, :k] = response.label_ids
+            self.scores[response.index, :k] = response.scores
+            self.nm_results[response.index] = k
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        k = int(self.nm_results[index])
+        if k < 0:
+            return _BirdClassifierResponse(index, self.images[index])
+        return _BirdClassifierResponse(index, self.images[index], self.label_ids[index, :k],
+                self.scores[index, :k])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def _deduplicator(args):
+    return Deduplicator(args['dedup_max_entries']) if args['dedup'] else None
+
+
+def _is_unique(dedup, task, key, kind, answer):
+    """
+    Check whether a task is the first with a key identifying its image. A duplicate whose answer
+    is known already is passed to answer(task), which must pass its response through
+    _with_duplicates() like any other; the other duplicates are answered there.
+    """
+
+    if dedup is None:
+        return True
+    status = dedup.add(task, key, kind)
+    if status == Deduplicator.ANSWERED:
+        task.data = None
+        answer(task)
+    return status == Deduplicator.NEW
+
+
+def _with_duplicates(dedup, responses):
+    """Add the responses to the duplicates waiting for a list of responses."""
+
+    if dedup is None:
+        return responses
+    return responses + [ _BirdClassifierResponse(task.index, task.image, task.label_ids,
+        task.scores) for response in responses for task in dedup.answer(response) ]
+
+
+def _classify_birds_main(image_urls, args, cache, metrics):
     tasks = [ _BirdClassifierTask(i, image) for i, image in enumerate(image_urls) ]
-    return _BirdClassifierMain(tasks, args).run()
+    return _BirdClassifierMain(tasks, args, cache, metrics).run()
 
 
-def _classify_birds_multiprocessing(image_urls, nm_tasks, args):
-    tasks = multiprocessing.JoinableQueue()
-    responses = multiprocessing.Queue()
+class _BirdClassifierFeeder(threading.Thread):
+    """
+    Thread feeding BirdClassifierTasks to the worker processes.
+
+    Image URLs are read lazily, and a new one is only taken once there is room for it among the
+    max_in_flight tasks allowed to be in flight. Downloads run in a thread pool and feed the
+    workers through the bounded task queue, so that the workers never wait on the network while
+    there is work to be done.
+
+    Downloaded tasks are put to the task queue in chunks, sized by the PoolScheduler, so that
+    the cost of passing tasks between processes is paid per chunk rather than per task. A chunk
+    waits at most max_batch_wait_ms to fill up. Tasks that need no worker, because their
+    download failed or their classifications were cached, are answered directly, in chunks as
+    well.
+
+    With dedup, an image URL seen before is not downloaded again, and an image whose bytes were
+    downloaded before is not classified again; the task is answered with the answer to the
+    first task with that image, when it comes.
+    """
+
+    def __init__(self, image_urls, task_queue, result_queue, in_flight, args, cache, scheduler,
+            metrics, nm_tasks=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.image_urls = image_urls
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.in_flight = in_flight
+        self.args = args
+        self.scheduler = scheduler
+        self.downloader = ImageDownloader(args['nm_downloads'], cache, metrics)
+        self.dedup = _deduplicator(args)
+        self.downloaded = queue.Queue()
+        self.cache_keys = {}
+        self.nm_expected_tasks = nm_tasks
+        self.nm_tasks = None
+
+    def _tasks(self):
+        nm_tasks = 0
+        try:
+            for i, image in enumerate(self.image_urls):
+                self.in_flight.acquire()
+                nm_tasks += 1
+                task = _BirdClassifierTask(i, image)
+                if _is_unique(self.dedup, task, image, "URL", self.downloaded.put):
+                    yield task
+        finally:
+            self.nm_tasks = nm_tasks
+
+    def _feed(self, task, data):
+        if data is not None and not _is_unique(self.dedup, task, Deduplicator.content_key(data),
+                "content", self.downloaded.put):
+            return
+        task.data = data
+        self.downloaded.put(task)
+
+    def _download(self):
+        try:
+            self.downloader.download_to(self._tasks(), self._feed)
+        except Exception:
+            logging.exception("Unexpected error when reading image URLs")
+        self.downloaded.put(None)
+
+    def run(self):
+        threading.Thread(target=self._download, daemon=True).start()
+        nm_handed_out = 0
+        while True:
+            nm_tasks = self.nm_tasks if self.nm_tasks is not None else self.nm_expected_tasks
+            chunk = get_batch(self.downloaded, self.scheduler.chunk_size(
+                None if nm_tasks is None else nm_tasks - nm_handed_out),
+                self.args['max_batch_wait_ms'])
+            stop = chunk[-1] is None
+            if stop:
+                chunk.pop()
+            nm_handed_out += len(chunk)
+            answered = [ _BirdClassifierResponse(task.index, task.image, task.label_ids,
+                task.scores) for task in chunk if task.data is None ]
+            if answered:
+                self.result_queue.put(answered)
+            chunk = [ task for task in chunk if task.data is not None ]
+            for task in chunk:
+                if task.cache_key is not None:
+                    self.cache_keys[task.index] = task.cache_key
+            if chunk:
+                with self.downloader.stats.stalled():
+                    self.task_queue.put(chunk)
+            if stop:
+                break
+        logging.debug("All tasks put to queue")
+        if self.dedup is not None:
+            logging.info("Deduplication: %s", str(self.dedup))
+        if self.args['time']:
+            logging.debug("Throughput of %s", str(self.downloader.stats))
+            logging.debug("Download retries: %d", self.downloader.nm_retries)
+        # Tell the reader of the result queue that self.nm_tasks is final.
+        self.result_queue.put(None)
+
+
+class _BirdClassifierPool:
+    """
+    Pool of _BirdClassifierWorkers sharing a task queue, resized as the PoolScheduler says.
+
+    A worker is retired by queueing a None task, on which the first worker to take it exits.
+    Every worker puts its StageMetrics to the metrics queue as it exits.
+    """
+
+    def __init__(self, task_queue, image_queue, result_queue, metrics_queue, args):
+        self.task_queue = task_queue
+        self.image_queue = image_queue
+        self.result_queue = result_queue
+        self.metrics_queue = metrics_queue
+        self.args = args
+        self.workers = []
+        self.nm_active = 0
+
+    def resize(self, nm_workers):
+        while self.nm_active < nm_workers:
+            worker = _BirdClassifierWorker("BirdClassifierWorker-{}".format(len(self.workers)),
+                    self.task_queue, self.image_queue, self.result_queue, self.metrics_queue,
+                    self.args)
+            worker.start()
+            self.workers += [worker]
+            self.nm_active += 1
+        while self.nm_active > nm_workers:
+            try:
+                self.task_queue.put_nowait(None)
+            except queue.Full:
+                # The workers are busy; the next resize tries again.
+                break
+            self.nm_active -= 1
 
-    for i, image in enumerate(image_urls):
-        tasks.put(_BirdClassifierTask(i, image))
-    logging.debug("All tasks put to queue")
-
-    nm_workers = min(nm_tasks, multiprocessing.cpu_count())
-    for i in range(nm_workers):
-        tasks.put(None)
-    logging.debug("Creating {} worker(s)".format(nm_workers))
-    workers = [
-            _BirdClassifierWorker("BirdClassifierWorker-{}".format(i), tasks, responses, args)
-            for i in range(nm_workers) ]
-    for worker in workers:
-        worker.start()
+    def stop(self):
+        """Tell all workers to exit once the tasks queued are handled."""
+        for _ in range(self.nm_active):
+            self.task_queue.put(None)
+        self.nm_active = 0
+
+    def join(self):
+        self.stop()
+        for worker in self.workers:
+            worker.join()
+
+    def terminate(self):
+        for worker in self.workers:
+            worker.terminate()
+
+
+# Processes put their metrics as they exit, once all responses are in.
+_METRICS_TIMEOUT = 10
+
+
+def _merge_metrics(metrics, metrics_queue, nm_processes):
+    """Merge the StageMetrics put to the metrics queue by nm_processes exiting processes."""
+
+    for _ in range(nm_processes):
+        try:
+            metrics.merge(metrics_queue.get(timeout=_METRICS_TIMEOUT))
+        except queue.Empty:
+            logging.warning("Stage metrics missing from a process - they are left out")
+            break
+
+
+def _classify_birds_multiprocessing(image_urls, args, cache, ordered, metrics, nm_tasks=None):
+    # The queues hold chunks of tasks; bound them by the tasks the chunks can hold.
+    queue_size = max(1, args['task_queue_size'] // args['max_chunk_size'])
+    tasks = multiprocessing.Queue(queue_size)
+    images = multiprocessing.Queue(queue_size)
+    responses = multiprocessing.Queue()
+    metrics_queue = multiprocessing.Queue()
+
+    scheduler = PoolScheduler(args, nm_tasks)
+    logging.info("Pool: %s", str(scheduler))
+    server = _BirdClassifierServer("BirdClassifierServer", images, responses, metrics_queue,
+            scheduler.server_args())
+    server.start()
+    pool = _BirdClassifierPool(tasks, images, responses, metrics_queue, args)
+    pool.resize(scheduler.nm_workers)
     logging.debug("All worker(s) started")
 
-    tasks.join()
+    in_flight = threading.BoundedSemaphore(args['max_in_flight'])
+    feeder = _BirdClassifierFeeder(image_urls, tasks, responses, in_flight, args, cache,
+            scheduler, metrics, nm_tasks)
+    feeder.start()
+
+    try:
+        # Responses that arrive ahead of their turn wait in the reorder buffer. Their tasks are
+        # still counted as in flight, which bounds the size of the buffer.
+        reorder_buffer = {}
+        next_index = 0
+        nm_responses = 0
+        nm_tasks = None
+        while nm_tasks is None or nm_responses < nm_tasks:
+            chunk = responses.get()
+            if chunk is None:
+                nm_tasks = feeder.nm_tasks
+                continue
+            chunk = _with_duplicates(feeder.dedup, chunk)
+            for resp in chunk:
+                logging.debug("Got response: %s", str(resp))
+                feeder.downloader.store(feeder.cache_keys.pop(resp.index, None), resp)
+                nm_responses += 1
+                scheduler.observe(resp)
+                if not ordered:
+                    in_flight.release()
+                    yield resp
+                    continue
+                reorder_buffer[resp.index] = resp
+                while next_index in reorder_buffer:
+                    in_flight.release()
+                    yield reorder_buffer.pop(next_index)
+                    next_index += 1
+            pool.resize(scheduler.resize(pool.nm_active))
+    except GeneratorExit:
+        pool.terminate()
+        server.terminate()
+        # With the processes reading them gone, the queues may never be flushed; do not wait on
+        # them at exit.
+        for x in [tasks, images, responses, metrics_queue]:
+            x.cancel_join_thread()
+        raise
+
+    # The metrics are taken before joining, so that no process waits to flush them at exit.
+    pool.stop()
+    images.put(None)
+    _merge_metrics(metrics, metrics_queue, len(pool.workers) + 1)
+    pool.join()
+    server.join()
+
+
+def _signature(args):
+    """Get a signature of how answers are computed, which differs for other models or settings."""
+
+    # Results are stored as (label id, score) pairs; "ids" tells them from the label names
+    # stored before.
+    signature = "|".join(["ids"] + [ str(args[x]) for x in ['url_model', 'url_labels',
+        'nm_top_results', 'score_softmax', 'score_threshold'] ])
+    # TFLite models score a little differently; results of the TensorFlow model are kept.
+    if args['backend'] == 'tflite':
+        signature += "|tflite " + args['tflite_quantization']
+    return signature
+
+
+def _open_cache(args):
+    if not args['cache_path']:
+        return None
+    return ResultCache(args['cache_path'], _signature(args), args['cache_max_size_mb'] * 1024**2,
+            args['cache_ttl'])
+
+
+def _close_cache(cache, args):
+    if cache is not None:
+        if args['time']:
+            logging.debug("Result cache: %s", str(cache))
+        cache.close()
+
+
+def open_journal(path, args, resume=False):
+    """
+    Open a Journal at path for the answers of a run, resuming the journal there with resume.
+    Raises JournalException when that journal was written with other settings.
+    """
+
+    return Journal(path, _signature(args), resume, args['journal_sync_ms'])
+
 
-    results = []
-    while nm_tasks:
-        resp = responses.get()
-        logging.debug("Got response: %s", str(resp))
-        results += [resp]
-        nm_tasks -= 1
+def _journaled(journal, answer):
+    """Write an answer to the journal, if there is one and the image could be classified."""
 
-    return sorted(results)
+    if journal is not None and answer.label_ids is not None:
+        journal.write(answer.image, answer.label_ids, answer.scores)
 
 
-def classify_birds(image_urls, config, args):
+def _resumed_stream(image_urls, journal, ordered, classify):
+    """
+    Answer the image URLs answered in a journal from it, and the others with classify(), a
+    generator of answers like _classify_birds_multiprocessing(), journaling their answers.
+
+    Image URLs are read lazily by classify(). The answers from the journal are merged in as the
+    URLs are read: in their place when ordered, else as soon as they are found.
+    """
+
+    # The answers from the journal not yielded yet and, when ordered, None in the place of
+    # every other image URL.
+    found = collections.deque()
+    # The index of each image URL passed to classify() and not answered yet, by its index
+    # there, so that only the URLs in flight are kept.
+    indices = {}
+
+    def new_urls():
+        new_indices = itertools.count()
+        for index, image in enumerate(image_urls):
+            answer = journal.find(image)
+            if answer is not None:
+                found.append(_BirdClassifierResponse(index, image, *answer))
+                continue
+            if ordered:
+                found.append(None)
+            indices[next(new_indices)] = index
+            yield image
+
+    with contextlib.closing(classify(new_urls())) as answers:
+        for answer in answers:
+            answer.index = indices.pop(answer.index)
+            _journaled(journal, answer)
+            # The URLs up to that of the answer have been read.
+            while found and found[0] is not None:
+                yield found.popleft()
+            if ordered:
+                found.popleft()
+            yield answer
+    yield from found
+
+
+def load_labels(args):
+    """Load the labels of the arguments, through the labels cache next to the TF Hub cache."""
+
+    return Classification.load_labels(args['url_labels'], Classification.labels_path(
+        args['url_labels'], args['tfhub_cache_dir']), args['labels_ttl'])
+
+
+def warmup(args):
+    """
+    Export the model for a fast startup, then check that the exported model loads and runs.
+
+    Returns:
+        model_format (str): The format the model was exported in
+    """
+
+    model_format = Classification.export_model(args['url_model'], args['model_dir'])
+    if args['backend'] == 'tflite':
+        # Converted again, from the model just exported.
+        Classification.convert_tflite(args['url_model'], args['model_dir'],
+                Classification.tflite_path(args['url_model'], args['tflite_quantization'],
+                    args['tfhub_cache_dir']), args['tflite_quantization'])
+        model_format += " and tflite " + args['tflite_quantization']
+    classifier = _BirdClassifier(args)
+    try:
+        bird_model = classifier.load(args)
+    except _StopAllException:
+        raise ClassificationFatalException("Failed to load exported model")
+    classifier.call_model([np.zeros((224, 224, 3), dtype=np.uint8)], bird_model)
+    return model_format
+
+
+def classify_birds(image_urls, config, args, metrics=None, journal=None):
     """
     Classify birds from a list of image URLs.
 
     Parameters:
         image_urls ([str]): A list of image URLs
         config (ConfigParser): A ConfigParser containing application configuration values
+        metrics (StageMetrics): Where to time the stages of all processes, when given
+        journal (Journal): Where to journal the answers as they complete, when given; image
+                           URLs answered there already are not classified again
 
     Returns:
-        answers ([BirdClassifierResponse]): A list of answers in the order the image URLs
-                                            arrived
+        answers (BirdClassifierResults): The answers, in the order the image URLs arrived
     """
 
+    metrics = metrics if metrics is not None else StageMetrics()
+    results = BirdClassifierResults(image_urls, args['nm_top_results'])
+    # With a journal, the index of each image URL to classify by its index among them, until
+    # it is answered.
+    indices = {}
+    if journal is not None:
+        for index, image in enumerate(image_urls):
+            answer = journal.find(image)
+            if answer is None:
+                indices[len(indices)] = index
+            else:
+                results.add(_BirdClassifierResponse(index, image, *answer))
+        image_urls = [ image_urls[index] for index in indices.values() ]
     nm_tasks = len(image_urls)
 
-    if nm_tasks < args['multiprocessing_threshold']:
+    cache = _open_cache(args)
+    if not nm_tasks:
+        # All answered by the journal; the model is not even loaded.
+        answers = []
+    elif nm_tasks < args['multiprocessing_threshold']:
         logging.debug("nm_tasks=%d < multiprocessing_threshold=%d - running in main process",
                 nm_tasks, args['multiprocessing_threshold'])
-        return _classify_birds_main(image_urls, args)
+        answers = _classify_birds_main(image_urls, args, cache, metrics)
     else:
         logging.debug("nm_tasks=%d >= multiprocessing_threshold=%d - starting worker processes",
                 nm_tasks, args['multiprocessing_threshold'])
-        return _classify_birds_multiprocessing(image_urls, nm_tasks, args)
+        answers = _classify_birds_multiprocessing(image_urls, args, cache, False, metrics,
+                nm_tasks)
+    for answer in answers:
+        if journal is not None:
+            answer.index = indices.pop(answer.index)
+        _journaled(journal, answer)
+        results.add(answer)
+    _close_cache(cache, args)
+    return results
+
+
+def classify_birds_stream(image_urls, config, args, ordered=True, metrics=None, journal=None):
+    """
+    Classify birds from an iterable of image URLs, yielding answers as they complete.
+
+    Image URLs are read lazily and at most max_in_flight of them are handled at a time, so that
+    memory use does not grow with the number of image URLs.
+
+    Parameters:
+        image_urls (iterable): Image URLs
+        config (ConfigParser): A ConfigParser containing application configuration values
+        ordered (bool): Yield the answers in the order the image URLs arrived, rather than in
+                        the order they complete
+        metrics (StageMetrics): Where to time the stages of all processes, when given; the
+                                workers' are merged in once all answers are yielded
+        journal (Journal): Where to journal the answers as they complete, when given; image
+                           URLs answered there already are answered from there
+
+    Yields:
+        answer (BirdClassifierResponse): An answer per image URL
+    """
+
+    metrics = metrics if metrics is not None else StageMetrics()
+    cache = _open_cache(args)
+    classify = lambda urls: _classify_birds_multiprocessing(urls, args, cache, ordered, metrics)
+    try:
+        if journal is None:
+            yield from classify(image_urls)
+        else:
+            yield from _resumed_stream(image_urls, journal, ordered, classify)
+    finally:
+        _close_cache(cache, args)
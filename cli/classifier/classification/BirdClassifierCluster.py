@@ -0,0 +1,398 @@
+"""Classify birds on several machines: a coordinator hands chunks of image URLs out to workers."""
+
+
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import multiprocessing.util
+import os
+import queue
+import socket
+import threading
+import time
+import numpy as np
+
+from classification.BirdClassifier import (_BirdClassifierResponse, _resumed_stream, _signature,
+        classify_birds_stream)
+
+
+class BirdClassifierClusterException(Exception):
+    """Exception signifying that a worker could not join a coordinator."""
+
+
+# Messages are lines of JSON, over TCP. A worker says {"hello": PROTOCOL_VERSION, "signature":
+# ...}, and is answered {"welcome": true}, or {"error": ...} when its model or settings differ.
+# The coordinator then sends it {"chunk": id, "urls": [...]}, and the worker answers every URL
+# of a chunk with {"chunk": id, "offset": ..., "label_ids": [...], "scores": [...]}, the label
+# ids null when the image could not be classified. Workers send {"heartbeat": true} every
+# heartbeat_s. Once every image is answered, the coordinator sends {"done": true}.
+PROTOCOL_VERSION = 1
+
+# How long a worker waits between attempts to connect to a coordinator not listening yet.
+_CONNECT_RETRY_S = 1
+
+
+def _line(message):
+    return json.dumps(message, separators=(',', ':')) + "\n"
+
+
+class _BirdClassifierChunk:
+    """Image URLs handed out to a worker at once, with the index of each among all image URLs."""
+
+    __slots__ = ('id', 'indices', 'urls', 'answered', 'nm_left', 'worker')
+
+    def __init__(self, chunk_id, indices, urls):
+        self.id = chunk_id
+        self.indices = indices
+        self.urls = urls
+        self.answered = [False] * len(urls)
+        self.nm_left = len(urls)
+        self.worker = None
+
+
+class _BirdClassifierRemoteWorker:
+    """A worker connected to the coordinator, and the chunks it holds."""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.name = "{}:{}".format(*address[:2])
+        self.reader = sock.makefile('r', encoding='utf-8')
+        self.writer = sock.makefile('w', encoding='utf-8')
+        self.chunks = set()
+        self.nm_answered = 0
+
+    def send(self, message):
+        self.writer.write(_line(message))
+        self.writer.flush()
+
+    def close(self):
+        # Shut down first, so that its reader thread wakes up.
+        with contextlib.suppress(OSError):
+            self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+
+class _BirdClassifierCoordinator:
+    """
+    Coordinator handing the image URLs out to workers, in chunks, and gathering their answers.
+
+    Workers connect to it over TCP and are handed up to chunks_per_worker chunks of chunk_size
+    image URLs at a time; a worker is handed a new chunk as soon as it has answered every URL
+    of one, so that it pulls work at its own pace. The chunks held by a worker that disconnects,
+    or sends nothing for worker_timeout_s, are handed out again, but for the URLs it answered.
+
+    Image URLs are read lazily, at most max_in_flight of them per worker ahead of the answers
+    yielded. A thread per worker reads its messages; everything else runs in the thread
+    iterating over classify(), so that the state needs no lock.
+    """
+
+    def __init__(self, args, host, port):
+        self.args = args
+        self.signature = _signature(args)
+        self.server = socket.create_server((host, port))
+        self.events = queue.Queue()
+        # The workers that said hello, in the order they did.
+        self.workers = {}
+        self.chunks = {}
+        # Chunks to hand out before reading more image URLs: those of lost workers.
+        self.pending = collections.deque()
+        self.chunk_ids = itertools.count()
+
+    @property
+    def address(self):
+        """The (host, port) the coordinator listens on."""
+        return self.server.getsockname()[:2]
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.server.accept()
+            except OSError:
+                break
+            sock.settimeout(self.args['cluster_worker_timeout_s'])
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            worker = _BirdClassifierRemoteWorker(sock, address)
+            threading.Thread(target=self._read, args=(worker,), daemon=True).start()
+
+    def _read(self, worker):
+        try:
+            for line in worker.reader:
+                self.events.put((worker, json.loads(line)))
+        except (OSError, ValueError) as e:
+            logging.debug("Lost worker %s: %s", worker.name, e)
+        self.events.put((worker, None))
+
+    def _read_chunk(self):
+        """Read the next chunk of image URLs, or get None when there are none left to read."""
+
+        if self.exhausted or self.nm_read - self.nm_yielded >= \
+                self.args['max_in_flight'] * max(1, len(self.workers)):
+            return None
+        urls = list(itertools.islice(self.image_urls, self.args['cluster_chunk_size']))
+        self.exhausted = len(urls) < self.args['cluster_chunk_size']
+        if not urls:
+            return None
+        self.nm_read += len(urls)
+        return self._chunk(list(range(self.nm_read - len(urls), self.nm_read)), urls)
+
+    def _chunk(self, indices, urls):
+        chunk = _BirdClassifierChunk(next(self.chunk_ids), indices, urls)
+        self.chunks[chunk.id] = chunk
+        return chunk
+
+    def _dispatch(self):
+        """Hand chunks out to the workers with room for them."""
+
+        for worker in list(self.workers):
+            while worker in self.workers and \
+                    len(worker.chunks) < self.args['cluster_chunks_per_worker']:
+                chunk = self.pending.popleft() if self.pending else self._read_chunk()
+                if chunk is None:
+                    return
+                chunk.worker = worker
+                worker.chunks.add(chunk)
+                try:
+                    worker.send({'chunk': chunk.id, 'urls': chunk.urls})
+                except OSError:
+                    self._lost(worker)
+
+    def _lost(self, worker):
+        """Drop a worker, and hand the URLs of its chunks it did not answer out again."""
+
+        worker.close()
+        # Lost once only, though both a failed send and its reader thread may tell.
+        if worker not in self.workers:
+            return
+        del self.workers[worker]
+        reissued = []
+        for chunk in sorted(worker.chunks, key=lambda x: x.indices[0]):
+            del self.chunks[chunk.id]
+            left = [ k for k in range(len(chunk.urls)) if not chunk.answered[k] ]
+            reissued += [self._chunk([ chunk.indices[k] for k in left ],
+                [ chunk.urls[k] for k in left ])]
+        worker.chunks.clear()
+        # Ahead of the other pending chunks, the earliest first, for ordered answers.
+        self.pending.extendleft(reversed(reissued))
+        logging.warning("Worker %s lost, handing %d image URL(s) of %d chunk(s) out again",
+                worker.name, sum(len(x.urls) for x in reissued), len(reissued))
+
+    def _hello(self, worker, message):
+        if message.get('hello') != PROTOCOL_VERSION or message.get('signature') != self.signature:
+            logging.warning("Rejected worker %s: other protocol, model or settings", worker.name)
+            with contextlib.suppress(OSError):
+                worker.send({'error': "The coordinator runs another protocol version, model or "
+                    "settings: {}".format(self.signature)})
+            worker.close()
+            return
+        worker.send({'welcome': True})
+        self.workers[worker] = None
+        logging.info("Worker %s joined", worker.name)
+
+    def _answer(self, worker, message):
+        chunk = self.chunks.get(message['chunk'])
+        # Answers of chunks handed out again since are dropped.
+        if chunk is None or chunk.worker is not worker:
+            return
+        offset = message['offset']
+        if chunk.answered[offset]:
+            return
+        chunk.answered[offset] = True
+        chunk.nm_left -= 1
+        worker.nm_answered += 1
+        label_ids = message['label_ids']
+        if label_ids is None:
+            answer = _BirdClassifierResponse(chunk.indices[offset], chunk.urls[offset])
+        else:
+            answer = _BirdClassifierResponse(chunk.indices[offset], chunk.urls[offset],
+                    np.array(label_ids, dtype=np.int32),
+                    np.array(message['scores'], dtype=np.float32))
+        if self.ordered:
+            self.answers[answer.index] = answer
+        else:
+            self.answers.append(answer)
+        if not chunk.nm_left:
+            del self.chunks[chunk.id]
+            worker.chunks.discard(chunk)
+
+    def _handle(self, worker, message):
+        if message is None:
+            self._lost(worker)
+            return
+        try:
+            if 'hello' in message:
+                self._hello(worker, message)
+            elif 'chunk' in message:
+                self._answer(worker, message)
+        except (OSError, KeyError, IndexError, TypeError, ValueError) as e:
+            logging.warning("Dropping worker %s, which sent %.200s: %s", worker.name,
+                    str(message), e)
+            self._lost(worker)
+
+    def _ready(self):
+        """Yield the answers ready to be yielded."""
+
+        if self.ordered:
+            while self.nm_yielded in self.answers:
+                self.nm_yielded += 1
+                yield self.answers.pop(self.nm_yielded - 1)
+        else:
+            while self.answers:
+                self.nm_yielded += 1
+                yield self.answers.popleft()
+
+    def _close(self):
+        with contextlib.suppress(OSError):
+            self.server.shutdown(socket.SHUT_RDWR)
+        self.server.close()
+        for worker in self.workers:
+            with contextlib.suppress(OSError):
+                worker.send({'done': True})
+            worker.close()
+            logging.info("Worker %s answered %d image(s)", worker.name, worker.nm_answered)
+
+    def classify(self, image_urls, ordered=True):
+        """
+        Get the answers of the workers to image URLs, as they come. The coordinator can classify
+        once, and stops listening when done.
+
+        Parameters:
+            image_urls (iterable): Image URLs
+            ordered (bool): Yield the answers in the order the image URLs arrived, rather than
+                            in the order they come
+
+        Yields:
+            answer (BirdClassifierResponse): An answer per image URL
+        """
+
+        self.image_urls = iter(image_urls)
+        self.exhausted = False
+        self.nm_read = 0
+        self.nm_yielded = 0
+        self.ordered = ordered
+        # The answers not yielded yet: by index when ordered.
+        self.answers = {} if ordered else collections.deque()
+        threading.Thread(target=self._accept, daemon=True).start()
+        logging.info("Waiting for workers on %s:%d", *self.address)
+        try:
+            # Read ahead, so that no worker is waited for when there are no image URLs.
+            chunk = self._read_chunk()
+            if chunk is not None:
+                self.pending.append(chunk)
+            while True:
+                self._dispatch()
+                yield from self._ready()
+                if self.exhausted and self.nm_yielded == self.nm_read:
+                    break
+                self._handle(*self.events.get())
+        finally:
+            self._close()
+
+
+def classify_birds_distributed(image_urls, args, host, port, ordered=True, journal=None):
+    """
+    Classify birds from an iterable of image URLs on the workers connecting to host:port,
+    yielding the answers as they come.
+
+    Parameters:
+        image_urls (iterable): Image URLs
+        host (str), port (int): The address to listen on for workers
+        ordered (bool): Yield the answers in the order the image URLs arrived, rather than in
+                        the order they come
+        journal (Journal): Where to journal the answers as they come, when given; image URLs
+                           answered there already are answered from there
+
+    Yields:
+        answer (BirdClassifierResponse): An answer per image URL
+    """
+
+    coordinator = _BirdClassifierCoordinator(args, host, port)
+    if journal is None:
+        yield from coordinator.classify(image_urls, ordered)
+    else:
+        yield from _resumed_stream(image_urls, journal, ordered,
+                lambda urls: coordinator.classify(urls, ordered))
+
+
+def _connect(host, port, timeout):
+    """Connect to a coordinator, waiting up to timeout seconds for it to listen."""
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection((host, port))
+        except OSError as e:
+            if time.monotonic() >= deadline:
+                raise BirdClassifierClusterException("Failed to connect to the coordinator at "
+                        "{}:{}: {}".format(host, port, e))
+            time.sleep(_CONNECT_RETRY_S)
+
+
+def run_worker(args, host, port, metrics=None):
+    """
+    Classify the image URLs handed out by the coordinator at host:port until it is done, with
+    the worker processes of classify_birds_stream(), the model loaded once for all chunks.
+
+    Returns:
+        nm_answered (int): The number of image URLs answered
+    """
+
+    sock = _connect(host, port, args['cluster_worker_timeout_s'])
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Closed in the processes forked to classify, so that the coordinator sees the connection
+    # close as soon as this process dies. Its files would keep it open, were it closed by close().
+    multiprocessing.util.register_after_fork(sock, lambda sock: os.close(sock.detach()))
+    reader = sock.makefile('r', encoding='utf-8')
+    writer = sock.makefile('w', encoding='utf-8')
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def send(message):
+        with lock:
+            writer.write(_line(message))
+            writer.flush()
+
+    def heartbeat():
+        with contextlib.suppress(OSError):
+            while not stop.wait(args['cluster_heartbeat_s']):
+                send({'heartbeat': True})
+
+    # The (chunk, offset) of every image URL being classified, by its index in the stream.
+    where = {}
+
+    def urls():
+        index = itertools.count()
+        for line in reader:
+            message = json.loads(line)
+            if message.get('done'):
+                return
+            for offset, image in enumerate(message['urls']):
+                where[next(index)] = (message['chunk'], offset)
+                yield image
+        logging.warning("Lost the coordinator")
+
+    nm_answered = 0
+    try:
+        send({'hello': PROTOCOL_VERSION, 'signature': _signature(args)})
+        reply = json.loads(reader.readline() or "{}")
+        if not reply.get('welcome'):
+            raise BirdClassifierClusterException("The coordinator at {}:{} refused this worker: "
+                    "{}".format(host, port, reply.get('error', "it closed the connection")))
+        logging.info("Joined the coordinator at %s:%d", host, port)
+        threading.Thread(target=heartbeat, daemon=True).start()
+        with contextlib.closing(classify_birds_stream(urls(), None, args, False,
+                metrics)) as answers:
+            for answer in answers:
+                chunk, offset = where.pop(answer.index)
+                classified = answer.label_ids is not None
+                send({'chunk': chunk, 'offset': offset,
+                    'label_ids': answer.label_ids.tolist() if classified else None,
+                    'scores': answer.scores.tolist() if classified else None})
+                nm_answered += 1
+    except OSError as e:
+        logging.warning("Lost the coordinator: %s", e)
+    finally:
+        stop.set()
+        sock.close()
+    return nm_answered
@@ -0,0 +1,192 @@
+"""Serve bird classifications over HTTP with the model kept loaded."""
+
+
+import concurrent.futures
+import http.server
+import json
+import logging
+import queue
+import threading
+from time import perf_counter
+
+from aux.batching import get_batch
+from aux.histogram import Histogram
+from aux.local_open import is_local
+from classification.BirdClassifier import (_BirdClassifier, _BirdClassifierTask,
+        _BirdClassifierResponse, _StopAllException, load_labels)
+from classification.classification import ClassificationFatalException
+from classification.ImageDownloader import ImageDownloader
+from classification.ResultWriter import response_json
+
+
+class BirdClassifierServiceException(Exception):
+    """Exception signifying that the service could not be started."""
+
+
+class _BirdClassifierBatcher(threading.Thread, _BirdClassifier):
+    """
+    Thread classifying the images submitted by concurrent requests.
+
+    Images that are submitted close together in time are classified in a single model call,
+    whichever request they come from.
+    """
+
+    def __init__(self, args, bird_model):
+        threading.Thread.__init__(self)
+        _BirdClassifier.__init__(self, args)
+        self.daemon = True
+        self.bird_model = bird_model
+        self.queue = queue.Queue()
+        self.batch_sizes = Histogram("classifier_batch_size", "Images per model call.",
+                [1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.inference_latency = Histogram("classifier_inference_seconds",
+                "Time taken to classify a batch of images.")
+
+    def submit(self, task):
+        """
+        Decode the downloaded image of a task and queue it for classification.
+
+        Returns:
+            future (Future): A future for the BirdClassifierResponse of the task
+        """
+
+        future = concurrent.futures.Future()
+        image = self.prepare(task) if task.data is not None else None
+        if image is None:
+            future.set_result(_BirdClassifierResponse(task.index, task.image))
+        else:
+            self.queue.put((task, image, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = get_batch(self.queue, self.args['batch_size'], self.args['max_batch_wait_ms'])
+            self.batch_sizes.observe(len(batch))
+            start = perf_counter()
+            responses = self.respond([ task for task, _, _ in batch ],
+                    [ image for _, image, _ in batch ], self.bird_model)
+            self.inference_latency.observe(perf_counter() - start)
+            for (_, _, future), response in zip(batch, responses):
+                future.set_result(response)
+
+
+class _BirdClassifierRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handle requests to the service.
+
+    GET /health answers whether the service is up. GET /metrics gives the latency histograms,
+    of requests and of every stage of classifying an image, in the Prometheus text format. POST /classify classifies either the images at the URLs
+    given as {"urls": [...]} in a JSON body, or a single image sent as the raw request body.
+    """
+
+    def log_message(self, format, *args):
+        logging.debug("%s - " + format, self.address_string(), *args)
+
+    def _reply(self, status, body, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._reply(200, {'status': "ok"})
+        elif self.path == "/metrics":
+            self._reply(200, "".join(x.to_prometheus() for x in service.histograms()),
+                    content_type="text/plain; version=0.0.4")
+        else:
+            self._reply(404, {'error': "Not found"})
+
+    def _tasks(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.headers.get('Content-Type', '').startswith("application/json"):
+            return [ _BirdClassifierTask(0, None, body) ]
+        urls = json.loads(body.decode('utf-8'))['urls']
+        if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+            raise ValueError("'urls' must be a list of strings")
+        # Clients must not read the files of the server.
+        if any(is_local(url) for url in urls):
+            raise ValueError("'urls' must be URLs, not local paths")
+        if len(urls) > self.server.service.args['max_request_images']:
+            raise ValueError("At most {} URLs can be classified per request".format(
+                self.server.service.args['max_request_images']))
+        return [ _BirdClassifierTask(i, url) for i, url in enumerate(urls) ]
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path != "/classify":
+            self._reply(404, {'error': "Not found"})
+            return
+
+        start = perf_counter()
+        try:
+            tasks = self._tasks()
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': "Invalid request: {}".format(e)})
+            return
+
+        futures = []
+        if tasks and tasks[0].data is not None:
+            futures += [service.batcher.submit(tasks[0])]
+        elif tasks:
+            for task, data in ImageDownloader(service.args['nm_downloads'],
+                    metrics=service.batcher.metrics).download(tasks):
+                task.data = data
+                futures += [service.batcher.submit(task)]
+        responses = sorted(future.result() for future in futures)
+
+        results = [ response_json(response, service.bird_labels)
+                for response in responses ]
+        service.request_latency.observe(perf_counter() - start)
+        self._reply(200, {'results': results})
+
+
+class BirdClassifierService:
+    """HTTP service classifying birds, with the model and labels loaded once at startup."""
+
+    def __init__(self, args, host, port):
+        self.args = args
+        try:
+            bird_model = _BirdClassifier(args).load(args)
+        except _StopAllException:
+            raise BirdClassifierServiceException("Failed to load model")
+        try:
+            self.bird_labels = load_labels(args)
+        except ClassificationFatalException:
+            logging.error("Failed to load labels - answering label ids instead of names")
+            self.bird_labels = None
+        self.batcher = _BirdClassifierBatcher(args, bird_model)
+        self.request_latency = Histogram("classifier_request_seconds",
+                "Time taken to answer a classify request.")
+        self.httpd = http.server.ThreadingHTTPServer((host, port), _BirdClassifierRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.service = self
+
+    @property
+    def address(self):
+        """The (host, port) the service listens on."""
+        return self.httpd.server_address[:2]
+
+    def histograms(self):
+        """Get the histograms kept by the service, those of the stages of an image included."""
+        return [self.request_latency, self.batcher.inference_latency, self.batcher.batch_sizes] \
+                + list(self.batcher.metrics.histograms.values())
+
+    def serve_forever(self):
+        """Handle requests until shutdown() is called."""
+        self.batcher.start()
+        logging.info("Serving on %s:%d", *self.address)
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        """Stop handling requests."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.args['time']:
+            for histogram in self.histograms():
+                logging.debug("%s", str(histogram))
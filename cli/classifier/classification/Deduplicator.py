@@ -0,0 +1,149 @@
+"""Classify an image once however many times it appears among the tasks."""
+
+
+import collections
+import hashlib
+import threading
+import numpy as np
+
+
+class Deduplicator:
+    """
+    Match tasks to earlier tasks with the same image, so that only the first one is classified.
+
+    Tasks are added by keys identifying their image: their URL before downloading it, a hash of
+    its bytes after. The first task with a key answers the later ones; a later task gets the
+    answer of the first as soon as it is known.
+
+    To keep memory bounded over millions of tasks, only the last max_entries keys and answers
+    are remembered. A task whose image was seen before that is classified again.
+    """
+
+    NEW, WAITING, ANSWERED = range(3)
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.nm_duplicates = collections.Counter()
+        self._lock = threading.Lock()
+        # Index of the first task by key, and the answer by index of the first tasks answered.
+        self._first = collections.OrderedDict()
+        self._answers = collections.OrderedDict()
+        # Tasks waiting for the answer of a first task, by index of the first task.
+        self._waiting = {}
+
+    @staticmethod
+    def content_key(data):
+        """Get the key of the raw bytes of an image."""
+
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def add(self, task, key, kind):
+        """
+        Add a task by a key identifying its image, of a kind counted in nm_duplicates.
+
+        Returns:
+            status (int): NEW if no earlier task has the key; the task then answers later tasks
+                          with the key. ANSWERED if an earlier task has the key and its answer
+                          is known; it is set on the task. WAITING if the earlier task is not
+                          answered yet; the task is then returned by answer() with it.
+        """
+
+        with self._lock:
+            index = self._first.get(key)
+            if index is not None and index in self._answers:
+                self._answers.move_to_end(index)
+                task.label_ids, task.scores = self._answers[index]
+                self.nm_duplicates[kind] += 1
+                return Deduplicator.ANSWERED
+            if index is not None and index in self._waiting:
+                self._waiting[index] += [task]
+                self.nm_duplicates[kind] += 1
+                return Deduplicator.WAITING
+            # New, or its first task is forgotten.
+            self._first[key] = task.index
+            self._first.move_to_end(key)
+            if len(self._first) > self.max_entries:
+                self._first.popitem(last=False)
+            self._waiting.setdefault(task.index, [])
+            return Deduplicator.NEW
+
+    def answer(self, response):
+        """
+        Take the response to a task, and get the tasks waiting for it with its answer set.
+
+        A task waiting may itself be the first task with another key, so the tasks waiting for
+        it are returned as well.
+        """
+
+        answered = []
+        with self._lock:
+            indices = [response.index]
+            while indices:
+                index = indices.pop()
+                waiting = self._waiting.pop(index, None)
+                if waiting is None:
+                    continue
+                self._answers[index] = (response.label_ids, response.scores)
+                if len(self._answers) > self.max_entries:
+                    self._answers.popitem(last=False)
+                answered += waiting
+                indices += [ task.index for task in waiting ]
+        for task in answered:
+            task.label_ids, task.scores = response.label_ids, response.scores
+        return answered
+
+    def __str__(self):
+        counts = ", ".join("{} by {}".format(n, kind) for kind, n in
+                sorted(self.nm_duplicates.items()))
+        return "{} duplicate(s) saved{}".format(sum(self.nm_duplicates.values()),
+                ": " + counts if counts else "")
+
+
+def _bit_count(x):
+    return bin(x).count('1')
+
+# Number of bits set in every byte, for NumPy versions without bitwise_count().
+_BYTE_BIT_COUNTS = np.array([ _bit_count(i) for i in range(256) ], dtype=np.uint8)
+
+
+class PerceptualIndex:
+    """
+    Answers to the last max_entries images classified, by their 64-bit perceptual hash.
+
+    An image is taken to look the same as another when their hashes differ in at most
+    max_distance bits. The hashes are kept in an array, compared with a hash all at once.
+    """
+
+    def __init__(self, max_entries, max_distance):
+        self.max_distance = max_distance
+        self._hashes = np.zeros(max_entries, dtype=np.uint64)
+        self._answers = [None] * max_entries
+        self._size = 0
+        self._next = 0
+
+    @staticmethod
+    def distance(a, b):
+        """Get the number of bits two hashes differ in."""
+
+        return _bit_count(a ^ b)
+
+    def find(self, key):
+        """Get the answer to the closest image looking the same as the image of a hash, or None."""
+
+        if not self._size:
+            return None
+        x = self._hashes[:self._size] ^ np.uint64(key)
+        if hasattr(np, 'bitwise_count'):
+            distances = np.bitwise_count(x)
+        else:
+            distances = _BYTE_BIT_COUNTS[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        i = int(np.argmin(distances))
+        return self._answers[i] if distances[i] <= self.max_distance else None
+
+    def add(self, key, answer):
+        """Add the answer to the image of a hash, in place of the oldest one when full."""
+
+        self._hashes[self._next] = key
+        self._answers[self._next] = answer
+        self._next = (self._next + 1) % len(self._hashes)
+        self._size = min(self._size + 1, len(self._hashes))
@@ -0,0 +1,211 @@
+"""Download images concurrently."""
+
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+import numpy as np
+
+from aux.stage_metrics import StageMetrics
+from aux.throughput import Throughput
+from aux.url_open import UrlOpenFatalException, UrlOpenRetryException
+from classification.classification import Classification, ClassificationFatalException
+
+
+class ImageDownloader:
+    """
+    Download images in a pool of threads.
+
+    Downloading is I/O-bound, so threads are enough to keep many requests in flight while the
+    processes that decode and classify the images keep the CPU busy.
+
+    With a ResultCache, images with cached classifications are not downloaded at all; their
+    tasks get the cached classifications instead.
+
+    Downloads that fail in a way that may be temporary are retried after a backoff delay,
+    without holding up a download thread in the meantime. Every attempt is timed as the fetch
+    stage of metrics.
+    """
+
+    def __init__(self, nm_downloads, cache=None, metrics=None):
+        self.nm_downloads = nm_downloads
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else StageMetrics()
+        self.stats = Throughput("download")
+        self.nm_retries = 0
+        self._retries_lock = threading.Lock()
+
+    def _fetch(self, task, attempt):
+        """Fetch the image of a task; raises UrlOpenRetryException to retry it later."""
+
+        with self.stats.busy(), self.metrics.time('fetch'):
+            try:
+                if self.cache is None:
+                    return Classification.fetch_image(task.image, attempt, block=False)
+                cached, data, task.cache_key = self.cache.fetch(task.image, attempt, block=False)
+                if cached is not None:
+                    task.label_ids = np.array([ label_id for label_id, _ in cached ],
+                            dtype=np.int32)
+                    task.scores = np.array([ score for _, score in cached ], dtype=np.float32)
+                return data
+            except UrlOpenRetryException:
+                with self._retries_lock:
+                    self.nm_retries += 1
+                raise
+            except (ClassificationFatalException, UrlOpenFatalException):
+                return None
+            except OSError as e:
+                logging.warning("Error reading URL '%s': %s", task.image, e)
+                return None
+            except Exception:
+                logging.exception("Unexpected error when downloading %s", str(task))
+                return None
+
+    def download(self, tasks):
+        """
+        Download the images of the given tasks.
+
+        At most nm_downloads downloads are in flight at a time, and no new downloads are started
+        until the caller has consumed the finished ones.
+
+        Parameters:
+            tasks (iterable): The tasks, with an image attribute holding the image URL
+
+        Yields:
+            (task, data): A task and the raw bytes of its image, in the order the downloads
+                          complete. data is None if the download failed or if the task got
+                          its classifications from the cache.
+        """
+
+        tasks = iter(tasks)
+        results = queue.Queue()
+        with concurrent.futures.ThreadPoolExecutor(self.nm_downloads) as executor:
+            # A task waiting to be retried frees its place for another, so wake up for that.
+            scheduler = _RetryScheduler(executor, self._fetch,
+                    lambda task, data: results.put((task, data)), lambda: results.put(None))
+            try:
+                nm_pending = 0
+                for task in tasks:
+                    scheduler.submit(task)
+                    nm_pending += 1
+                    while nm_pending - scheduler.nm_delayed >= self.nm_downloads:
+                        result = results.get()
+                        if result is not None:
+                            nm_pending -= 1
+                            yield result
+                while nm_pending:
+                    result = results.get()
+                    if result is not None:
+                        nm_pending -= 1
+                        yield result
+            finally:
+                scheduler.close()
+
+    def store(self, cache_key, response):
+        """Store the results of a response to a downloaded image in the cache, if there is one."""
+
+        if self.cache is not None and cache_key is not None and response.label_ids is not None \
+                and len(response.label_ids):
+            self.cache.store(cache_key, list(zip(response.label_ids.tolist(),
+                response.scores.tolist())))
+
+    def download_to(self, tasks, callback):
+        """
+        Download the images of the given tasks, passing each to a callback as it completes.
+
+        The callback is called as callback(task, data) from a download thread, with data as
+        yielded by download(). Tasks are taken from the iterable as fast as it gives them, so
+        the caller bounds the number of pending downloads by blocking in it. Returns when all
+        downloads have been handled.
+        """
+
+        with concurrent.futures.ThreadPoolExecutor(self.nm_downloads) as executor:
+            scheduler = _RetryScheduler(executor, self._fetch, callback)
+            try:
+                for task in tasks:
+                    scheduler.submit(task)
+                scheduler.join()
+            finally:
+                scheduler.close()
+
+
+class _RetryScheduler:
+    """
+    Run fetches in an executor, and run them again once the backoff delay of a retry passed.
+
+    fetch(task, attempt) either returns the data of a task, which is passed on as
+    callback(task, data), or raises UrlOpenRetryException. Retries wait in a heap for a timer
+    thread to submit them, so that they do not hold up an executor thread; on_retry() is called
+    when a retry starts waiting. join() waits for the callbacks of all tasks submitted.
+    """
+
+    def __init__(self, executor, fetch, callback, on_retry=None):
+        self.executor = executor
+        self.fetch = fetch
+        self.callback = callback
+        self.on_retry = on_retry
+        self.nm_delayed = 0
+        self._nm_unhandled = 0
+        self._handled = threading.Condition()
+        # Retries as (time to retry at, sequence number, task, attempt).
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._closed = False
+        self._timer_wakeup = threading.Condition()
+        self._timer = threading.Thread(target=self._run_timer, daemon=True)
+        self._timer.start()
+
+    def submit(self, task, attempt=0):
+        with self._handled:
+            self._nm_unhandled += 1
+        self.executor.submit(self._run, task, attempt)
+
+    def _run(self, task, attempt):
+        try:
+            data = self.fetch(task, attempt)
+        except UrlOpenRetryException as e:
+            with self._timer_wakeup:
+                heapq.heappush(self._delayed, (time.monotonic() + e.delay, next(self._sequence),
+                    task, e.attempt))
+                self.nm_delayed += 1
+                self._timer_wakeup.notify_all()
+            if self.on_retry is not None:
+                self.on_retry()
+            return
+        try:
+            self.callback(task, data)
+        except Exception:
+            logging.exception("Unexpected error when handling download of %s", str(task))
+        finally:
+            with self._handled:
+                self._nm_unhandled -= 1
+                self._handled.notify_all()
+
+    def _run_timer(self):
+        with self._timer_wakeup:
+            while not self._closed:
+                while self._delayed and self._delayed[0][0] <= time.monotonic():
+                    _, _, task, attempt = heapq.heappop(self._delayed)
+                    self.nm_delayed -= 1
+                    self.executor.submit(self._run, task, attempt)
+                timeout = self._delayed[0][0] - time.monotonic() if self._delayed else None
+                self._timer_wakeup.wait(timeout)
+
+    def join(self):
+        """Wait until the callbacks of all tasks submitted have been called."""
+
+        with self._handled:
+            while self._nm_unhandled:
+                self._handled.wait()
+
+    def close(self):
+        """Stop the timer thread; retries that have not been submitted yet are dropped."""
+
+        with self._timer_wakeup:
+            self._closed = True
+            self._timer_wakeup.notify_all()
+        self._timer.join()
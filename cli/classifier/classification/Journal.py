@@ -0,0 +1,111 @@
+"""Journal the answers of a run as they complete, for the run to be resumed."""
+
+
+import json
+import logging
+import os
+import time
+import numpy as np
+
+
+class JournalException(Exception):
+    """Exception signifying that a journal cannot be resumed."""
+
+
+class Journal:
+    """
+    Append-only journal of the answers to image URLs, as JSON lines.
+
+    The first line holds a signature of how the answers were computed (e.g. the model used);
+    every other line an answer, as [image URL, label ids, scores] with the scores written as
+    float32. Only classified images are journaled, so that images that could not be classified
+    are tried again when resuming.
+
+    Every line is passed on to the system as it is written, so that a run that is killed loses
+    no answers. They are only synced to disk every sync_interval_ms milliseconds, and on
+    close(), so that a system crash loses the answers of that interval at most. A line cut short
+    by a crash is dropped when resuming.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, signature, resume=False, sync_interval_ms=1000):
+        self.path = path
+        self.signature = signature
+        self.sync_interval = sync_interval_ms / 1000
+        self.answers = {}
+        self.nm_written = 0
+        end = self._read() if resume and os.path.exists(path) else None
+        if end is None:
+            self._file = open(path, 'w')
+            self._file.write(self._line({'journal': Journal.VERSION, 'signature': signature}))
+            self._sync()
+        else:
+            os.truncate(path, end)
+            self._file = open(path, 'a')
+            logging.info("Resuming journal '%s' with %d answer(s)", path, len(self.answers))
+        self._next_sync = time.monotonic() + self.sync_interval
+
+    @staticmethod
+    def _line(x):
+        return json.dumps(x, separators=(',', ':')) + "\n"
+
+    def _read(self):
+        """Read the answers of the journal, and get where the last whole line of it ends."""
+
+        end = 0
+        with open(self.path, 'rb') as f:
+            header = f.readline()
+            try:
+                header = json.loads(header)
+            except ValueError:
+                # Cut short before its header was synced; nothing to resume.
+                return None
+            if not isinstance(header, dict) or header.get('journal') != Journal.VERSION or \
+                    header.get('signature') != self.signature:
+                raise JournalException("Journal '{}' was written with other settings or another "
+                        "model - run without resuming to start it over".format(self.path))
+            end = f.tell()
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError
+                    image, label_ids, scores = json.loads(line)
+                except ValueError:
+                    logging.warning("Dropping the end of journal '%s', cut short", self.path)
+                    break
+                self.answers[image] = (np.array(label_ids, dtype=np.int32),
+                        np.array(scores, dtype=np.float32))
+                end += len(line)
+        return end
+
+    def find(self, image):
+        """Get the (label ids, scores) journaled for an image URL, or None."""
+
+        return self.answers.get(image)
+
+    def write(self, image, label_ids, scores):
+        """Journal the answer to an image URL."""
+
+        # Float32 scores are written with the fewest digits that read back the same.
+        self._file.write('{},[{}],[{}]]\n'.format(json.dumps([image])[:-1],
+            ",".join(map(str, label_ids.tolist())), ",".join(map(str, scores))))
+        self.nm_written += 1
+        if time.monotonic() >= self._next_sync:
+            self._sync()
+            self._next_sync = time.monotonic() + self.sync_interval
+        else:
+            self._file.flush()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """Sync the journal to disk and close it."""
+
+        self._sync()
+        self._file.close()
+
+    def __str__(self):
+        return "{} answer(s) resumed, {} written".format(len(self.answers), self.nm_written)
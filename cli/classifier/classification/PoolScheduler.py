@@ -0,0 +1,153 @@
+"""Size the pool of worker processes and the threads of the inference process."""
+
+
+import logging
+import math
+import multiprocessing
+import os
+from time import perf_counter
+
+
+def _nm_cores():
+    """Get the number of cores this process may run on."""
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+def _available_memory():
+    """Get the memory available to new processes in bytes, or None if it is not known."""
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+
+class PoolScheduler:
+    """
+    Choose how many worker processes decode images and how many threads TensorFlow uses.
+
+    The cores are first split evenly between the decoding workers and the intra-op threads of
+    the inference process, as the two cost about the same per image. Once images have been
+    classified, the pool is resized so that the workers decode images as fast as the inference
+    process classifies them, going by the measured decode and inference time per image. The
+    pool never outgrows the cores, the tasks, or the memory available for more workers.
+
+    Tasks are handed to the workers in chunks, to spread the cost of passing them between
+    processes over several tasks. See chunk_size().
+
+    Settings given in the config are kept as they are: a fixed nm_workers turns resizing off.
+    """
+
+    # Weight of a new measurement in the moving averages of the costs per image.
+    COST_SMOOTHING = 0.1
+    # Measurements needed before the pool is first resized.
+    MIN_SAMPLES = 8
+    # Chunk size used before any decode time has been measured.
+    INITIAL_CHUNK_SIZE = 4
+
+    def __init__(self, args, nm_tasks=None):
+        self.args = args
+        self.nm_cores = _nm_cores()
+        self.nm_tasks = nm_tasks
+        self.adaptive = args['nm_workers'] is None
+        self.intra_op_threads = args['tf_intra_op_threads'] or max(1, self.nm_cores // 2)
+        self.inter_op_threads = args['tf_inter_op_threads'] or 1
+        if self.adaptive:
+            self.nm_workers = min(max(1, self.nm_cores - self.intra_op_threads),
+                    self.max_workers())
+        else:
+            self.nm_workers = args['nm_workers']
+        self.decode_cost = None
+        self.inference_cost = None
+        self.nm_samples = 0
+        self._last_resize = perf_counter()
+
+    def max_workers(self):
+        """Get the largest number of workers worth running with the memory available now."""
+
+        max_workers = self.nm_cores
+        if self.nm_tasks is not None:
+            max_workers = min(max_workers, self.nm_tasks)
+        available_memory = _available_memory()
+        if available_memory is not None:
+            max_workers = min(max_workers, available_memory //
+                    (self.args['worker_memory_mb'] * 1024**2))
+        return max(1, max_workers)
+
+    def server_args(self):
+        """Get the args of the inference process, with its TensorFlow thread counts."""
+
+        return dict(self.args, tf_intra_op_threads=self.intra_op_threads,
+                tf_inter_op_threads=self.inter_op_threads)
+
+    def _smooth(self, average, cost):
+        if average is None:
+            return cost
+        return average + PoolScheduler.COST_SMOOTHING * (cost - average)
+
+    def observe(self, response):
+        """Take the decode and inference time measured for the image of a response."""
+
+        if response.decode_time is not None:
+            self.decode_cost = self._smooth(self.decode_cost, response.decode_time)
+        if response.inference_time is not None:
+            self.inference_cost = self._smooth(self.inference_cost, response.inference_time)
+            self.nm_samples += 1
+
+    def resize(self, nm_workers):
+        """
+        Get the number of workers the pool should have now that it has nm_workers.
+
+        The pool is resized at most once per pool_adjust_interval_ms.
+        """
+
+        now = perf_counter()
+        if not self.adaptive or self.nm_samples < PoolScheduler.MIN_SAMPLES or \
+                now - self._last_resize < self.args['pool_adjust_interval_ms'] / 1000 or \
+                not self.inference_cost:
+            return nm_workers
+        self._last_resize = now
+        target = math.ceil(self.decode_cost / self.inference_cost)
+        target = max(1, min(target, self.max_workers()))
+        if target != nm_workers:
+            logging.info("Resizing pool from %d to %d worker(s): decode %.1fms, inference "
+                    "%.1fms per image", nm_workers, target, self.decode_cost * 1000,
+                    self.inference_cost * 1000)
+        self.nm_workers = target
+        return target
+
+    def chunk_size(self, nm_remaining=None):
+        """
+        Get the number of tasks to hand to a worker at a time.
+
+        A chunk holds about chunk_target_ms of decoding, going by the measured decode time.
+        Towards the end, when nm_remaining tasks are left to hand out, chunks shrink so that the
+        last tasks are spread over all workers instead of leaving one worker to finish alone.
+        """
+
+        size = self.args['max_chunk_size']
+        if self.decode_cost:
+            size = min(size, int(self.args['chunk_target_ms'] / 1000 / self.decode_cost))
+        else:
+            size = min(size, PoolScheduler.INITIAL_CHUNK_SIZE)
+        if nm_remaining is not None:
+            size = min(size, math.ceil(nm_remaining / (2 * self.nm_workers)))
+        return max(1, size)
+
+    def __str__(self):
+        available_memory = _available_memory()
+        return "{} worker(s){}, TensorFlow intra-op threads {}, inter-op threads {} ({} " \
+                "core(s), {} available memory)".format(self.nm_workers,
+                "" if self.adaptive else " (fixed)", self.intra_op_threads,
+                self.inter_op_threads, self.nm_cores, "unknown" if available_memory is None
+                else "{} MiB".format(available_memory // 1024**2))
@@ -0,0 +1,231 @@
+"""Write classification answers out in bulk: as text, JSON lines, CSV, NumPy or Parquet."""
+
+
+import csv
+import io
+import json
+import logging
+import numpy as np
+from time import perf_counter
+
+
+FORMATS = ['text', 'jsonl', 'csv', 'npy', 'parquet']
+
+
+def _names(labels, label_ids):
+    if labels is None:
+        return [ str(label_id) for label_id in label_ids ]
+    return labels[label_ids].tolist()
+
+def response_json(response, labels):
+    """Get an answer as a JSON-serializable dict of its image and named classifications."""
+
+    if response.label_ids is None:
+        return {'image': response.image, 'classifications': None}
+    return {'image': response.image, 'classifications': [ {'name': name, 'score': score}
+        for name, score in zip(_names(labels, response.label_ids), response.scores.tolist()) ]}
+
+
+class ResultWriter:
+    """
+    Write answers to an output, a chunk at a time.
+
+    Answers are buffered and formatted and written chunk_size at a time, rather than one by one.
+    So that streamed answers still come out steadily, the buffer is also written when
+    max_wait_s has passed since it was last written.
+
+    Label names are looked up in labels, label ids are written when labels is None.
+    """
+
+    def __init__(self, out, labels, nm_top_results, chunk_size=1024, max_wait_s=0.1):
+        self.out = out
+        self.labels = labels
+        self.nm_top_results = nm_top_results
+        self.chunk_size = chunk_size
+        self.max_wait_s = max_wait_s
+        self._buffer = []
+        self._last_write = perf_counter()
+
+    def write(self, answers):
+        """Write an iterable of answers."""
+
+        for answer in answers:
+            self._buffer += [answer]
+            if len(self._buffer) >= self.chunk_size or \
+                    perf_counter() - self._last_write >= self.max_wait_s:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered answers."""
+
+        if self._buffer:
+            self._write_chunk(self._buffer)
+            self._buffer = []
+        self.out.flush()
+        self._last_write = perf_counter()
+
+    def close(self):
+        """Write the buffered answers and whatever the format writes at the end."""
+
+        self.flush()
+
+    def _write_chunk(self, answers):
+        raise NotImplementedError
+
+
+class TextWriter(ResultWriter):
+    """Write each answer as its image URL, followed by its results on indented lines."""
+
+    def _write_chunk(self, answers):
+        blocks = []
+        for answer in answers:
+            if answer.label_ids is None:
+                results = ["None"]
+            elif not len(answer.label_ids):
+                results = ["[]"]
+            else:
+                results = [ "({}, {})".format(name, score) for name, score in
+                        zip(_names(self.labels, answer.label_ids), answer.scores.tolist()) ]
+            blocks += ["{}\n    {}\n".format(answer.image, "\n    ".join(results))]
+        self.out.write("".join(blocks))
+
+
+class JsonlWriter(ResultWriter):
+    """Write each answer as a line of JSON, like the answers of the classify service."""
+
+    def _write_chunk(self, answers):
+        self.out.write("".join(json.dumps(response_json(answer, self.labels)) + "\n"
+            for answer in answers))
+
+
+class CsvWriter(ResultWriter):
+    """
+    Write a CSV row per result: image, rank, label_id, name, score. An image that could not be
+    classified gets a single row with only its image.
+    """
+
+    def __init__(self, *args, **kwargs):
+        ResultWriter.__init__(self, *args, **kwargs)
+        self.out.write("image,rank,label_id,name,score\n")
+
+    def _write_chunk(self, answers):
+        rows = []
+        for answer in answers:
+            if answer.label_ids is None:
+                rows += [(answer.image, "", "", "", "")]
+                continue
+            label_ids = answer.label_ids.tolist()
+            rows += zip([answer.image] * len(label_ids), range(1, len(label_ids) + 1),
+                    label_ids, _names(self.labels, answer.label_ids), answer.scores.tolist())
+        text = io.StringIO()
+        csv.writer(text, lineterminator="\n").writerows(rows)
+        self.out.write(text.getvalue())
+
+
+class NpyWriter(ResultWriter):
+    """
+    Write all answers as a single structured NumPy array, to be read with np.load().
+
+    Every answer is a record of its index in the input, the number of its results (-1 if the
+    image could not be classified), and its label ids and float32 scores, padded to
+    nm_top_results with -1 and NaN. The label map is not written; nor are the image URLs,
+    which the index points into.
+
+    The array size is only known at the end, so the records are kept until close().
+    """
+
+    def __init__(self, *args, **kwargs):
+        ResultWriter.__init__(self, *args, **kwargs)
+        self.dtype = np.dtype([('index', np.int64), ('nm_results', np.int16),
+            ('label_ids', np.int32, (self.nm_top_results,)),
+            ('scores', np.float32, (self.nm_top_results,))])
+        self._chunks = []
+
+    def _write_chunk(self, answers):
+        records = np.zeros(len(answers), dtype=self.dtype)
+        records['index'] = [ answer.index for answer in answers ]
+        records['nm_results'] = [ -1 if answer.label_ids is None else len(answer.label_ids)
+                for answer in answers ]
+        label_ids, scores = records['label_ids'], records['scores']
+        label_ids[:] = -1
+        scores[:] = np.nan
+        for i, answer in enumerate(answers):
+            if answer.label_ids is not None:
+                label_ids[i, :len(answer.label_ids)] = answer.label_ids
+                scores[i, :len(answer.scores)] = answer.scores
+        self._chunks += [records]
+
+    def close(self):
+        self.flush()
+        records = np.concatenate(self._chunks) if self._chunks else np.zeros(0, self.dtype)
+        np.save(self.out, records, allow_pickle=False)
+        self.out.flush()
+
+
+class ParquetWriter(ResultWriter):
+    """
+    Write the answers as a Parquet table, a row group per chunk, with the columns index,
+    image, label_ids, names and scores; the last three are lists, null for images that could
+    not be classified. Needs the pyarrow package.
+    """
+
+    def __init__(self, *args, **kwargs):
+        ResultWriter.__init__(self, *args, **kwargs)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([('index', pa.int64()), ('image', pa.string()),
+            ('label_ids', pa.list_(pa.int32())), ('names', pa.list_(pa.string())),
+            ('scores', pa.list_(pa.float32()))])
+        self.writer = pq.ParquetWriter(self.out, self.schema)
+
+    def _write_chunk(self, answers):
+        classified = [ answer.label_ids is not None for answer in answers ]
+        columns = [
+                [ answer.index for answer in answers ],
+                [ answer.image for answer in answers ],
+                [ answer.label_ids.tolist() if x else None
+                    for answer, x in zip(answers, classified) ],
+                [ _names(self.labels, answer.label_ids) if x else None
+                    for answer, x in zip(answers, classified) ],
+                [ answer.scores.tolist() if x else None
+                    for answer, x in zip(answers, classified) ],
+                ]
+        self.writer.write_table(self.pa.Table.from_arrays([ self.pa.array(column, type=field.type)
+            for column, field in zip(columns, self.schema) ], schema=self.schema))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.out.flush()
+
+
+_WRITERS = {
+        'text': TextWriter,
+        'jsonl': JsonlWriter,
+        'csv': CsvWriter,
+        'npy': NpyWriter,
+        'parquet': ParquetWriter,
+        }
+
+def is_binary(format):
+    """Check whether a format is written as bytes rather than text."""
+
+    return format in ('npy', 'parquet')
+
+def open_writer(format, out, labels, nm_top_results):
+    """
+    Create the ResultWriter of a format.
+
+    Parameters:
+        format (str): One of FORMATS
+        out (file): Where to write the answers; a binary file for the formats of is_binary()
+        labels (np.ndarray): Label names indexed by label id, or None to write label ids only
+        nm_top_results (int): The largest number of results an answer has
+
+    Returns:
+        writer (ResultWriter): The writer
+    """
+
+    logging.debug("Writing results as %s", format)
+    return _WRITERS[format](out, labels, nm_top_results)
@@ -1,22 +1,55 @@
 """Provide functionality for classification."""
 
 
+import contextlib
+import hashlib
+import json
 import logging
 import os
+import shutil
+import time
 import cv2
 import numpy as np
-import tensorflow.compat.v2 as tf
-import tensorflow_hub as hub
 
+from aux.atomic_write import atomic_write
+from aux.local_open import is_local, local_read
 from aux.url_open import url_open, UrlOpenFatalException
 
 
 class Tf:
+    @staticmethod
+    def get():
+        """
+        Get the TensorFlow module, importing it on first use.
+
+        Importing TensorFlow takes seconds, so it is only imported by the processes that run
+        the model.
+        """
+        import tensorflow.compat.v2 as tf
+        return tf
+
     @staticmethod
     def print_info():
+        tf = Tf.get()
         print("Number of available physical GPUs: %d" % len(tf.config.list_physical_devices('GPU')))
         print("Number of available logical GPUs: %d" % len(tf.config.experimental.list_logical_devices('GPU')))
 
+    @staticmethod
+    def set_threads(intra_op_threads, inter_op_threads):
+        """
+        Set the number of threads TensorFlow runs an op on and runs ops in parallel on, where
+        given. This only has an effect before TensorFlow has run anything in this process.
+        """
+
+        tf = Tf.get()
+        try:
+            if intra_op_threads:
+                tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+            if inter_op_threads:
+                tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        except RuntimeError:
+            logging.debug("TensorFlow already initialized - keeping its thread counts")
+
     @staticmethod
     def init(tfhub_cache_dir):
         os.environ["TFHUB_CACHE_DIR"] = os.path.expanduser(tfhub_cache_dir)
@@ -29,6 +62,8 @@ class ClassificationFatalException(Exception):
 class ClassificationResult:
     """Classification result, containing name and probability."""
 
+    __slots__ = ('name', 'probability')
+
     def __init__(self, name, probability):
         self.name = name
         self.probability = probability
@@ -36,81 +71,535 @@ class ClassificationResult:
         return "({}, {})".format(self.name, self.probability)
 
 
+class _ModelOutput:
+    """Output of a model not run by TensorFlow, with the numpy() method of a tensor."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def numpy(self):
+        return self.array
+
+
+class StubModel:
+    """
+    Model standing in for the bird model when benchmarking, so that no model is downloaded.
+
+    Every call takes a fixed time. The scores depend on the mean color of the images only, so
+    that the same image always gets the same classifications.
+    """
+
+    NM_CLASSES = 965
+
+    def __init__(self, call_ms):
+        self.call_ms = call_ms
+        self.weights = np.random.default_rng(0).random((3, StubModel.NM_CLASSES),
+                dtype=np.float32)
+
+    def call(self, image_tensor):
+        time.sleep(self.call_ms / 1000)
+        return _ModelOutput(image_tensor.numpy().mean(axis=(1, 2)) @ self.weights)
+
+
+class TfLiteModel:
+    """
+    Model converted to TensorFlow Lite, run by the TFLite interpreter.
+
+    The interpreter of the tflite_runtime package is used when installed, so that inference
+    does not need TensorFlow; the one of TensorFlow otherwise. Its input is resized whenever the
+    batch size changes.
+    """
+
+    def __init__(self, path, nm_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = Tf.get().lite.Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=nm_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.input_shape = None
+
+    def call(self, image_tensor):
+        images = image_tensor.numpy()
+        if images.shape != self.input_shape:
+            self.interpreter.resize_tensor_input(self.input_index, images.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = images.shape
+        self.interpreter.set_tensor(self.input_index, images)
+        self.interpreter.invoke()
+        return _ModelOutput(self.interpreter.get_tensor(self.output_index))
+
+
+class CompiledModel:
+    """
+    TensorFlow model called through a function traced once, rather than op by op eagerly.
+
+    The function has a fixed (None, 224, 224, 3) float32 input signature, so that batches of any
+    size run the same graph without tracing it again. With xla, it is also compiled with XLA,
+    which fuses its ops; XLA compiles it again for every new batch size, so warm() it with the
+    batch size used most.
+    """
+
+    def __init__(self, model, xla=False):
+        tf = Tf.get()
+        # Kept, for its variables to live as long as the function.
+        self.model = model
+        self.xla = xla
+        self.function = tf.function(lambda images: model.call(images),
+                input_signature=[tf.TensorSpec([None, 224, 224, 3], tf.float32)],
+                jit_compile=xla)
+
+    def warm(self, batch_size):
+        """Trace the function, compiled for batch_size images with XLA, by calling it on zeros."""
+
+        tf = Tf.get()
+        self.function(tf.zeros([batch_size, 224, 224, 3], tf.float32))
+
+    def call(self, image_tensor):
+        return self.function(image_tensor)
+
+
 class Classification:
     """Namespace for functionality used for classification."""
 
+    EXPORT_INFO_FILE = "export.json"
+    STUB_MODEL_PREFIX = "stub:"
+    TFLITE_QUANTIZATIONS = ['float32', 'float16', 'int8']
+    # Bumped whenever the format of the labels cached by load_labels() changes.
+    LABELS_CACHE_VERSION = 1
+
+    @staticmethod
+    def _exported_model_format(url_model, model_dir):
+        if not model_dir:
+            return None
+        try:
+            with open(os.path.join(os.path.expanduser(model_dir),
+                    Classification.EXPORT_INFO_FILE)) as f:
+                export_info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if export_info.get('url_model') != url_model:
+            logging.debug("Model in '%s' was exported from another URL - ignoring it", model_dir)
+            return None
+        return export_info.get('format')
+
+    @staticmethod
+    def export_model(url_model, model_dir):
+        """
+        Export the model at a given URL to a local directory, for load_model() to load quickly.
+
+        The model is saved as a SavedModel with a traced call function, which loads without
+        resolving the URL or rebuilding a KerasLayer. Should the model not be exportable that
+        way, the resolved TF Hub module is copied instead.
+        """
+
+        import tensorflow_hub as hub
+        tf = Tf.get()
+        model_dir = os.path.expanduser(model_dir)
+        tmp_dir = model_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            layer = hub.KerasLayer(url_model)
+            module = tf.Module()
+            module.layer = layer
+            module.call = tf.function(lambda images: layer(images),
+                    input_signature=[tf.TensorSpec([None, 224, 224, 3], tf.float32)])
+            tf.saved_model.save(module, tmp_dir)
+            model_format = 'saved_model'
+        except Exception:
+            logging.warning("Could not export model as a SavedModel - copying it instead",
+                    exc_info=True)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            try:
+                shutil.copytree(hub.resolve(url_model), tmp_dir)
+            except Exception:
+                logging.exception("Failed to export model from URL '%s'", url_model)
+                raise ClassificationFatalException
+            model_format = 'hub'
+        with open(os.path.join(tmp_dir, Classification.EXPORT_INFO_FILE), 'w') as f:
+            json.dump({'url_model': url_model, 'format': model_format}, f)
+        shutil.rmtree(model_dir, ignore_errors=True)
+        os.rename(tmp_dir, model_dir)
+        return model_format
+
+    INFERENCE_MODES = ['eager', 'graph', 'xla']
+
+    @staticmethod
+    def _compiled(model, xla, warmup_batch_size):
+        """Get a model as a CompiledModel warmed up, or as it is when it cannot be compiled."""
+
+        start = time.perf_counter()
+        try:
+            compiled = CompiledModel(model, xla)
+            compiled.warm(warmup_batch_size)
+        except Exception:
+            logging.warning("Could not compile the model%s - calling it eagerly",
+                    " with XLA" if xla else "", exc_info=True)
+            return model
+        logging.debug("Traced the model%s in %.4fs", " and compiled it with XLA" if xla else "",
+                time.perf_counter() - start)
+        return compiled
+
     @staticmethod
-    def load_model(url_model):
-        """Load a KerasLayer model from a given URL."""
+    def load_model(url_model, model_dir=None, inference='eager', warmup_batch_size=1):
+        """
+        Load a model from a given URL.
+
+        When the model has been exported from that URL to model_dir with export_model(), it is
+        loaded from there instead. A URL of the form "stub:<ms>" gives a StubModel taking <ms>
+        milliseconds per call.
+
+        With inference 'graph' or 'xla', the model is called through a CompiledModel, traced,
+        and compiled with XLA for 'xla', by a first call on warmup_batch_size images here.
+        """
 
         model = None
         try:
-            model = hub.KerasLayer(url_model)
+            if url_model.startswith(Classification.STUB_MODEL_PREFIX):
+                return StubModel(float(url_model[len(Classification.STUB_MODEL_PREFIX):]))
+            model_format = Classification._exported_model_format(url_model, model_dir)
+            if model_format == 'saved_model':
+                model = Tf.get().saved_model.load(os.path.expanduser(model_dir))
+            else:
+                import tensorflow_hub as hub
+                model = hub.KerasLayer(os.path.expanduser(model_dir) if model_format
+                        else url_model)
             if not model:
                 logging.warning("No model returned for URL '%s'", url_model)
                 raise
         except Exception:
             raise ClassificationFatalException
+        if inference != 'eager':
+            model = Classification._compiled(model, inference == 'xla', warmup_batch_size)
         return model
 
     @staticmethod
-    def load_labels(url_labels):
-        """Load labels from a given URL."""
+    def tflite_path(url_model, quantization, tfhub_cache_dir):
+        """
+        Get where the TFLite conversion of a model is cached: in a tflite directory next to the
+        TF Hub cache, named by the model URL and the quantization.
+        """
+
+        cache_dir = os.path.normpath(os.path.expanduser(tfhub_cache_dir))
+        name = hashlib.sha1(url_model.encode()).hexdigest()[:16]
+        return os.path.join(os.path.dirname(cache_dir), "tflite",
+                "{}-{}.tflite".format(name, quantization))
+
+    @staticmethod
+    def convert_tflite(url_model, model_dir, path, quantization):
+        """
+        Convert the model at a given URL to TensorFlow Lite, and save it to path.
+
+        The model is loaded as load_model() does, from model_dir when exported there. Its
+        weights are kept as float32, or quantized to float16 or to int8 with dynamic range
+        quantization, which also runs most ops on int8 values.
+        """
 
-        labels_raw = None
+        tf = Tf.get()
+        model = Classification.load_model(url_model, model_dir)
         try:
-            labels_raw = url_open(url_labels)
-        except UrlOpenFatalException:
+            call = tf.function(lambda images: model.call(images),
+                    input_signature=[tf.TensorSpec([None, 224, 224, 3], tf.float32)])
+            converter = tf.lite.TFLiteConverter.from_concrete_functions(
+                    [call.get_concrete_function()], model)
+            if quantization != 'float32':
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if quantization == 'float16':
+                converter.target_spec.supported_types = [tf.float16]
+            tflite_model = converter.convert()
+        except Exception:
+            logging.exception("Failed to convert model from URL '%s' to TFLite", url_model)
             raise ClassificationFatalException
-        labels_lines = [line.decode('utf-8').replace('\n', '') for line in labels_raw.readlines()]
-        labels_lines.pop(0) # Remove header (id, name).
-        labels = {}
-        for line in labels_lines:
-            e_id = int(line.split(',')[0])
-            e_name = line.split(',')[1]
-            labels[e_id] = {'name': e_name}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, 'wb') as f:
+            f.write(tflite_model)
+
+    @staticmethod
+    def load_tflite_model(url_model, model_dir, path, quantization, nm_threads=None):
+        """
+        Load the TFLite conversion of the model at a given URL from path, converting it there
+        with convert_tflite() first if it is not there yet. Stub models are loaded as they are.
+        """
+
+        if url_model.startswith(Classification.STUB_MODEL_PREFIX):
+            return Classification.load_model(url_model)
+        if not os.path.exists(path):
+            logging.info("Converting model to TFLite (%s) to '%s'", quantization, path)
+            Classification.convert_tflite(url_model, model_dir, path, quantization)
+        try:
+            return TfLiteModel(path, nm_threads)
+        except Exception:
+            logging.exception("Failed to load TFLite model '%s'", path)
+            raise ClassificationFatalException
+
+    @staticmethod
+    def labels_path(url_labels, tfhub_cache_dir):
+        """
+        Get where the label map at a URL is cached by load_labels(): in a labels directory next
+        to the TF Hub cache, named by the URL and the version of the cache format.
+        """
+
+        cache_dir = os.path.normpath(os.path.expanduser(tfhub_cache_dir))
+        name = hashlib.sha1(url_labels.encode()).hexdigest()[:16]
+        return os.path.join(os.path.dirname(cache_dir), "labels",
+                "{}-v{}.npy".format(name, Classification.LABELS_CACHE_VERSION))
+
+    @staticmethod
+    def parse_labels(data):
+        """Parse the raw bytes of a label map, a CSV of id,name lines after a header."""
+
+        lines = data.decode('utf-8').splitlines()[1:]
+        labels_split = [ line.split(',', 2) for line in lines if line ]
+        e_ids = [ int(e[0]) for e in labels_split ]
+        labels = np.full(max(e_ids) + 1, '', dtype=object)
+        labels[e_ids] = [ e[1] for e in labels_split ]
+        return labels.astype(str)
+
+    @staticmethod
+    def _labels_cache_info(url_labels, path):
+        """Get the info of the labels cached at path, or None if none are cached for the URL."""
+
+        try:
+            with open(path[:-len(".npy")] + ".json") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if info.get('url') != url_labels or not os.path.exists(path):
+            return None
+        return info
+
+    @staticmethod
+    def _save_labels_cache(path, labels, info):
+        # The array first, so that its info is never newer than it.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if labels is not None:
+            with atomic_write(path, 'wb') as f:
+                np.save(f, labels)
+        with atomic_write(path[:-len(".npy")] + ".json") as f:
+            json.dump(info, f)
+
+    @staticmethod
+    def load_labels(url_labels, path=None, ttl=0):
+        """
+        Load labels from a given URL, as an array of label names indexed by label id.
+
+        With a path, as given by labels_path(), the labels are cached there as a NumPy array,
+        which is memory-mapped rather than read. For ttl seconds after being fetched or last
+        revalidated, they are loaded from there without any request; after that, they are
+        revalidated with a conditional request on their ETag/Last-Modified. Should the URL not
+        be reachable, the cached labels are loaded however old they are, so that they load
+        offline.
+        """
+
+        info = Classification._labels_cache_info(url_labels, path) if path else None
+        if info is not None and time.time() - info['checked'] < ttl:
+            return np.load(path, mmap_mode='r')
+        headers = {}
+        if info is not None and info['etag']:
+            headers['If-None-Match'] = info['etag']
+        if info is not None and info['last_modified']:
+            headers['If-Modified-Since'] = info['last_modified']
+        try:
+            labels_raw = url_open(url_labels, headers)
+        except UrlOpenFatalException:
+            if info is None:
+                raise ClassificationFatalException
+            logging.warning("Could not revalidate labels from URL '%s' - loading cached ones",
+                    url_labels)
+            return np.load(path, mmap_mode='r')
+        if info is not None and labels_raw.getcode() == 304:
+            info['checked'] = time.time()
+            Classification._save_labels_cache(path, None, info)
+            return np.load(path, mmap_mode='r')
+        labels = Classification.parse_labels(labels_raw.read())
+        if path:
+            Classification._save_labels_cache(path, labels, {'url': url_labels,
+                'etag': labels_raw.headers.get('ETag'),
+                'last_modified': labels_raw.headers.get('Last-Modified'),
+                'checked': time.time()})
         return labels
 
     @staticmethod
-    def order_by_result_score(model_raw_output, labels):
-        """Order model output based on score values."""
+    def top_n(model_raw_output, n, softmax=False, threshold=None):
+        """
+        Get the ids and scores of the top n labels for every image of a model output.
 
-        for index, value in np.ndenumerate(model_raw_output):
-            index = index[1]
-            labels[index]['score'] = value
-        return sorted(labels.items(), key=lambda x: x[1]['score'])
+        Parameters:
+            model_raw_output (np.ndarray): Scores of shape (nm_images, nm_labels)
+            n (int): The number of results to get per image
+            softmax (bool): Turn the scores of each image into probabilities first
+            threshold (float): Leave out results scoring below this value
+
+        Returns:
+            label_ids (np.ndarray): int32 label ids of shape (nm_images, n), highest score first
+            scores (np.ndarray): float32 scores of shape (nm_images, n)
+            nm_results (np.ndarray): The number of results per image scoring above the
+                                     threshold, which are the first ones of each row
+        """
+
+        scores = np.asarray(model_raw_output, dtype=np.float32)
+        if softmax:
+            scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+            scores /= scores.sum(axis=1, keepdims=True)
+        n = min(n, scores.shape[1])
+        # Only the n best scores are sorted, the rest are just partitioned away.
+        top_ids = np.argpartition(scores, -n, axis=1)[:, -n:]
+        top_scores = np.take_along_axis(scores, top_ids, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top_ids = np.take_along_axis(top_ids, order, axis=1).astype(np.int32)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        if threshold is None:
+            nm_results = np.full(len(top_ids), n)
+        else:
+            nm_results = (top_scores >= threshold).sum(axis=1)
+        return top_ids, top_scores, nm_results
 
     @staticmethod
-    def get_top_n_result(top_index, names_with_results_ordered):
-        """Get the top n results from an ordered list."""
+    def top_n_results(model_raw_output, labels, n, softmax=False, threshold=None):
+        """
+        Get the top n results for every image of a model output, as ClassificationResults.
+
+        See top_n() for the parameters; labels holds the label names indexed by label id.
+
+        Returns:
+            results ([[ClassificationResult]]): The results per image, highest score first
+        """
 
-        name = names_with_results_ordered[top_index*(-1)][1]['name']
-        score = names_with_results_ordered[top_index*(-1)][1]['score']
-        return ClassificationResult(name, score)
+        top_ids, top_scores, nm_results = Classification.top_n(model_raw_output, n, softmax,
+                threshold)
+        return [ [ ClassificationResult(name, score) for name, score in
+                zip(labels[top_ids[i, :k]], top_scores[i, :k].tolist()) ]
+                for i, k in enumerate(nm_results.tolist()) ]
 
     @staticmethod
-    def load_image(image):
-        """Load an image from a URL."""
+    def fetch_image(image, attempt=0, block=True):
+        """
+        Fetch the raw bytes of an image from a URL, or read them from a local file or archive.
+
+        attempt and block are passed on to url_open(): without block, UrlOpenRetryException is
+        raised when the image should be fetched again later.
+        """
 
+        if is_local(image):
+            try:
+                return local_read(image)
+            except OSError as e:
+                logging.warning("Error reading file '%s': %s", image, e)
+                raise ClassificationFatalException
         image_get_response = None
         try:
-            image_get_response = url_open(image)
+            image_get_response = url_open(image, attempt=attempt, block=block)
+            return image_get_response.read()
         except UrlOpenFatalException:
             raise ClassificationFatalException
-        return np.asarray(bytearray(image_get_response.read()), dtype=np.uint8)
+        except OSError as e:
+            logging.warning("Error reading URL '%s': %s", image, e)
+            raise ClassificationFatalException
+
+    @staticmethod
+    def image_array(data):
+        """View the raw bytes of an image as an array that can be decoded, without copying."""
+
+        return np.frombuffer(data, dtype=np.uint8)
+
+    @staticmethod
+    def load_image(image):
+        """Load an image from a URL or a local file or archive."""
+
+        return Classification.image_array(Classification.fetch_image(image))
+
+    IMAGE_SIZE = 224
+    _JPEG_REDUCED_FLAGS = [
+            (8, cv2.IMREAD_REDUCED_COLOR_8),
+            (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2),
+            ]
 
     @staticmethod
-    def format_image(image_array):
-        """Format an image."""
+    def jpeg_size(image_array):
+        """Get the (width, height) of a JPEG image from its header, or None if not a JPEG."""
+
+        a = image_array
+        if len(a) < 4 or a[0] != 0xFF or a[1] != 0xD8:
+            return None
+        i = 2
+        while i + 9 < len(a):
+            if a[i] != 0xFF:
+                return None
+            marker = a[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                i += 2
+                continue
+            # Start of frame markers, except DHT (C4), JPG (C8) and DAC (CC), hold the size.
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height = (int(a[i + 5]) << 8) | int(a[i + 6])
+                width = (int(a[i + 7]) << 8) | int(a[i + 8])
+                return width, height
+            i += 2 + ((int(a[i + 2]) << 8) | int(a[i + 3]))
+        return None
+
+    @staticmethod
+    def format_image(image_array, stages=None):
+        """
+        Format an image as a 224x224 BGR uint8 array.
+
+        Large JPEG images are decoded at 1/2, 1/4 or 1/8 of their size when that still leaves
+        at least 224x224 pixels, which is much cheaper than a full decode. With a StageMetrics
+        as stages, the decode and the resize are timed in it. Raises
+        ClassificationFatalException when the image cannot be decoded.
+        """
+
+        flags = cv2.IMREAD_COLOR
+        with stages.time('decode') if stages else contextlib.nullcontext():
+            size = Classification.jpeg_size(image_array)
+            if size:
+                for factor, reduced_flags in Classification._JPEG_REDUCED_FLAGS:
+                    if min(size) // factor >= Classification.IMAGE_SIZE:
+                        flags = reduced_flags
+                        break
+            # OpenCV gives None for data it cannot decode, but fails on empty data.
+            image = cv2.imdecode(image_array, flags) if image_array.size else None
+            if image is None:
+                raise ClassificationFatalException
+        with stages.time('resize') if stages else contextlib.nullcontext():
+            return cv2.resize(image, (Classification.IMAGE_SIZE, Classification.IMAGE_SIZE))
+
+    @staticmethod
+    def dhash(image):
+        """
+        Get the difference hash of a formatted image: whether each pixel is brighter than the
+        one to its left, in a 9x8 grayscale thumbnail, as a 64-bit int. Images that look the
+        same, though encoded differently or at other sizes, get hashes differing in few bits.
+        """
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+        return int.from_bytes(np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1]).tobytes(), 'big')
+
+    @staticmethod
+    def fill_batch(images, out=None):
+        """
+        Convert formatted images to a float32 RGB batch of shape (N, 224, 224, 3) in [0, 1].
+
+        The BGR to RGB swap and the scaling are done in one pass per image, straight into out
+        when given. out must then have room for at least N images; out[:N] is returned.
+        """
 
-        image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-        image = cv2.resize(image, (224, 224))
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        return image / 255
+        if out is None or len(out) < len(images):
+            out = np.empty((len(images), Classification.IMAGE_SIZE, Classification.IMAGE_SIZE,
+                3), dtype=np.float32)
+        scale = np.float32(1 / 255)
+        for i, image in enumerate(images):
+            np.multiply(image[..., ::-1], scale, out=out[i])
+        return out[:len(images)]
 
     @staticmethod
-    def generate_tensor(image):
-        """Generate a tensor for an image."""
+    def generate_tensor(images, out=None):
+        """Generate a tensor of shape (N, 224, 224, 3) with values in [0, 1] for N images."""
 
-        image_tensor = tf.convert_to_tensor(image, dtype=tf.float32)
-        return tf.expand_dims(image_tensor, 0)
+        tf = Tf.get()
+        return tf.convert_to_tensor(Classification.fill_batch(images, out), dtype=tf.float32)
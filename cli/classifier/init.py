@@ -9,6 +9,7 @@ import sys
 import traceback
 
 from aux.err import *
+from aux.local_open import expand
 from aux.MultiprocessingLog import MultiprocessingLog
 
 
@@ -20,27 +21,49 @@ def _get_config():
     config.read(CONFIG_FILE)
     return config
 
-def init():
-    config = _get_config()
+def _read_data(sys_stdin, files, images):
+    """
+    Read image URLs lazily: standard input first, then the files in order, then images. Local
+    directories, globs and archives are expanded into the images they hold.
+    """
 
-    parser = argparse.ArgumentParser(description='Classifier')
+    # Get any standard input directed to this program.
+    if sys_stdin:
+        nm_lines = 0
+        for line in sys.stdin:
+            nm_lines += 1
+            yield from expand(line.strip())
+        logging.debug("Read {} line(s) from sys.stdin".format(nm_lines))
 
-    parser.add_argument('files', nargs='*', type=str,
-            help='The file(s) containing image URLs to open. Opening more than one file leads to a concatenation of all files.')
-    parser.add_argument('-i', '--image', nargs=1, type=str, action='append',
-            help='Image URL.') 
+    # If more than one file is given, concatenate them together in the sequence that they arrived.
+    for f, rf in files:
+        nm_lines = 0
+        with rf:
+            for line in rf:
+                nm_lines += 1
+                yield from expand(line.strip())
+        logging.debug("Read " + str(nm_lines) + " line(s) from file " + str(f))
+
+    # Add any number of image URL(s) stated with the flag.
+    if images:
+        for image in images:
+            for x in image:
+                yield from expand(x)
+
+def _add_common_arguments(parser):
     parser.add_argument('-d', '--debug', action='store_true',
             help='Turn on debug output.')
     parser.add_argument('-t', '--time', action='store_true',
             help='Time the execution time(s) of the application.')
     parser.add_argument('-p', '--profile', action='store_true',
             help='Profile the application')
-    parser.add_argument('-s', '--show', action='store_true',
-            help='Show image in terminal window')
-
-    args = parser.parse_args()
 
-    mpl = MultiprocessingLog("classifier.log", mode="w+", maxsize=0, rotate=0)
+def _init_logging(args, config, name="classifier.log", mode="w+"):
+    mpl = MultiprocessingLog(name, mode=mode, maxsize=0, rotate=0,
+            batch_size=int(config.get('log', 'batch_size')),
+            flush_interval_ms=int(config.get('log', 'flush_interval_ms')),
+            queue_size=int(config.get('log', 'queue_size')),
+            debug_sample_rate=int(config.get('log', 'debug_sample_rate')))
     formatter = logging.Formatter("[%(asctime)s] %(processName)s: %(levelname)s: %(message)s")
     mpl.setFormatter(formatter)
     logger = logging.getLogger()
@@ -52,6 +75,99 @@ def init():
     else:
         logger.setLevel(logging.INFO)
 
+def _init_serve(config, argv):
+    parser = argparse.ArgumentParser(prog='classifier serve',
+            description='Serve classifications over HTTP, keeping the model loaded.')
+
+    parser.add_argument('--host', type=str, default=config.get('service', 'host'),
+            help='The address to listen on.')
+    parser.add_argument('--port', type=int, default=int(config.get('service', 'port')),
+            help='The port to listen on.')
+    _add_common_arguments(parser)
+
+    args = parser.parse_args(argv)
+    args.command = 'serve'
+    _init_logging(args, config)
+    return config, None, args
+
+def _init_warmup(config, argv):
+    parser = argparse.ArgumentParser(prog='classifier warmup',
+            description='Export the model to model_dir, from where it loads fastest.')
+
+    _add_common_arguments(parser)
+
+    args = parser.parse_args(argv)
+    args.command = 'warmup'
+    _init_logging(args, config)
+    return config, None, args
+
+def _address(value):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("'{}' is not HOST:PORT".format(value))
+    return host, int(port)
+
+def _init_worker(config, argv):
+    parser = argparse.ArgumentParser(prog='classifier worker',
+            description='Classify the image URLs handed out by a coordinator, a classifier run with --listen.')
+
+    parser.add_argument('--connect', type=_address, required=True, metavar='HOST:PORT',
+            help='The address the coordinator listens on.')
+    _add_common_arguments(parser)
+
+    args = parser.parse_args(argv)
+    args.command = 'worker'
+    # Appended to, so that the workers of a machine can share it.
+    _init_logging(args, config, "classifier-worker.log", "a")
+    return config, None, args
+
+COMMANDS = {
+        'serve': _init_serve,
+        'warmup': _init_warmup,
+        'worker': _init_worker,
+        }
+
+def init():
+    config = _get_config()
+
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](config, sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='Classifier',
+            epilog='Commands: {}. Run a command with --help for its arguments.'.format(
+                ', '.join(COMMANDS)))
+
+    parser.add_argument('files', nargs='*', type=str,
+            help='The file(s) containing image URLs to open. Opening more than one file leads to a concatenation of all files. A line may also be a local image, directory, glob, or tar/zip archive.')
+    parser.add_argument('-i', '--image', nargs=1, type=str, action='append',
+            help='Image URL, or local image, directory, glob, or tar/zip archive.') 
+    _add_common_arguments(parser)
+    parser.add_argument('-s', '--show', action='store_true',
+            help='Show image in terminal window')
+    parser.add_argument('--stream', action='store_true',
+            help='Read image URLs lazily and write each result as soon as it is ready, keeping memory use bounded.')
+    parser.add_argument('--unordered', action='store_true',
+            help='With --stream or --listen, write results in the order they complete instead of the input order.')
+    parser.add_argument('--format', choices=['text', 'jsonl', 'csv', 'npy', 'parquet'],
+            default='text',
+            help='The format to write results in. npy and parquet are binary; parquet needs pyarrow.')
+    parser.add_argument('--metrics-file', type=str,
+            help='Write latency histograms of every stage (fetch, decode, resize, tensor, model, scoring) to this file in the Prometheus text format.')
+    parser.add_argument('--profile-workers', action='store_true',
+            help='Profile the worker processes, and print their merged profile to stderr.')
+    parser.add_argument('--listen', type=_address, metavar='HOST:PORT',
+            help="Hand the images out to workers connecting to this address, started with 'classifier worker --connect HOST:PORT', instead of classifying them here.")
+    parser.add_argument('--journal', type=str,
+            help='Journal the answers to this file as they complete, starting it over.')
+    parser.add_argument('--resume', action='store_true',
+            help='With --journal, resume the journal: images answered there are not classified again, and their answers are written with the others.')
+
+    args = parser.parse_args()
+    if args.resume and not args.journal:
+        err_exit(msg="--resume needs --journal\n", parser=parser)
+    args.command = None
+    _init_logging(args, config)
+
     # Check if stdin is piped and if it is redirected.
     mode = os.fstat(0).st_mode
     stdin_is_piped, stdin_is_redirected = stat.S_ISFIFO(mode), stat.S_ISREG(mode)
@@ -70,28 +186,16 @@ def init():
         err_exit(msg="no {} and no {} provided as argument(s)\n".format(e[0], e[1]), parser=parser)
     del e
 
-    data = []
-
-    # Get any standard input directed to this program.
-    if sys_stdin:
-        data = [line.strip() for line in sys.stdin]
-    if data:
-        logging.debug("Read {} line(s) from sys.stdin".format(len(data)))
-
-    # If more than one file is given, concatenate them together in the sequence that they arrived.
+    # Open all files up front so that a missing file is reported before anything runs.
+    files = []
     for f in args.files:
-        f_data_prev_len = len(data)
         try:
-            with open(f, 'r') as rf:
-                data += [line.strip() for line in rf]
+            files += [(f, open(f, 'r'))]
         except FileNotFoundError as e:
             err_exit(traceback=traceback.format_exc())
-        logging.debug("Read " + str(len(data) - f_data_prev_len) + " line(s) from file " + str(f))
-    f_data_nm_lines = len(data)
 
-    # Add any number of image URL(s) stated with the flag.
-    if args.image:
-        for image in args.image:
-            data += image
+    data = _read_data(sys_stdin, files, args.image)
+    if not args.stream:
+        data = list(data)
 
-    return config, data, args.time, args.profile, args.show
+    return config, data, args
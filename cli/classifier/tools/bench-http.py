@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark of image fetches: url_open() with pooled keep-alive connections against a new
+connection per request.
+
+Images of the benchmark corpus are fetched from a local keep-alive server by a pool of
+threads, as the ImageDownloader does. A remote host is simulated by delaying every new
+connection by --connect-ms, which is what a TCP and TLS handshake costs over the network.
+
+Usage: python tools/bench-http.py [--connect-ms 20] [--nm-requests 2000]
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark
+from aux.url_open import configure_url_open, url_open
+
+
+def _fetch_all(urls, nm_threads):
+    with concurrent.futures.ThreadPoolExecutor(nm_threads) as executor:
+        start = perf_counter()
+        sizes = list(executor.map(lambda url: len(url_open(url).read()), urls))
+    return perf_counter() - start, sum(sizes)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pooled keep-alive fetches.")
+    parser.add_argument("--connect-ms", type=float, default=20,
+            help="delay of every new connection in milliseconds")
+    parser.add_argument("-n", "--nm-requests", type=int, default=2000)
+    parser.add_argument("--nm-threads", type=int, default=32)
+    parser.add_argument("--max-connections-per-host", type=int, default=8)
+    cli_args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        benchmark._write_corpus(directory)
+        httpd, url = benchmark._serve(directory)
+        setup = httpd.RequestHandlerClass.func.setup
+        def delayed_setup(handler):
+            time.sleep(cli_args.connect_ms / 1000)
+            setup(handler)
+        httpd.RequestHandlerClass.func.setup = delayed_setup
+        urls = [ "{}/{}".format(url, name) for name, size in benchmark.CORPUS if size ]
+        urls = [ urls[i % len(urls)] for i in range(cli_args.nm_requests) ]
+
+        print("{:>12} {:>10} {:>12} {:>10}".format("connections", "seconds", "requests/s",
+            "MiB/s"))
+        for keep_alive in [False, True]:
+            configure_url_open(30, cli_args.max_connections_per_host, keep_alive=keep_alive)
+            elapsed, size = _fetch_all(urls, cli_args.nm_threads)
+            print("{:>12} {:>10.3f} {:>12.1f} {:>10.1f}".format(
+                "keep-alive" if keep_alive else "per request", elapsed,
+                len(urls) / elapsed, size / elapsed / 1024**2))
+        httpd.shutdown()
+
+if __name__ == "__main__":
+    main()
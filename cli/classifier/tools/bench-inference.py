@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the model called eagerly against the model called through a traced function, with and
+without XLA, at several batch sizes.
+
+For every inference mode and batch size, the table shows the time of the first call, which
+traces the function (and compiles it with XLA for that batch size), then the median time per
+call and per image of the calls after it, and the speedup per image over eager calls.
+
+The model of config.ini is loaded as load_model() does. With --synthetic, a MobileNetV2 with
+random weights and the 965 classes of the bird model is built instead, so that nothing is
+downloaded; the bird model is a MobileNet too.
+
+Usage: python tools/bench-inference.py [-b 1 8 32 128] [-n 20] [-m eager graph xla] [--synthetic]
+"""
+
+import argparse
+import configparser
+import os
+import statistics
+import sys
+from time import perf_counter
+
+import numpy as np
+
+CLASSIFIER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, CLASSIFIER_DIR)
+from classification.classification import Classification, CompiledModel, StubModel, Tf
+
+
+def _load_model(cli_args):
+    if cli_args.synthetic:
+        return Tf.get().keras.applications.MobileNetV2(weights=None,
+                classes=StubModel.NM_CLASSES)
+    config = configparser.ConfigParser()
+    config.read(os.path.join(CLASSIFIER_DIR, "config.ini"))
+    Tf.init(config.get('classifier', 'tfhub_cache_dir'))
+    return Classification.load_model(config.get('bird-classifier', 'url_model'),
+            config.get('bird-classifier', 'model_dir'))
+
+def _bench(model, image_tensor, nm_iterations):
+    """Get the time of the first call, and the median time of the calls after it."""
+    start = perf_counter()
+    model.call(image_tensor).numpy()
+    first = perf_counter() - start
+    times = []
+    for _ in range(nm_iterations):
+        start = perf_counter()
+        model.call(image_tensor).numpy()
+        times += [perf_counter() - start]
+    return first, statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark eager and compiled inference.")
+    parser.add_argument("-b", "--batch-sizes", nargs='+', type=int, default=[1, 8, 32, 128])
+    parser.add_argument("-n", "--nm-iterations", type=int, default=20)
+    parser.add_argument("-m", "--modes", nargs='+', choices=Classification.INFERENCE_MODES,
+            default=Classification.INFERENCE_MODES)
+    parser.add_argument("--synthetic", action='store_true',
+            help="benchmark a MobileNetV2 with random weights instead of the model")
+    cli_args = parser.parse_args()
+
+    model = _load_model(cli_args)
+    models = { mode: model if mode == 'eager' else CompiledModel(model, mode == 'xla')
+            for mode in cli_args.modes }
+    images = np.random.default_rng(0).integers(0, 256, (max(cli_args.batch_sizes), 224, 224, 3),
+            dtype=np.uint8)
+
+    print("{:>6} {:>6} {:>10} {:>10} {:>10} {:>8}".format("batch", "mode", "first ms",
+        "ms/call", "ms/image", "speedup"))
+    for batch_size in cli_args.batch_sizes:
+        image_tensor = Classification.generate_tensor(images[:batch_size])
+        eager = None
+        for mode in cli_args.modes:
+            first, median = _bench(models[mode], image_tensor, cli_args.nm_iterations)
+            eager = median if mode == 'eager' else eager
+            print("{:>6} {:>6} {:>10.1f} {:>10.2f} {:>10.3f} {:>8}".format(batch_size, mode,
+                first * 1000, median * 1000, median * 1000 / batch_size,
+                "{:.2f}x".format(eager / median) if eager else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark of image preprocessing: time and allocations per image.
+
+Compares the original path (copy through bytearray, full decode, resize, cvtColor, divide by
+255, convert to float32, add a batch dimension) with the current one (decode straight from the
+downloaded bytes, reduced JPEG decode, one pass of BGR to RGB swap and scaling into a
+preallocated float32 batch). Only NumPy allocations are traced; OpenCV allocates outside of
+Python's allocator.
+
+Usage: python tools/bench-preprocess.py [nm_iterations]
+"""
+
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from classification.classification import Classification
+
+
+SIZES = [(320, 240), (640, 480), (1600, 1200), (4000, 3000)]
+
+
+def _jpeg(width, height):
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([(np.sin(x / 40) + 1) * 120, (np.cos(y / 55) + 1) * 120, (x + y) % 255],
+            axis=-1).astype(np.uint8)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+def _original(data, _):
+    image_array = np.asarray(bytearray(data), dtype=np.uint8)
+    image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
+    image = cv2.resize(image, (224, 224))
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    image = image / 255
+    return np.expand_dims(image.astype(np.float32), 0)
+
+def _current(data, out):
+    image = Classification.format_image(Classification.image_array(data))
+    return Classification.fill_batch([image], out)
+
+def _bench(preprocess, data, nm_iterations):
+    out = np.empty((1, 224, 224, 3), dtype=np.float32)
+    preprocess(data, out)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = perf_counter()
+    for _ in range(nm_iterations):
+        preprocess(data, out)
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / nm_iterations, peak
+
+def main():
+    nm_iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print("{:>11} {:>8} {:>12} {:>12} {:>14} {:>14}".format("size", "KiB", "original ms",
+        "current ms", "original peak", "current peak"))
+    for width, height in SIZES:
+        data = _jpeg(width, height)
+        original_time, original_peak = _bench(_original, data, nm_iterations)
+        current_time, current_peak = _bench(_current, data, nm_iterations)
+        print("{:>11} {:>8} {:>12.3f} {:>12.3f} {:>12}KiB {:>12}KiB".format(
+            "{}x{}".format(width, height), len(data) // 1024, original_time * 1000,
+            current_time * 1000, original_peak // 1024, current_peak // 1024))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of classify_birds() against a local image server.
+
+A synthetic corpus of images of mixed sizes and formats, broken ones included, is served over
+HTTP from a temporary directory. classify_birds() is run on it in main process and
+multiprocessing mode, at task counts around multiprocessing_threshold. Every configuration runs
+in a fresh Python process, so that its peak RSS is its own. By default the model is a stub
+taking a fixed time per call, so that nothing has to be downloaded; --model runs the model of
+config.ini instead.
+
+Throughput is taken from the median time of the runs of a configuration, and latency is taken
+per image, from the start of its run to its answer.
+
+The results are written as JSON, and compared with the results of an earlier run when given
+with --baseline.
+
+Usage: python tools/benchmark.py [-o benchmark.json] [--baseline earlier.json]
+"""
+
+import argparse
+import configparser
+import functools
+import http.server
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+
+CLASSIFIER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, CLASSIFIER_DIR)
+
+
+# (file name, (width, height)) of the images in the corpus. Images without a size are broken.
+CORPUS = [
+        ("small.jpg", (320, 240)),
+        ("medium.jpg", (640, 480)),
+        ("large.jpg", (1600, 1200)),
+        ("huge.jpg", (4000, 3000)),
+        ("medium.png", (640, 480)),
+        ("large.png", (1024, 768)),
+        ("medium.webp", (800, 600)),
+        ("medium.bmp", (640, 480)),
+        ("truncated.jpg", None),
+        ("garbage.jpg", None),
+        ("empty.jpg", None),
+        ("missing.jpg", None),
+        ]
+
+
+def _image(width, height, rng):
+    y, x = np.ogrid[0:height, 0:width]
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = (np.sin(x / 40) + 1) * 120
+    image[..., 1] = (np.cos(y / 55) + 1) * 120
+    image[..., 2] = (x + y) % 255
+    return cv2.add(image, rng.integers(0, 16, image.shape, dtype=np.uint8))
+
+def _write_corpus(directory):
+    rng = np.random.default_rng(0)
+    for name, size in CORPUS:
+        if size:
+            data = cv2.imencode(os.path.splitext(name)[1], _image(*size, rng))[1].tobytes()
+        elif name == "truncated.jpg":
+            data = cv2.imencode(".jpg", _image(640, 480, rng))[1].tobytes()
+            data = data[:len(data) // 2]
+        elif name == "garbage.jpg":
+            data = rng.integers(0, 256, 4096, dtype=np.uint8).tobytes()
+        elif name == "empty.jpg":
+            data = b""
+        else:
+            continue
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+    with open(os.path.join(directory, "labels.csv"), 'w') as f:
+        f.write("id,name\n")
+        f.writelines("{},Bird {}\n".format(i, i) for i in range(965))
+
+def _serve(directory):
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        # Keep connections alive, like the hosts images are usually fetched from. Headers and
+        # body are written separately, which Nagle's algorithm would delay on a kept connection.
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+        def log_message(self, format, *args):
+            pass
+    class Server(http.server.ThreadingHTTPServer):
+        # Room for nm_downloads concurrent connections, which are otherwise refused and retried.
+        request_queue_size = 128
+    httpd = Server(("127.0.0.1", 0),
+            functools.partial(Handler, directory=directory))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, "http://{}:{}".format(*httpd.server_address[:2])
+
+def _load_args(config_path):
+    spec = importlib.util.spec_from_file_location("classifier_main",
+            os.path.join(CLASSIFIER_DIR, "__main__.py"))
+    classifier_main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(classifier_main)
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return classifier_main._get_args(config, False, False)
+
+def _peak_rss_kib():
+    # ru_maxrss is kept across exec(), so it would include the peak of the benchmark process
+    # this process was started from. VmHWM only counts this process.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def _cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def _peak_child_rss_kib():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _timed(add, start, latencies):
+    """Wrap BirdClassifierResults.add() to record the time from start to every answer."""
+
+    def timed_add(results, response):
+        latencies.append(perf_counter() - start)
+        add(results, response)
+    return timed_add
+
+def _run(run):
+    """Run a single configuration, in a process of its own, and print its measurements."""
+
+    logging.basicConfig(level=logging.CRITICAL)
+    from classification.BirdClassifier import BirdClassifierResults, classify_birds
+    from classification.classification import Tf
+    from aux.retry import configure_retry
+    from aux.url_open import configure_url_open
+
+    args = _load_args(run['config'])
+    args.update(run['overrides'])
+    args['cache_path'] = ""
+    args['multiprocessing_threshold'] = 0 if run['mode'] == "multiprocessing" else \
+            run['nm_tasks'] + 1
+    Tf.init(args['tfhub_cache_dir'])
+    configure_url_open(args['http_timeout'], args['http_max_connections_per_host'],
+            args['http2'], args['http_keep_alive'])
+    configure_retry(args['retry_max_retries'], args['retry_base_delay_ms'],
+            args['retry_max_delay_ms'], args['retry_breaker_failures'],
+            args['retry_breaker_reset_s'])
+    image_urls = [ "{}/{}".format(run['url'], run['images'][i % len(run['images'])])
+            for i in range(run['nm_tasks']) ]
+
+    times = []
+    latencies = []
+    nm_unclassified = 0
+    for _ in range(run['repeats']):
+        start = perf_counter()
+        # classify_birds() adds every answer to its results as soon as it completes.
+        with patch.object(BirdClassifierResults, 'add',
+                _timed(BirdClassifierResults.add, start, latencies)):
+            answers = classify_birds(image_urls, None, args)
+        times += [perf_counter() - start]
+        nm_unclassified = int((answers.nm_results < 0).sum())
+    print(json.dumps({
+        'times': times,
+        'latencies': latencies,
+        'nm_unclassified': nm_unclassified,
+        'peak_rss_kib': _peak_rss_kib(),
+        'peak_child_rss_kib': _peak_child_rss_kib(),
+        'cpu_s': _cpu_time(resource.RUSAGE_SELF) + _cpu_time(resource.RUSAGE_CHILDREN),
+        }))
+
+def _measure(run):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", json.dumps(run)],
+            stdout=subprocess.PIPE, check=True, cwd=CLASSIFIER_DIR).stdout
+    measured = json.loads(output)
+    times = measured.pop('times')
+    latencies = np.array(measured.pop('latencies'))
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return dict({
+        'mode': run['mode'],
+        'nm_tasks': run['nm_tasks'],
+        'repeats': run['repeats'],
+        'images_per_s': run['nm_tasks'] / np.median(times),
+        'latency_s': {'p50': p50, 'p95': p95, 'p99': p99, 'max': latencies.max()},
+        }, **measured)
+
+def _setting(setting):
+    key, value = setting.split("=", 1)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+def _compare(results, baseline):
+    earlier = { (x['mode'], x['nm_tasks']): x for x in baseline['results'] }
+    print("{:>16} {:>8} {:>12} {:>12} {:>8} {:>10}".format("mode", "tasks", "images/s",
+        "baseline", "change", "p95 change"))
+    for result in results:
+        base = earlier.get((result['mode'], result['nm_tasks']))
+        if base is None:
+            continue
+        print("{:>16} {:>8} {:>12.1f} {:>12.1f} {:>+7.1f}% {:>+9.1f}%".format(result['mode'],
+            result['nm_tasks'], result['images_per_s'], base['images_per_s'],
+            100 * (result['images_per_s'] / base['images_per_s'] - 1),
+            100 * (result['latency_s']['p95'] / base['latency_s']['p95'] - 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark classify_birds() against a local "
+            "image server.")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+            help="file to write the results to as JSON")
+    parser.add_argument("-c", "--config", default=os.path.join(CLASSIFIER_DIR, "config.ini"),
+            help="config file to take the settings from")
+    parser.add_argument("-n", "--nm-tasks", type=int, nargs='+',
+            help="task counts to run (default: around multiprocessing_threshold)")
+    parser.add_argument("-m", "--modes", nargs='+', choices=["main", "multiprocessing"],
+            default=["main", "multiprocessing"], help="modes to run")
+    parser.add_argument("-r", "--repeats", type=int, default=5,
+            help="number of runs per configuration")
+    parser.add_argument("-i", "--images", nargs='+', choices=[ name for name, _ in CORPUS ],
+            default=[ name for name, _ in CORPUS ], help="images of the corpus to classify")
+    parser.add_argument("--stub-ms", type=float, default=20,
+            help="time taken by each call of the stub model in milliseconds")
+    parser.add_argument("--model", action='store_true',
+            help="use the model and labels of the config file instead of the stub model")
+    parser.add_argument("-s", "--set", nargs='+', type=_setting, default=[],
+            metavar="KEY=VALUE", help="settings to override, e.g. http_keep_alive=false")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    cli_args = parser.parse_args()
+
+    if cli_args.run:
+        _run(json.loads(cli_args.run))
+        return
+
+    args = _load_args(cli_args.config)
+    threshold = args['multiprocessing_threshold']
+    nm_tasks = cli_args.nm_tasks or sorted({max(1, threshold // 2), max(1, threshold - 1),
+        threshold, 2 * threshold, 8 * threshold})
+
+    with tempfile.TemporaryDirectory() as directory:
+        _write_corpus(directory)
+        httpd, url = _serve(directory)
+        overrides = {} if cli_args.model else {
+                'url_model': "stub:{}".format(cli_args.stub_ms),
+                'url_labels': url + "/labels.csv",
+                }
+        overrides.update(cli_args.set)
+        results = []
+        for mode in cli_args.modes:
+            for n in nm_tasks:
+                results += [_measure({'mode': mode, 'nm_tasks': n, 'repeats': cli_args.repeats,
+                    'config': cli_args.config, 'overrides': overrides, 'url': url,
+                    'images': cli_args.images})]
+                print("{:>16} {:>6} tasks: {:8.1f} images/s, p50 {:.3f}s, p95 {:.3f}s, "
+                        "CPU {:.2f}s, peak RSS {} KiB (children {} KiB)".format(mode, n,
+                        results[-1]['images_per_s'], results[-1]['latency_s']['p50'],
+                        results[-1]['latency_s']['p95'], results[-1]['cpu_s'],
+                        results[-1]['peak_rss_kib'], results[-1]['peak_child_rss_kib']),
+                        file=sys.stderr)
+        httpd.shutdown()
+
+    with open(cli_args.output, 'w') as f:
+        json.dump({
+            'meta': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': multiprocessing.cpu_count(),
+                'model': args['url_model'] if cli_args.model else "stub:{}".format(
+                    cli_args.stub_ms),
+                'multiprocessing_threshold': threshold,
+                'batch_size': args['batch_size'],
+                'images': cli_args.images,
+                'settings': dict(cli_args.set),
+                },
+            'results': results,
+            }, f, indent=2)
+
+    if cli_args.baseline:
+        with open(cli_args.baseline) as f:
+            _compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
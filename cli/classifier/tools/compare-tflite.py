@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Compare the TFLite conversions of the model with the float32 TensorFlow model: how often they
+agree on the top N results, and how fast they are.
+
+The images of the given files of image URLs (or local image paths) are classified by the model
+of config.ini, then by its TFLite conversion at every quantization asked for, converting and
+caching it as the tflite backend does when not cached yet. For each, the table shows:
+
+* top-1: the share of images whose best result is the same as the float32 model's
+* top-N: the mean share of the float32 model's top N labels that are among its own top N
+* exact: the share of images whose top N labels are the same, in the same order
+* max diff: the largest difference of any score from the float32 model's
+* ms/image: the time of the model calls per image, after a first call to warm up
+
+Usage: python tools/compare-tflite.py [-q float16 int8] [-n 4] [-b 16] sample_42.txt
+"""
+
+import argparse
+import configparser
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+CLASSIFIER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, CLASSIFIER_DIR)
+from classification.classification import Classification, Tf
+
+
+def _load_images(paths):
+    images = []
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    image_array = Classification.image_array(f.read())
+            else:
+                image_array = Classification.load_image(path)
+            images += [Classification.format_image(image_array)]
+        except Exception:
+            print("Skipping image that cannot be loaded: {}".format(path), file=sys.stderr)
+    return images
+
+def _scores(model, images, batch_size):
+    """Get the scores of all images, and the time taken per image by the model calls."""
+    out = np.empty((batch_size, Classification.IMAGE_SIZE, Classification.IMAGE_SIZE, 3),
+            dtype=np.float32)
+    model.call(Classification.generate_tensor(images[:batch_size], out))
+    scores = []
+    elapsed = 0
+    for i in range(0, len(images), batch_size):
+        image_tensor = Classification.generate_tensor(images[i:i + batch_size], out)
+        start = perf_counter()
+        scores += [model.call(image_tensor).numpy()]
+        elapsed += perf_counter() - start
+    return np.concatenate(scores), elapsed / len(images)
+
+def _agreement(reference, scores, n):
+    reference_ids = Classification.top_n(reference, n)[0]
+    ids = Classification.top_n(scores, n)[0]
+    top_1 = (reference_ids[:, 0] == ids[:, 0]).mean()
+    top_n = np.mean([ len(np.intersect1d(a, b)) / n for a, b in zip(reference_ids, ids) ])
+    exact = (reference_ids == ids).all(axis=1).mean()
+    return top_1, top_n, exact, np.abs(reference - scores).max()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare TFLite models with the float32 model.")
+    parser.add_argument("files", nargs='+', help="files of image URLs or paths")
+    parser.add_argument("-q", "--quantizations", nargs='+',
+            choices=Classification.TFLITE_QUANTIZATIONS, default=['float16', 'int8'])
+    parser.add_argument("-n", "--nm-top-results", type=int, default=4)
+    parser.add_argument("-b", "--batch-size", type=int, default=16)
+    parser.add_argument("--nm-threads", type=int, help="threads of the TFLite interpreter")
+    cli_args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(CLASSIFIER_DIR, "config.ini"))
+    url_model = config.get('bird-classifier', 'url_model')
+    model_dir = config.get('bird-classifier', 'model_dir')
+    tfhub_cache_dir = config.get('classifier', 'tfhub_cache_dir')
+    Tf.init(tfhub_cache_dir)
+
+    paths = []
+    for name in cli_args.files:
+        with open(name) as f:
+            paths += [ line.strip() for line in f if line.strip() ]
+    images = _load_images(paths)
+    if not images:
+        sys.exit("No images to compare on")
+
+    reference, reference_time = _scores(Classification.load_model(url_model, model_dir),
+            images, cli_args.batch_size)
+    print("{} images, top {}".format(len(images), cli_args.nm_top_results))
+    print("{:>10} {:>8} {:>8} {:>8} {:>10} {:>10} {:>10}".format("model", "top-1", "top-N",
+        "exact", "max diff", "ms/image", "MiB"))
+    print("{:>10} {:>8} {:>8} {:>8} {:>10} {:>10.2f} {:>10}".format("tensorflow", "", "", "",
+        "", reference_time * 1000, ""))
+    for quantization in cli_args.quantizations:
+        path = Classification.tflite_path(url_model, quantization, tfhub_cache_dir)
+        model = Classification.load_tflite_model(url_model, model_dir, path, quantization,
+                cli_args.nm_threads)
+        scores, elapsed = _scores(model, images, cli_args.batch_size)
+        print("{:>10} {:>8.3f} {:>8.3f} {:>8.3f} {:>10.4f} {:>10.2f} {:>10.1f}".format(
+            quantization, *_agreement(reference, scores, cli_args.nm_top_results),
+            elapsed * 1000, os.path.getsize(path) / 1024**2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Test the atomic_write module."""
+
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from aux.atomic_write import atomic_write
+
+
+class AtomicWriteTestCases(unittest.TestCase):
+    """Test suite for the atomic_write module."""
+
+    def test_replaced_once_written(self):
+        """Test that the file only replaces path once it is closed, leaving nothing aside."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "a.txt")
+            with open(path, 'w') as f:
+                f.write("old")
+            with atomic_write(path) as f:
+                f.write("new")
+                f.flush()
+                with open(path) as current:
+                    self.assertEqual(current.read(), "old")
+            with open(path) as f:
+                self.assertEqual(f.read(), "new")
+            self.assertEqual(os.listdir(directory), ["a.txt"])
+
+    def test_failed_write(self):
+        """Test that a failed write leaves path as it was, and removes the file aside."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "a.bin")
+            with self.assertRaises(ValueError):
+                with atomic_write(path, 'wb') as f:
+                    f.write(b"part")
+                    raise ValueError("failed")
+            self.assertEqual(os.listdir(directory), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+"""Test the batching module."""
+
+
+import queue
+import time
+import unittest
+
+from classifier.aux.batching import get_batch
+
+
+class BatchingTestCases(unittest.TestCase):
+    """Test suite for the batching module."""
+
+    def test_returns_full_batch(self):
+        """Test that get_batch() stops collecting when batch_size items have been collected."""
+        source = queue.Queue()
+        for i in range(5):
+            source.put(i)
+        self.assertEqual(get_batch(source, 3, 1000), [0, 1, 2])
+        self.assertEqual(source.qsize(), 2)
+
+    def test_returns_partial_batch_after_wait(self):
+        """Test that get_batch() returns what it has once max_batch_wait_ms has passed."""
+        source = queue.Queue()
+        source.put(0)
+        start = time.monotonic()
+        self.assertEqual(get_batch(source, 3, 20), [0])
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_stops_at_sentinel(self):
+        """Test that get_batch() ends the batch with the stop sentinel."""
+        source = queue.Queue()
+        for item in [0, None, 1]:
+            source.put(item)
+        self.assertEqual(get_batch(source, 3, 1000, stop=None), [0, None])
+        self.assertEqual(get_batch(source, 3, 0, stop=None), [1])
+
+    def test_returns_sentinel_alone(self):
+        """Test that get_batch() returns immediately when the first item is the sentinel."""
+        source = queue.Queue()
+        source.put(None)
+        source.put(1)
+        self.assertEqual(get_batch(source, 3, 1000, stop=None), [None])
+
+    def test_bounds_total_item_size(self):
+        """Test that get_batch() stops collecting when the items add up to batch_size."""
+        source = queue.Queue()
+        for item in [[0, 1], [2], [3, 4, 5], [6]]:
+            source.put(item)
+        self.assertEqual(get_batch(source, 4, 1000, item_size=len), [[0, 1], [2], [3, 4, 5]])
+        self.assertEqual(source.qsize(), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,301 @@
+"""Test the BirdClassifier module with a stub model and fake downloads."""
+
+
+import contextlib
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import types
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+try:
+    import cv2
+    import numpy as np
+    from aux.stage_metrics import StageMetrics
+    from classification import BirdClassifier
+    from classification.classification import Classification, ClassificationFatalException
+except ImportError:
+    BirdClassifier = None
+
+
+class _Tensor:
+    """Array with the numpy() method of a tensor."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def numpy(self):
+        """Get the tensor as an array."""
+        return self.array
+
+# What the module uses of TensorFlow once the model input is made without it.
+_tf = types.SimpleNamespace(errors=types.SimpleNamespace(InvalidArgumentError=ValueError))
+
+def _args():
+    return {
+            'nm_top_results': 1,
+            'score_softmax': False,
+            'score_threshold': None,
+            'batch_size': 4,
+            'max_batch_wait_ms': 5,
+            'decode_threads': 2,
+            'decode_lookahead': 1,
+            'nm_downloads': 4,
+            'max_in_flight': 6,
+            'journal_sync_ms': 1000,
+            'task_queue_size': 16,
+            'max_chunk_size': 4,
+            'chunk_target_ms': 50,
+            'nm_workers': 2,
+            'worker_memory_mb': 1,
+            'pool_adjust_interval_ms': 2000,
+            'tf_intra_op_threads': 1,
+            'tf_inter_op_threads': 1,
+            'multiprocessing_threshold': 0,
+            'cache_path': "",
+            'url_model': "stub:0",
+            'url_labels': "fake",
+            'model_dir': None,
+            'dedup': True,
+            'dedup_perceptual': False,
+            'dedup_max_entries': 1000,
+            'dedup_perceptual_distance': 4,
+            'backend': "tensorflow",
+            'inference': "graph",
+            'time': False,
+            'profile_dir': None,
+            'tfhub_cache_dir': "",
+            'labels_ttl': 0,
+            }
+
+class _Downloads:
+    """Fake image downloads, finishing out of order, counting the tasks in flight."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nm_started = 0
+        self.nm_answered = 0
+        self.max_in_flight = 0
+
+    def fetch_image(self, image, attempt=0, block=True):
+        index = int(image.rsplit("/", 1)[1])
+        with self.lock:
+            self.nm_started += 1
+            self.max_in_flight = max(self.max_in_flight, self.nm_started - self.nm_answered)
+        time.sleep((7 - index % 7) / 1000)
+        if index % 5 == 4:
+            return b"not an image"
+        return cv2.imencode(".png", np.full((32, 32, 3), index % 256, dtype=np.uint8))[1] \
+                .tobytes()
+
+    def answered(self):
+        with self.lock:
+            self.nm_answered += 1
+
+def _patches(downloads):
+    """Get patches to classify the images of downloads with the stub model, without TensorFlow."""
+    labels = np.array([ "bird{}".format(i) for i in range(965) ])
+    generate_tensor = lambda images, out=None: _Tensor(Classification.fill_batch(images, out))
+    return [
+            patch("classification.classification.Classification.fetch_image",
+                downloads.fetch_image),
+            patch("classification.classification.Classification.load_labels",
+                return_value=labels),
+            patch("classification.classification.Classification.generate_tensor",
+                generate_tensor),
+            patch("classification.classification.Tf.get", return_value=_tf),
+            patch("classification.classification.Tf.set_threads"),
+            ]
+
+@unittest.skipIf(BirdClassifier is None, "requires numpy and opencv")
+class BirdClassifierTestCases(unittest.TestCase):
+    """Test suite for the BirdClassifier module in multiprocessing mode."""
+
+    def setUp(self):
+        self.downloads = _Downloads()
+        # Worker processes are forked, so they get the patches too.
+        self.patches = _patches(self.downloads)
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def _urls(self, nm_urls):
+        return ( "http://a/{}".format(i) for i in range(nm_urls) )
+
+    def test_stream_is_ordered(self):
+        """Test that answers come in the order of the URLs, with few tasks in flight."""
+        images = []
+        # Closed on failure too, so that the worker processes stop.
+        with contextlib.closing(BirdClassifier.classify_birds_stream(self._urls(60), None,
+                _args())) as answers:
+            for answer in answers:
+                self.downloads.answered()
+                images += [answer.image]
+                self.assertEqual(answer.label_ids is None, answer.index % 5 == 4)
+        self.assertEqual(images, list(self._urls(60)))
+        # The answer yielded is released before it is counted here.
+        self.assertLessEqual(self.downloads.max_in_flight, _args()['max_in_flight'] + 1)
+
+    def test_stream_is_unordered(self):
+        """Test that answers come as they complete when not ordered, one per URL."""
+        indices = []
+        with contextlib.closing(BirdClassifier.classify_birds_stream(self._urls(60), None,
+                _args(), ordered=False)) as answers:
+            for answer in answers:
+                self.downloads.answered()
+                indices += [answer.index]
+        self.assertEqual(sorted(indices), list(range(60)))
+        # The answer yielded is released before it is counted here.
+        self.assertLessEqual(self.downloads.max_in_flight, _args()['max_in_flight'] + 1)
+
+    def test_classify_birds(self):
+        """Test that classify_birds() answers every URL of a list in order."""
+        answers = BirdClassifier.classify_birds(list(self._urls(20)), None, _args())
+        self.assertEqual([ x.index for x in answers ], list(range(20)))
+        self.assertEqual((answers.nm_results < 0).tolist(), [ i % 5 == 4 for i in range(20) ])
+
+    def test_labels_not_loaded(self):
+        """Test that images are classified to label ids when the labels fail to load."""
+        for threshold in [0, 1000]:
+            args = dict(_args(), multiprocessing_threshold=threshold)
+            with patch("classification.classification.Classification.load_labels",
+                    side_effect=ClassificationFatalException):
+                answers = BirdClassifier.classify_birds(list(self._urls(10)), None, args)
+            self.assertEqual((answers.nm_results < 0).tolist(), [ i % 5 == 4 for i in range(10) ])
+            self.assertTrue(all(x.label_ids is not None for x in answers if x.index % 5 != 4))
+
+    def test_decode_pipeline_in_main_process(self):
+        """Test that decoding ahead of the model in threads gives the answers of no lookahead."""
+        answers = []
+        for threads, lookahead in [(0, 0), (2, 1), (3, 4)]:
+            args = dict(_args(), multiprocessing_threshold=1000, dedup=False,
+                    decode_threads=threads, decode_lookahead=lookahead)
+            answers += [BirdClassifier.classify_birds(list(self._urls(30)), None, args)]
+        for x in answers[1:]:
+            self.assertEqual(x.nm_results.tolist(), answers[0].nm_results.tolist())
+            self.assertEqual(x.label_ids.tolist(), answers[0].label_ids.tolist())
+        self.assertEqual((answers[0].nm_results < 0).tolist(), [ i % 5 == 4 for i in range(30) ])
+
+    def test_stage_metrics(self):
+        """Test that the stages timed by all processes are merged, and that workers profile."""
+        metrics = StageMetrics()
+        with tempfile.TemporaryDirectory() as profile_dir:
+            args = dict(_args(), dedup=False, profile_dir=profile_dir)
+            BirdClassifier.classify_birds(list(self._urls(20)), None, args, metrics)
+            self.assertEqual(sorted(os.listdir(profile_dir)), [ name + ".prof" for name in
+                ["BirdClassifierServer", "BirdClassifierWorker-0", "BirdClassifierWorker-1"] ])
+        counts = { stage: x.count for stage, x in metrics.histograms.items() }
+        self.assertEqual(counts['fetch'], 20)
+        # The bad data of every fifth image is timed as well, but not resized.
+        self.assertEqual(counts['decode'], 20)
+        self.assertEqual(counts['resize'], 16)
+        self.assertGreater(counts['model'], 0)
+        self.assertEqual(counts['tensor'], counts['model'])
+        self.assertEqual(counts['scoring'], counts['model'])
+
+    def test_resume(self):
+        """Test that a resumed run only classifies the URLs not journaled, and merges the rest."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.journal")
+            args = dict(_args(), dedup=False)
+            journal = BirdClassifier.open_journal(path, args)
+            BirdClassifier.classify_birds(list(self._urls(12)), None, args, journal=journal)
+            journal.close()
+            expected = BirdClassifier.classify_birds(list(self._urls(30)), None, args)
+            self.downloads.nm_started = 0
+            journal = BirdClassifier.open_journal(path, args, resume=True)
+            answers = BirdClassifier.classify_birds(list(self._urls(30)), None, args,
+                    journal=journal)
+            journal.close()
+            # The images that could not be classified are tried again.
+            self.assertEqual(self.downloads.nm_started, 18 + 2)
+            self.assertEqual(answers.nm_results.tolist(), expected.nm_results.tolist())
+            self.assertEqual(answers.label_ids.tolist(), expected.label_ids.tolist())
+            ids = lambda x: None if x.label_ids is None else x.label_ids.tolist()
+            # 10 new URLs and 6 failed the first time, then the 8 failed of all 40.
+            for ordered, nm_started in [(True, 16), (False, 8)]:
+                self.downloads.nm_started = 0
+                journal = BirdClassifier.open_journal(path, args, resume=True)
+                with contextlib.closing(BirdClassifier.classify_birds_stream(self._urls(40),
+                        None, args, ordered, journal=journal)) as stream:
+                    streamed = list(stream)
+                journal.close()
+                self.assertEqual(self.downloads.nm_started, nm_started)
+                indices = [ x.index for x in streamed ]
+                self.assertEqual(indices if ordered else sorted(indices), list(range(40)))
+                for x in streamed:
+                    if x.index < 30:
+                        self.assertEqual(ids(x), ids(expected[x.index]))
+
+    def _duplicate_urls(self):
+        # Images 1280 up are the same as 0 up; the second half repeats the URLs of the first.
+        urls = [ "http://a/{}".format(i % 10 + 1280 * (i // 10)) for i in range(20) ]
+        return urls + urls
+
+    def test_duplicates_in_main_process(self):
+        """Test that an image is only downloaded once per URL and decoded once per content."""
+        args = dict(_args(), multiprocessing_threshold=1000)
+        with patch("classification.classification.Classification.format_image",
+                side_effect=Classification.format_image) as format_image:
+            answers = BirdClassifier.classify_birds(self._duplicate_urls(), None, args)
+        self.assertEqual(self.downloads.nm_started, 20)
+        # 8 images, and the bad data of all URLs ending in 4 or 9.
+        self.assertEqual(format_image.call_count, 9)
+        for answer in answers:
+            first = answers[answer.index % 10]
+            self.assertEqual(answer.label_ids is None, answer.index % 5 == 4)
+            if answer.label_ids is not None:
+                self.assertEqual(answer.label_ids.tolist(), first.label_ids.tolist())
+
+    def test_duplicates(self):
+        """Test that duplicates are answered like the first of them in multiprocessing mode."""
+        answers = BirdClassifier.classify_birds(self._duplicate_urls(), None, _args())
+        self.assertEqual(self.downloads.nm_started, 20)
+        self.assertEqual((answers.nm_results < 0).tolist(), [ i % 5 == 4 for i in range(40) ])
+        for i in range(40):
+            self.assertEqual(answers.label_ids[i].tolist(), answers.label_ids[i % 10].tolist())
+
+    def test_perceptual_duplicates(self):
+        """Test that images looking the same are classified once, flat ones always."""
+        args = dict(_args(), dedup_perceptual=True)
+        classifier = BirdClassifier._BirdClassifier(args)
+        y, x = np.mgrid[0:224, 0:224]
+        image = np.stack([x, y, x + y], axis=-1).astype(np.uint8)
+        images = [image, np.clip(image + 1, 0, 255), np.zeros_like(image),
+                np.full_like(image, 255), image]
+        tasks = [ BirdClassifier._BirdClassifierTask(i, str(i)) for i in range(5) ]
+        model = Classification.load_model("stub:0")
+        with patch.object(classifier, "classify", wraps=classifier.classify) as classify:
+            responses = classifier.respond(tasks, images, model)
+            self.assertEqual(len(classify.call_args[0][0]), 3)
+            classifier.respond(tasks[:1], images[:1], model)
+            self.assertEqual(classify.call_count, 1)
+        self.assertEqual(responses[1].label_ids.tolist(), responses[0].label_ids.tolist())
+        self.assertEqual(classifier.nm_perceptual_duplicates, 3)
+
+    def test_stream_closed_early(self):
+        """Test that a process leaving a stream after its first answer still exits."""
+        script = textwrap.dedent("""
+            import test_bird_classifier as t
+            case = t.BirdClassifierTestCases()
+            case.setUp()
+            answers = t.BirdClassifier.classify_birds_stream(case._urls(500), None, t._args())
+            next(answers)
+            answers.close()
+            """)
+        for _ in range(3):
+            subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(__file__),
+                    check=True, timeout=30, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+
+if __name__ == "__main__":
+    unittest.main()
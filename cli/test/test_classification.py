@@ -0,0 +1,261 @@
+"""Test the classification module."""
+
+
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+try:
+    import cv2
+    import numpy as np
+    from aux.stage_metrics import StageMetrics
+    from aux.url_open import UrlOpenFatalException
+    from classification.classification import (Classification, ClassificationFatalException,
+            CompiledModel, StubModel, TfLiteModel)
+except ImportError:
+    Classification = None
+
+
+class _Tensor:
+    """Array with the numpy() method of a tensor."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def numpy(self):
+        """Get the tensor as an array."""
+        return self.array
+
+def _jpeg(width, height, progressive=False):
+    """Encode a JPEG image of the given size."""
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    ok, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive)])
+    return data.ravel()
+
+class _Interpreter:
+    """Fake TFLite interpreter, summing the pixels of each image."""
+
+    def __init__(self, model_path, num_threads=None):
+        self.nm_allocations = 0
+
+    def get_input_details(self):
+        return [{'index': 0}]
+
+    def get_output_details(self):
+        return [{'index': 1}]
+
+    def resize_tensor_input(self, index, shape):
+        self.shape = shape
+
+    def allocate_tensors(self):
+        self.nm_allocations += 1
+
+    def set_tensor(self, index, value):
+        assert value.shape == self.shape
+        self.input = value
+
+    def invoke(self):
+        self.output = self.input.sum(axis=(1, 2))
+
+    def get_tensor(self, index):
+        return self.output
+
+class _Response:
+    """Response to a request for a label map."""
+
+    def __init__(self, code, data=b""):
+        self.code = code
+        self.data = data
+        self.headers = {'ETag': '"v1"'}
+
+    def getcode(self):
+        return self.code
+
+    def read(self):
+        return self.data
+
+class _Function:
+    """Function traced by a fake TensorFlow, keeping the size of every batch it is called on."""
+
+    def __init__(self, function, input_signature, jit_compile):
+        self.function = function
+        self.input_signature = input_signature
+        self.jit_compile = jit_compile
+        self.batch_sizes = []
+
+    def __call__(self, images):
+        self.batch_sizes += [len(images.numpy())]
+        return self.function(images)
+
+def _fake_tf(model, function=_Function):
+    return types.SimpleNamespace(function=function, float32=np.float32,
+            TensorSpec=lambda shape, dtype: (shape, dtype),
+            zeros=lambda shape, dtype: _Tensor(np.zeros(shape, dtype)),
+            saved_model=types.SimpleNamespace(load=lambda path: model))
+
+@unittest.skipIf(Classification is None, "requires numpy and opencv")
+class ClassificationTestCases(unittest.TestCase):
+    """Test suite for the classification module."""
+
+    def test_stub_model(self):
+        """Test that the stub model gives the same scores for the same images."""
+        model = Classification.load_model("stub:0")
+        images = np.random.default_rng(0).random((3, 224, 224, 3), dtype=np.float32)
+        scores = model.call(_Tensor(images)).numpy()
+        self.assertEqual(scores.shape, (3, model.NM_CLASSES))
+        np.testing.assert_array_equal(scores, Classification.load_model("stub:0").call(_Tensor(
+            images)).numpy())
+
+    def test_invalid_stub_model(self):
+        """Test that a stub model without a valid cost fails to load."""
+        with self.assertRaises(ClassificationFatalException):
+            Classification.load_model("stub:fast")
+
+    @patch("classification.classification.Classification._exported_model_format",
+            return_value='saved_model')
+    def test_compiled_model(self, _):
+        """Test that a model is traced with a fixed signature and warmed up when loaded."""
+        stub = StubModel(0)
+        images = np.random.default_rng(0).random((3, 224, 224, 3), dtype=np.float32)
+        with patch("classification.classification.Tf.get", return_value=_fake_tf(stub)):
+            self.assertIs(Classification.load_model("http://a/model", "dir", 'eager'), stub)
+            model = Classification.load_model("http://a/model", "dir", 'xla', 16)
+            self.assertIsInstance(model, CompiledModel)
+            self.assertEqual(model.function.input_signature, [([None, 224, 224, 3], np.float32)])
+            self.assertTrue(model.function.jit_compile)
+            np.testing.assert_array_equal(model.call(_Tensor(images)).numpy(),
+                    stub.call(_Tensor(images)).numpy())
+        self.assertEqual(model.function.batch_sizes, [16, 3])
+
+    @patch("classification.classification.Classification._exported_model_format",
+            return_value='saved_model')
+    def test_compiled_model_fails(self, _):
+        """Test that a model that cannot be traced is called eagerly."""
+        stub = StubModel(0)
+        def function(f, input_signature, jit_compile):
+            raise ValueError("cannot trace")
+        with patch("classification.classification.Tf.get",
+                return_value=_fake_tf(stub, function)):
+            self.assertIs(Classification.load_model("http://a/model", "dir", 'graph'), stub)
+
+    def test_top_n_results(self):
+        """Test that the best scores are returned in order, above the threshold."""
+        labels = np.array(["a", "b", "c", "d"])
+        results = Classification.top_n_results([[0.1, 0.4, 0.3, 0.2]], labels, 3, threshold=0.25)
+        self.assertEqual([ x.name for x in results[0] ], ["b", "c"])
+
+    def test_jpeg_size(self):
+        """Test that the size of baseline and progressive JPEGs is read from their header."""
+        self.assertEqual(Classification.jpeg_size(_jpeg(640, 480)), (640, 480))
+        self.assertEqual(Classification.jpeg_size(_jpeg(300, 2000, progressive=True)),
+                (300, 2000))
+
+    def test_jpeg_size_not_jpeg(self):
+        """Test that images that are not JPEGs, or are cut short, have no JPEG size."""
+        ok, png = cv2.imencode(".png", np.zeros((10, 10, 3), dtype=np.uint8))
+        self.assertIsNone(Classification.jpeg_size(png.ravel()))
+        self.assertIsNone(Classification.jpeg_size(np.frombuffer(b"", dtype=np.uint8)))
+        jpeg = _jpeg(640, 480)
+        for length in [2, 3, 20, 100]:
+            self.assertIsNone(Classification.jpeg_size(jpeg[:length]))
+
+    def test_reduced_decode(self):
+        """Test that a large JPEG decoded at a reduced size is formatted like a small one."""
+        image = Classification.format_image(_jpeg(4000, 3000))
+        self.assertEqual(image.shape, (224, 224, 3))
+
+    def test_undecodable_image(self):
+        """Test that data that is not an image cannot be formatted, and is timed as a decode."""
+        metrics = StageMetrics()
+        for data in [b"not an image", b"", _jpeg(640, 480)[:100].tobytes()]:
+            with self.assertRaises(ClassificationFatalException):
+                Classification.format_image(Classification.image_array(data), metrics)
+        self.assertEqual(metrics.histograms['decode'].count, 3)
+        self.assertEqual(metrics.histograms['resize'].count, 0)
+
+    def test_fill_batch(self):
+        """Test that a batch holds the same pixels as converting each image to RGB and scaling."""
+        images = [ np.random.default_rng(i).integers(0, 256, (224, 224, 3), dtype=np.uint8)
+                for i in range(3) ]
+        expected = np.multiply(np.stack([ cv2.cvtColor(x, cv2.COLOR_BGR2RGB) for x in images ]),
+                np.float32(1 / 255), dtype=np.float32)
+        out = np.zeros((5, 224, 224, 3), dtype=np.float32)
+        batch = Classification.fill_batch(images, out)
+        self.assertEqual(batch.shape, (3, 224, 224, 3))
+        np.testing.assert_array_equal(batch, expected)
+        np.testing.assert_array_max_ulp(batch, np.stack([ cv2.cvtColor(x, cv2.COLOR_BGR2RGB)
+            for x in images ]).astype(np.float32) / 255, maxulp=1)
+        np.testing.assert_array_equal(Classification.fill_batch(images), expected)
+
+    def test_tflite_path(self):
+        """Test that TFLite models are cached next to the TF Hub cache, by URL and quantization."""
+        path = Classification.tflite_path("http://a/model", "int8", "/cache/tfhub_modules/")
+        self.assertTrue(path.startswith("/cache/tflite/"))
+        self.assertTrue(path.endswith("-int8.tflite"))
+        self.assertNotEqual(path, Classification.tflite_path("http://a/model", "float16",
+            "/cache/tfhub_modules"))
+        self.assertNotEqual(path, Classification.tflite_path("http://b/model", "int8",
+            "/cache/tfhub_modules"))
+
+    @patch("classification.classification.TfLiteModel")
+    @patch("classification.classification.Classification.convert_tflite")
+    def test_tflite_converted_once(self, convert_tflite, tflite_model):
+        """Test that a TFLite model is only converted when it is not cached yet."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.tflite")
+            convert_tflite.side_effect = lambda url, model_dir, path, quantization: \
+                    open(path, 'wb').close()
+            for _ in range(2):
+                Classification.load_tflite_model("http://a/model", None, path, "float16", 2)
+            convert_tflite.assert_called_once_with("http://a/model", None, path, "float16")
+            tflite_model.assert_called_with(path, 2)
+        self.assertIsInstance(Classification.load_tflite_model("stub:0", None, path, "int8"),
+                type(Classification.load_model("stub:0")))
+
+    def test_tflite_model(self):
+        """Test that the TFLite input is only resized when the batch size changes."""
+        runtime = types.ModuleType("tflite_runtime")
+        runtime.interpreter = types.SimpleNamespace(Interpreter=_Interpreter)
+        with patch.dict(sys.modules, {'tflite_runtime': runtime,
+                'tflite_runtime.interpreter': runtime.interpreter}):
+            model = TfLiteModel("model.tflite")
+        images = np.ones((4, 224, 224, 3), dtype=np.float32)
+        for batch in [images, images, images[:2]]:
+            scores = model.call(_Tensor(batch)).numpy()
+            np.testing.assert_array_equal(scores, np.full((len(batch), 3), 224 * 224))
+        self.assertEqual(model.interpreter.nm_allocations, 2)
+
+    def test_parse_labels(self):
+        """Test that labels are indexed by their id, with names missing for ids left out."""
+        labels = Classification.parse_labels(b"id,name\n0,a\n2,c,x\n\n")
+        self.assertEqual(labels.tolist(), ["a", "", "c"])
+
+    @patch("classification.classification.url_open")
+    def test_labels_cache(self, url_open):
+        """Test that cached labels are only revalidated when stale, and load offline."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = Classification.labels_path("http://a/labels.csv", directory + "/tfhub")
+            self.assertTrue(path.startswith(os.path.join(directory, "labels", "")))
+            url_open.return_value = _Response(200, b"id,name\n0,a\n1,b\n")
+            labels = Classification.load_labels("http://a/labels.csv", path, 60)
+            self.assertEqual(labels.tolist(), ["a", "b"])
+            url_open.reset_mock()
+            self.assertEqual(Classification.load_labels("http://a/labels.csv", path, 60)
+                    .tolist(), ["a", "b"])
+            url_open.assert_not_called()
+            url_open.return_value = _Response(304)
+            self.assertEqual(Classification.load_labels("http://a/labels.csv", path, 0)
+                    .tolist(), ["a", "b"])
+            url_open.assert_called_once_with("http://a/labels.csv", {'If-None-Match': '"v1"'})
+            url_open.side_effect = UrlOpenFatalException
+            self.assertEqual(Classification.load_labels("http://a/labels.csv", path, 0)
+                    .tolist(), ["a", "b"])
+            with self.assertRaises(ClassificationFatalException):
+                Classification.load_labels("http://b/labels.csv", path, 60)
+
+if __name__ == "__main__":
+    unittest.main()
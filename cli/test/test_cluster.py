@@ -0,0 +1,129 @@
+"""Test the BirdClassifierCluster module with local worker processes."""
+
+
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+sys.path.insert(0, os.path.dirname(__file__))
+import test_bird_classifier as base
+try:
+    from classification import BirdClassifier, BirdClassifierCluster
+except ImportError:
+    BirdClassifierCluster = None
+
+
+def _args():
+    return dict(base._args(), dedup=False, cluster_chunk_size=4, cluster_chunks_per_worker=2,
+            cluster_heartbeat_s=0.1, cluster_worker_timeout_s=10)
+
+def _ids(answer):
+    return None if answer.label_ids is None else answer.label_ids.tolist()
+
+@unittest.skipIf(BirdClassifierCluster is None or base.BirdClassifier is None,
+        "requires numpy and opencv")
+class BirdClassifierClusterTestCases(unittest.TestCase):
+    """Test suite for the BirdClassifierCluster module."""
+
+    def setUp(self):
+        # Worker processes are forked, so they get the patches too.
+        self.patches = base._patches(base._Downloads())
+        for p in self.patches:
+            p.start()
+        self.coordinator = BirdClassifierCluster._BirdClassifierCoordinator(_args(),
+                "127.0.0.1", 0)
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                worker.terminate()
+        for p in self.patches:
+            p.stop()
+
+    def _start_workers(self, nm_workers):
+        for _ in range(nm_workers):
+            self.workers += [multiprocessing.Process(target=BirdClassifierCluster.run_worker,
+                args=(_args(), *self.coordinator.address))]
+            self.workers[-1].start()
+
+    def _classify(self, nm_urls, ordered=True):
+        """Classify in a thread, as the coordinator only answers workers while classifying."""
+        answers = []
+        thread = threading.Thread(target=lambda: answers.extend(self.coordinator.classify(
+            self._urls(nm_urls), ordered)))
+        thread.start()
+        return thread, answers
+
+    def _urls(self, nm_urls):
+        return [ "http://a/{}".format(i) for i in range(nm_urls) ]
+
+    def test_workers(self):
+        """Test that several workers answer every URL once, like a single process, in order."""
+        expected = BirdClassifier.classify_birds(self._urls(40), None, _args())
+        for ordered in [True, False]:
+            self.coordinator = BirdClassifierCluster._BirdClassifierCoordinator(_args(),
+                    "127.0.0.1", 0)
+            self._start_workers(3)
+            answers = list(self.coordinator.classify(self._urls(40), ordered))
+            indices = [ x.index for x in answers ]
+            self.assertEqual(indices if ordered else sorted(indices), list(range(40)))
+            for x in answers:
+                self.assertEqual(x.image, "http://a/{}".format(x.index))
+                self.assertEqual(_ids(x), _ids(expected[x.index]))
+            for worker in self.workers:
+                worker.join(timeout=30)
+                self.assertEqual(worker.exitcode, 0)
+
+    def _join_fake_worker(self):
+        fake = socket.create_connection(self.coordinator.address)
+        reader, writer = fake.makefile('r'), fake.makefile('w')
+        writer.write(BirdClassifierCluster._line({'hello': BirdClassifierCluster.PROTOCOL_VERSION,
+            'signature': BirdClassifier._signature(_args())}))
+        writer.flush()
+        return fake, reader, writer
+
+    def test_lost_worker(self):
+        """Test that the URLs a worker did not answer are handed out again when it is lost."""
+        for silent in [False, True]:
+            args = dict(_args(), cluster_worker_timeout_s=0.5)
+            self.coordinator = BirdClassifierCluster._BirdClassifierCoordinator(args,
+                    "127.0.0.1", 0)
+            fake, reader, writer = self._join_fake_worker()
+            thread, answers = self._classify(40)
+            self.assertTrue(json.loads(reader.readline())['welcome'])
+            # Alone, it is handed the first two chunks.
+            chunks = [ json.loads(reader.readline()) for _ in range(2) ]
+            self.assertEqual(chunks[1]['urls'], self._urls(8)[4:])
+            writer.write(BirdClassifierCluster._line({'chunk': chunks[0]['chunk'], 'offset': 1,
+                'label_ids': [964], 'scores': [9.0]}))
+            writer.flush()
+            # Killed, or stuck without even a heartbeat.
+            if not silent:
+                fake.close()
+            self._start_workers(2)
+            thread.join(timeout=60)
+            fake.close()
+            self.assertEqual([ x.index for x in answers ], list(range(40)))
+            # Answered once, by the lost worker.
+            self.assertEqual(_ids(answers[1]), [964])
+            self.assertEqual(sum(x.label_ids is None for x in answers), 8)
+
+    def test_rejected_worker(self):
+        """Test that a worker with another model or settings cannot join."""
+        thread, answers = self._classify(8)
+        with self.assertRaises(BirdClassifierCluster.BirdClassifierClusterException):
+            BirdClassifierCluster.run_worker(dict(_args(), nm_top_results=2),
+                    *self.coordinator.address)
+        self._start_workers(1)
+        thread.join(timeout=60)
+        self.assertEqual(len(answers), 8)
+
+if __name__ == "__main__":
+    unittest.main()
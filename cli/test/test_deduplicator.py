@@ -0,0 +1,79 @@
+"""Test the Deduplicator module."""
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+try:
+    import numpy as np
+    from classification.Deduplicator import Deduplicator, PerceptualIndex
+except ImportError:
+    Deduplicator = None
+
+
+class _Task:
+    def __init__(self, index):
+        self.index = index
+        self.label_ids = None
+        self.scores = None
+
+class _Response:
+    def __init__(self, index, label_ids):
+        self.index = index
+        self.label_ids = label_ids
+        self.scores = None if label_ids is None else np.ones(len(label_ids), dtype=np.float32)
+
+@unittest.skipIf(Deduplicator is None, "requires numpy")
+class DeduplicatorTestCases(unittest.TestCase):
+    """Test suite for the Deduplicator module."""
+
+    def test_duplicates_get_first_answer(self):
+        """Test that duplicates wait for the answer to the first task, or get it when known."""
+        dedup = Deduplicator(10)
+        tasks = [ _Task(i) for i in range(3) ]
+        self.assertEqual(dedup.add(tasks[0], "a", "URL"), Deduplicator.NEW)
+        self.assertEqual(dedup.add(tasks[1], "a", "URL"), Deduplicator.WAITING)
+        answered = dedup.answer(_Response(0, np.array([7], dtype=np.int32)))
+        self.assertEqual(answered, [tasks[1]])
+        self.assertEqual(tasks[1].label_ids.tolist(), [7])
+        self.assertEqual(dedup.add(tasks[2], "a", "URL"), Deduplicator.ANSWERED)
+        self.assertEqual(tasks[2].label_ids.tolist(), [7])
+        self.assertEqual(dedup.nm_duplicates["URL"], 2)
+        self.assertEqual(str(dedup), "2 duplicate(s) saved: 2 by URL")
+
+    def test_answers_chain(self):
+        """Test that a duplicate by content passes its answer on to its duplicates by URL."""
+        dedup = Deduplicator(10)
+        tasks = [ _Task(i) for i in range(3) ]
+        dedup.add(tasks[0], "hash", "content")
+        dedup.add(tasks[1], "b", "URL")
+        dedup.add(tasks[2], "b", "URL")
+        self.assertEqual(dedup.add(tasks[1], "hash", "content"), Deduplicator.WAITING)
+        self.assertEqual(dedup.answer(_Response(0, None)), [tasks[1], tasks[2]])
+        self.assertEqual(dedup.answer(_Response(1, None)), [])
+
+    def test_forgotten_key_is_new(self):
+        """Test that a task whose first task is forgotten is classified again."""
+        dedup = Deduplicator(1)
+        for i, key in enumerate(["a", "b"]):
+            dedup.add(_Task(i), key, "URL")
+            dedup.answer(_Response(i, None))
+        self.assertEqual(dedup.add(_Task(2), "a", "URL"), Deduplicator.NEW)
+
+    def test_perceptual_index(self):
+        """Test that hashes differing in few bits find the same answer, and that old ones go."""
+        index = PerceptualIndex(2, 2)
+        self.assertIsNone(index.find(0b1111))
+        index.add(0b1111, "a")
+        index.add(0xFF00, "b")
+        self.assertEqual(index.find(0b1100), "a")
+        self.assertEqual(index.find(0xF000), None)
+        self.assertEqual(index.find(0xFF01), "b")
+        index.add(0xFFFF0000, "c")
+        self.assertIsNone(index.find(0b1111))
+        self.assertEqual(PerceptualIndex.distance(0b1010, 0b0101), 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Test the http_pool module against a local keep-alive server."""
+
+
+import http.server
+import importlib.util
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from aux.http_pool import HttpPool
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/image")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"image" if self.path == "/image" else b""
+        self.send_response(200 if body else 404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        self.nm_connections = 0
+
+    def get_request(self):
+        self.nm_connections += 1
+        return http.server.ThreadingHTTPServer.get_request(self)
+
+class HttpPoolTestCases(unittest.TestCase):
+    """Test suite for the http_pool module."""
+
+    def setUp(self):
+        self.server = _Server()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://{}:{}".format(*self.server.server_address[:2])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_connection_is_reused(self):
+        """Test that requests to the same host share a connection."""
+        pool = HttpPool(timeout=5)
+        for _ in range(5):
+            response = pool.get(self.url + "/image")
+            self.assertEqual((response.getcode(), response.read()), (200, b"image"))
+        self.assertEqual(self.server.nm_connections, 1)
+
+    def test_redirect_is_followed(self):
+        """Test that a redirect is followed to the image."""
+        response = HttpPool(timeout=5).get(self.url + "/redirect")
+        self.assertEqual(response.read(), b"image")
+        self.assertEqual(response.url, self.url + "/image")
+
+    def test_error_status_is_returned(self):
+        """Test that an error status is returned rather than raised."""
+        self.assertEqual(HttpPool(timeout=5).get(self.url + "/missing").getcode(), 404)
+
+    def test_hung_host_times_out(self):
+        """Test that a host accepting a connection but never answering fails the request."""
+        with socket.socket() as hung:
+            hung.bind(("127.0.0.1", 0))
+            hung.listen()
+            with self.assertRaises(OSError):
+                HttpPool(timeout=0.2).get("http://{}:{}/image".format(*hung.getsockname()))
+
+    def test_not_http(self):
+        """Test that URLs that are not HTTP(S) are rejected."""
+        with self.assertRaises(ValueError):
+            HttpPool().get("file:///etc/hosts")
+
+    @unittest.skipIf(importlib.util.find_spec("httpx") and importlib.util.find_spec("h2"),
+            "httpx and h2 are installed")
+    def test_http2_falls_back(self):
+        """Test that HTTP/1.1 is used when the packages HTTP/2 needs are missing."""
+        with self.assertLogs(level='WARNING'):
+            pool = HttpPool(timeout=5, http2=True)
+        self.assertFalse(pool.http2)
+        self.assertEqual(pool.get(self.url + "/image").read(), b"image")
+
+if __name__ == "__main__":
+    unittest.main()
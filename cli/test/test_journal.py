@@ -0,0 +1,81 @@
+"""Test the Journal module."""
+
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+try:
+    import numpy as np
+    from classification.Journal import Journal, JournalException
+except ImportError:
+    Journal = None
+
+
+@unittest.skipIf(Journal is None, "requires numpy")
+class JournalTestCases(unittest.TestCase):
+    """Test suite for the Journal module."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "run.journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, journal, nm_answers):
+        for i in range(nm_answers):
+            journal.write("http://a/{}".format(i), np.array([i, 7], dtype=np.int32),
+                    np.array([0.1 * i, 1 / 3], dtype=np.float32))
+
+    def test_resume(self):
+        """Test that the answers journaled are found when resuming, exactly as written."""
+        journal = Journal(self.path, "model")
+        self._write(journal, 3)
+        journal.close()
+        journal = Journal(self.path, "model", resume=True)
+        self.assertIsNone(journal.find("http://a/3"))
+        label_ids, scores = journal.find("http://a/2")
+        self.assertEqual(label_ids.tolist(), [2, 7])
+        self.assertEqual(scores.tolist(), np.array([0.2, 1 / 3], dtype=np.float32).tolist())
+        self._write(journal, 5)
+        journal.close()
+        for resume, nm_answers in [(True, 5), (False, 0), (True, 0)]:
+            journal = Journal(self.path, "model", resume=resume)
+            self.assertEqual(len(journal.answers), nm_answers)
+            journal.close()
+
+    def test_resume_after_crash(self):
+        """Test that a line cut short by a crash is dropped, and the journal appended to after."""
+        journal = Journal(self.path, "model")
+        self._write(journal, 2)
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('["http://a/9",[1')
+        journal = Journal(self.path, "model", resume=True)
+        self.assertEqual(sorted(journal.answers), ["http://a/0", "http://a/1"])
+        journal.write("http://a/9", np.array([1], dtype=np.int32), np.array([1], dtype=np.float32))
+        journal.close()
+        journal = Journal(self.path, "model", resume=True)
+        self.assertEqual(len(journal.answers), 3)
+        journal.close()
+
+    def test_other_signature(self):
+        """Test that a journal written with other settings cannot be resumed."""
+        Journal(self.path, "model-1").close()
+        with self.assertRaises(JournalException):
+            Journal(self.path, "model-2", resume=True)
+
+    def test_syncs_batched(self):
+        """Test that writes are synced to disk once per interval, not once per answer."""
+        with patch("classification.Journal.os.fsync") as fsync:
+            journal = Journal(self.path, "model", sync_interval_ms=60000)
+            self._write(journal, 100)
+            journal.close()
+        self.assertEqual(fsync.call_count, 2)
+
+if __name__ == "__main__":
+    unittest.main()
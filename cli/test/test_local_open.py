@@ -0,0 +1,103 @@
+"""Test the local_open module."""
+
+
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from aux.local_open import expand, is_local, local_read, local_version
+
+
+class LocalOpenTestCases(unittest.TestCase):
+    """Test suite for the local_open module."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dir = self.directory.name
+        self.images = { "b.jpg": b"image b", "a.png": b"image a" * 100, "c/d.jpg": b"image d" }
+        for name, data in self.images.items():
+            self._write(name, data)
+        self._write("notes.txt", b"not an image")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, name, data):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _tar(self, name):
+        path = os.path.join(self.dir, name)
+        with tarfile.open(path, 'w') as tar:
+            for member, data in self.images.items():
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return path
+
+    def _zip(self, name, compression):
+        path = os.path.join(self.dir, name)
+        with zipfile.ZipFile(path, 'w', compression) as archive:
+            for member, data in self.images.items():
+                archive.writestr(member, data)
+        return path
+
+    def test_is_local(self):
+        """Test that paths and file:// URLs are local, and other URLs are not."""
+        self.assertTrue(is_local("images/1.jpg"))
+        self.assertTrue(is_local("/images/1.jpg"))
+        self.assertTrue(is_local("file:///images/1.jpg"))
+        self.assertFalse(is_local("http://a/1.jpg"))
+        self.assertFalse(is_local("https://a/1.jpg"))
+
+    def test_expand(self):
+        """Test that directories and globs stand for the images they hold, in sorted order."""
+        self.assertEqual(list(expand("http://a/*.jpg")), ["http://a/*.jpg"])
+        self.assertEqual(list(expand(self.dir)), [ os.path.join(self.dir, x)
+            for x in ["a.png", "b.jpg", "c/d.jpg"] ])
+        self.assertEqual(list(expand(os.path.join(self.dir, "*.jpg"))),
+                [os.path.join(self.dir, "b.jpg")])
+        self.assertEqual(list(expand(os.path.join(self.dir, "none*.jpg"))), [])
+        self.assertEqual(list(expand(os.path.join(self.dir, "missing.jpg"))),
+                [os.path.join(self.dir, "missing.jpg")])
+
+    def test_read_archives(self):
+        """Test that the images of tar and zip archives are listed and read, stored or not."""
+        for path in [self._tar("images.tar"), self._zip("stored.zip", zipfile.ZIP_STORED),
+                self._zip("deflated.zip", zipfile.ZIP_DEFLATED)]:
+            names = list(expand(path))
+            self.assertEqual(names, [ path + "/" + x for x in self.images ])
+            self.assertEqual([ local_read(x) for x in names ], list(self.images.values()))
+            self.assertEqual(local_read("file://" + names[0]), self.images["b.jpg"])
+            with self.assertRaises(FileNotFoundError):
+                local_read(path + "/missing.jpg")
+        self.assertEqual(len(list(expand(self.dir))), 3 + 3 * len(self.images))
+
+    def test_broken_archive(self):
+        """Test that a broken archive stands for no images, and that its images fail to read."""
+        path = self._write("broken.zip", b"not a zip")
+        self.assertEqual(list(expand(path)), [])
+        with self.assertRaises(OSError):
+            local_read(path + "/b.jpg")
+
+    def test_version(self):
+        """Test that the version of an image changes with the image."""
+        path = os.path.join(self.dir, "b.jpg")
+        version = local_version(path)
+        self._write("b.jpg", b"another image")
+        self.assertNotEqual(local_version(path), version)
+        tar = self._tar("images.tar")
+        self.assertNotEqual(local_version(tar + "/b.jpg"), local_version(tar + "/a.png"))
+        with self.assertRaises(OSError):
+            local_version(os.path.join(self.dir, "missing.jpg"))
+
+if __name__ == "__main__":
+    unittest.main()
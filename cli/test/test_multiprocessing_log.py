@@ -0,0 +1,90 @@
+"""Test the MultiprocessingLog module."""
+
+
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from aux.MultiprocessingLog import MultiprocessingLog
+
+
+def _log_records(name, nm_records):
+    logger = logging.getLogger(name)
+    for i in range(nm_records):
+        logger.debug("child %d", i)
+
+class MultiprocessingLogTestCases(unittest.TestCase):
+    """Test suite for the MultiprocessingLog module."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "classifier.log")
+        self.logger = logging.getLogger("test_multiprocessing_log")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.directory.cleanup()
+
+    def _handler(self, **kwargs):
+        handler = MultiprocessingLog(self.path, "w+", 0, 0, **kwargs)
+        handler.setFormatter(logging.Formatter("%(processName)s %(message)s"))
+        self.logger.addHandler(handler)
+        return handler
+
+    def _lines(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def test_records_of_all_processes(self):
+        """Test that the records of the process and of a forked one are all written, in order."""
+        handler = self._handler(batch_size=8)
+        for i in range(20):
+            self.logger.debug("parent %d", i)
+        child = multiprocessing.Process(target=_log_records, args=(self.logger.name, 30),
+                name="Child")
+        child.start()
+        child.join()
+        handler.close()
+        lines = self._lines()
+        self.assertEqual([ x for x in lines if x.startswith("MainProcess") ],
+                [ "MainProcess parent {}".format(i) for i in range(20) ])
+        self.assertEqual([ x for x in lines if x.startswith("Child") ],
+                [ "Child child {}".format(i) for i in range(30) ])
+
+    def test_debug_records_sampled_when_full(self):
+        """Test that debug records are sampled while the queue is full, and the rest reported."""
+        handler = self._handler(batch_size=10, debug_sample_rate=5)
+        with patch.object(handler.queue, "put_nowait", side_effect=queue.Full):
+            for i in range(19):
+                self.logger.debug("debug %d", i)
+            self.logger.info("info")
+        handler.close()
+        lines = self._lines()
+        self.assertEqual(lines, ["MainProcess debug 4", "MainProcess debug 9",
+            "MainProcess Dropped 8 debug record(s) - the log could not keep up",
+            "MainProcess debug 14", "MainProcess info",
+            "MainProcess Dropped 8 debug record(s) - the log could not keep up"])
+        self.assertEqual(handler.nm_dropped, 16)
+
+    def test_records_after_listener_stopped(self):
+        """Test that records logged at exit, after the listener stopped, are written directly."""
+        handler = self._handler()
+        self.logger.info("before")
+        handler._stop_listener()
+        self.logger.info("after")
+        handler.close()
+        self.logger.info("closed")
+        self.assertEqual(self._lines(), ["MainProcess before", "MainProcess after"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Test the PoolScheduler module."""
+
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from classification.PoolScheduler import PoolScheduler
+
+
+class _Response:
+    """Response with measured costs."""
+
+    def __init__(self, decode_time, inference_time):
+        self.decode_time = decode_time
+        self.inference_time = inference_time
+
+def _args(**kwargs):
+    return dict({
+            'nm_workers': None,
+            'worker_memory_mb': 256,
+            'pool_adjust_interval_ms': 0,
+            'tf_intra_op_threads': None,
+            'tf_inter_op_threads': None,
+            'chunk_target_ms': 50,
+            'max_chunk_size': 64,
+            }, **kwargs)
+
+@patch("classification.PoolScheduler._available_memory", return_value=16 * 1024**3)
+@patch("classification.PoolScheduler._nm_cores", return_value=8)
+class PoolSchedulerTestCases(unittest.TestCase):
+    """Test suite for the PoolScheduler module."""
+
+    def test_cores_are_split(self, *_):
+        """Test that the cores are split between the workers and the inference threads."""
+        scheduler = PoolScheduler(_args())
+        self.assertEqual(scheduler.nm_workers, 4)
+        self.assertEqual(scheduler.server_args()['tf_intra_op_threads'], 4)
+        self.assertEqual(scheduler.server_args()['tf_inter_op_threads'], 1)
+
+    def test_bounded_by_tasks_and_memory(self, _, mock_available_memory):
+        """Test that there are no more workers than tasks or memory for them."""
+        self.assertEqual(PoolScheduler(_args(), nm_tasks=2).nm_workers, 2)
+        mock_available_memory.return_value = 600 * 1024**2
+        self.assertEqual(PoolScheduler(_args()).nm_workers, 2)
+
+    def test_resized_to_measured_costs(self, *_):
+        """Test that the pool grows when decoding is slower than inference, and shrinks back."""
+        scheduler = PoolScheduler(_args())
+        self.assertEqual(scheduler.resize(4), 4)
+        for _ in range(PoolScheduler.MIN_SAMPLES):
+            scheduler.observe(_Response(0.03, 0.005))
+        self.assertEqual(scheduler.resize(4), 6)
+        for _ in range(100):
+            scheduler.observe(_Response(0.005, 0.01))
+        self.assertEqual(scheduler.resize(6), 1)
+
+    def test_fixed_workers(self, *_):
+        """Test that a number of workers given in the config is kept."""
+        scheduler = PoolScheduler(_args(nm_workers=3))
+        for _ in range(PoolScheduler.MIN_SAMPLES):
+            scheduler.observe(_Response(0.03, 0.005))
+        self.assertEqual(scheduler.resize(3), 3)
+
+    def test_chunk_size(self, *_):
+        """Test that chunks hold chunk_target_ms of decoding and shrink towards the end."""
+        scheduler = PoolScheduler(_args())
+        self.assertEqual(scheduler.chunk_size(), PoolScheduler.INITIAL_CHUNK_SIZE)
+        scheduler.observe(_Response(0.002, None))
+        self.assertEqual(scheduler.chunk_size(), 25)
+        self.assertEqual(scheduler.chunk_size(nm_remaining=80), 10)
+        self.assertEqual(scheduler.chunk_size(nm_remaining=3), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Test the prefetch module."""
+
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from aux.prefetch import Prefetcher
+from aux.throughput import Throughput
+
+
+def _square(x):
+    if x < 0:
+        raise ValueError("negative")
+    return x * x
+
+class PrefetchTestCases(unittest.TestCase):
+    """Test suite for the prefetch module."""
+
+    def test_results(self):
+        """Test that every item gets its result or exception, with threads or without."""
+        for nm_threads in [0, 3]:
+            with Prefetcher(_square, nm_threads) as prefetcher:
+                futures = [ prefetcher.submit(x) for x in range(10) ]
+                failed = prefetcher.submit(-1)
+                self.assertEqual([ x.result() for x in futures ], [ x * x for x in range(10) ])
+                with self.assertRaises(ValueError):
+                    failed.result()
+
+    def test_runs_ahead(self):
+        """Test that items are handled in parallel while the caller does other work."""
+        started = threading.Barrier(2, timeout=5)
+        def work(x):
+            started.wait()
+            return x
+        with Prefetcher(work, 2) as prefetcher:
+            futures = [ prefetcher.submit(x) for x in range(2) ]
+            self.assertEqual([ x.result(timeout=5) for x in futures ], [0, 1])
+
+    def test_stalls_counted(self):
+        """Test that the time the threads wait for items is counted as stalled."""
+        stats = Throughput("decode")
+        with Prefetcher(_square, 1, stats) as prefetcher:
+            time.sleep(0.05)
+            prefetcher.submit(2).result()
+        self.assertGreaterEqual(stats.stalled_time, 0.05)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Test the result_cache module."""
+
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from aux.result_cache import ResultCache
+
+
+def _response(data, code=200, etag=None):
+    """Create a mock url_open() response."""
+    response = MagicMock()
+    response.read.return_value = data
+    response.getcode.return_value = code
+    response.headers = {'ETag': etag} if etag else {}
+    return response
+
+class ResultCacheTestCases(unittest.TestCase):
+    """Test suite for the result_cache module."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "results.sqlite")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    @patch("aux.result_cache.url_open")
+    def test_miss_then_hit_without_request(self, mock_url_open):
+        """Test that a stored result is returned without a request while the URL is fresh."""
+        mock_url_open.return_value = _response(b"image")
+        cache = ResultCache(self.path, "model", 1024, 60)
+        result, data, key = cache.fetch("http://a/1.jpg")
+        self.assertIsNone(result)
+        self.assertEqual(data, b"image")
+        cache.store(key, [["bird", 0.5]])
+        self.assertEqual(cache.fetch("http://a/1.jpg"), ([["bird", 0.5]], None, None))
+        self.assertEqual(mock_url_open.call_count, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+
+    @patch("aux.result_cache.url_open")
+    def test_same_content_shares_result(self, mock_url_open):
+        """Test that a result is found by content for a URL never seen before."""
+        mock_url_open.return_value = _response(b"image")
+        cache = ResultCache(self.path, "model", 1024, 60)
+        _, _, key = cache.fetch("http://a/1.jpg")
+        cache.store(key, [["bird", 0.5]])
+        self.assertEqual(cache.fetch("http://b/1.jpg?v=2")[0], [["bird", 0.5]])
+        cache.close()
+
+    @patch("aux.result_cache.url_open")
+    def test_signature_separates_results(self, mock_url_open):
+        """Test that results stored for one signature are not returned for another."""
+        mock_url_open.return_value = _response(b"image")
+        cache = ResultCache(self.path, "model-1", 1024, 60)
+        _, _, key = cache.fetch("http://a/1.jpg")
+        cache.store(key, [["bird", 0.5]])
+        cache.close()
+        cache = ResultCache(self.path, "model-2", 1024, 60)
+        self.assertIsNone(cache.fetch("http://a/1.jpg")[0])
+        cache.close()
+
+    @patch("aux.result_cache.url_open")
+    def test_stale_url_is_revalidated(self, mock_url_open):
+        """Test that a stale URL is revalidated with its ETag and kept on 304."""
+        mock_url_open.return_value = _response(b"image", etag='"v1"')
+        cache = ResultCache(self.path, "model", 1024, 0)
+        _, _, key = cache.fetch("http://a/1.jpg")
+        cache.store(key, [["bird", 0.5]])
+        mock_url_open.return_value = _response(b"", code=304)
+        self.assertEqual(cache.fetch("http://a/1.jpg")[0], [["bird", 0.5]])
+        mock_url_open.assert_called_with("http://a/1.jpg", {'If-None-Match': '"v1"'}, 0, True)
+        self.assertEqual(cache.revalidations, 1)
+        cache.close()
+
+    @patch("aux.result_cache.url_open")
+    def test_evicts_least_recently_used(self, mock_url_open):
+        """Test that the least recently used results are evicted when the cache is full."""
+        cache = ResultCache(self.path, "model", 40, 60)
+        for i in range(3):
+            mock_url_open.return_value = _response(b"image %d" % i)
+            _, _, key = cache.fetch("http://a/%d.jpg" % i)
+            cache.store(key, [["bird", 0.5]])
+        mock_url_open.return_value = _response(b"image 0")
+        self.assertIsNone(cache.fetch("http://a/0.jpg")[0])
+        mock_url_open.return_value = _response(b"image 2")
+        self.assertIsNotNone(cache.fetch("http://a/2.jpg")[0])
+        cache.close()
+
+    @patch("aux.result_cache.local_read", side_effect=lambda path: open(path, 'rb').read())
+    def test_local_file_read_once(self, mock_local_read):
+        """Test that a local file is only read again once it changed, without any request."""
+        path = os.path.join(self.dir.name, "1.jpg")
+        with open(path, 'wb') as f:
+            f.write(b"image")
+        cache = ResultCache(self.path, "model", 1024, 60)
+        _, data, key = cache.fetch(path)
+        self.assertEqual(data, b"image")
+        cache.store(key, [["bird", 0.5]])
+        self.assertEqual(cache.fetch(path), ([["bird", 0.5]], None, None))
+        self.assertEqual(mock_local_read.call_count, 1)
+        with open(path, 'wb') as f:
+            f.write(b"other image")
+        self.assertEqual(cache.fetch(path)[1], b"other image")
+        self.assertEqual(mock_local_read.call_count, 2)
+        cache.close()
+
+if __name__ == "__main__":
+    unittest.main()
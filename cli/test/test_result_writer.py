@@ -0,0 +1,118 @@
+"""Test the ResultWriter module and the array-backed answers it writes."""
+
+
+import io
+import json
+import os
+import pickle
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+try:
+    import numpy as np
+    from classification import ResultWriter
+    from classification.BirdClassifier import BirdClassifierResults, _BirdClassifierResponse
+except ImportError:
+    ResultWriter = None
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+def _answers():
+    """Create answers to three images, the second of which could not be classified."""
+    answers = BirdClassifierResults(["http://a/0.jpg", "http://a/1.jpg", "http://a/2.jpg"], 2)
+    answers.add(_BirdClassifierResponse(0, "http://a/0.jpg", np.array([2, 0], dtype=np.int32),
+        np.array([0.75, 0.125], dtype=np.float32)))
+    answers.add(_BirdClassifierResponse(2, "http://a/2.jpg", np.array([1], dtype=np.int32),
+        np.array([0.5], dtype=np.float32)))
+    return answers
+
+@unittest.skipIf(ResultWriter is None, "requires numpy")
+class ResultWriterTestCases(unittest.TestCase):
+    """Test suite for the ResultWriter module."""
+
+    def setUp(self):
+        self.labels = np.array(["a", "b", "c"])
+
+    def _write(self, format, labels):
+        out = io.BytesIO() if ResultWriter.is_binary(format) else io.StringIO()
+        writer = ResultWriter.open_writer(format, out, labels, 2)
+        writer.write(_answers())
+        writer.close()
+        return out.getvalue()
+
+    def test_results(self):
+        """Test that answers are kept in place by index, unclassified ones as None."""
+        answers = _answers()
+        self.assertEqual(answers.nm_results.tolist(), [2, -1, 1])
+        self.assertEqual([ x.index for x in answers ], [0, 1, 2])
+        self.assertIsNone(answers[1].label_ids)
+        self.assertEqual([ (x.name, x.probability)
+            for x in answers[0].classifications(self.labels) ], [("c", 0.75), ("a", 0.125)])
+
+    def test_pickle_response(self):
+        """Test that an answer comes back the same through pickling, classified or not."""
+        for answer in _answers():
+            copy = pickle.loads(pickle.dumps(answer))
+            self.assertEqual((copy.index, copy.image), (answer.index, answer.image))
+            if answer.label_ids is None:
+                self.assertIsNone(copy.label_ids)
+            else:
+                np.testing.assert_array_equal(copy.label_ids, answer.label_ids)
+                np.testing.assert_array_equal(copy.scores, answer.scores)
+                self.assertEqual(copy.scores.dtype, np.float32)
+
+    def test_text(self):
+        """Test that the text format is the image followed by its indented results."""
+        self.assertEqual(self._write("text", self.labels), "http://a/0.jpg\n    (c, 0.75)\n"
+                "    (a, 0.125)\nhttp://a/1.jpg\n    None\nhttp://a/2.jpg\n    (b, 0.5)\n")
+
+    def test_jsonl(self):
+        """Test that each answer is a line of JSON, with label ids when there are no labels."""
+        lines = [ json.loads(x) for x in self._write("jsonl", None).splitlines() ]
+        self.assertEqual(lines[0]['classifications'], [{'name': "2", 'score': 0.75},
+            {'name': "0", 'score': 0.125}])
+        self.assertIsNone(lines[1]['classifications'])
+        self.assertEqual([ x['image'] for x in lines ], _answers().images)
+
+    def test_csv(self):
+        """Test that there is a row per result, and an empty row per unclassified image."""
+        self.assertEqual(self._write("csv", self.labels).splitlines(), [
+            "image,rank,label_id,name,score",
+            "http://a/0.jpg,1,2,c,0.75",
+            "http://a/0.jpg,2,0,a,0.125",
+            "http://a/1.jpg,,,,",
+            "http://a/2.jpg,1,1,b,0.5",
+            ])
+
+    def test_npy(self):
+        """Test that the answers are a structured array, padded to the number of results."""
+        records = np.load(io.BytesIO(self._write("npy", self.labels)))
+        self.assertEqual(records['index'].tolist(), [0, 1, 2])
+        self.assertEqual(records['nm_results'].tolist(), [2, -1, 1])
+        self.assertEqual(records['label_ids'].tolist(), [[2, 0], [-1, -1], [1, -1]])
+        self.assertEqual(records['scores'][0].tolist(), [0.75, 0.125])
+        self.assertTrue(np.isnan(records['scores'][2, 1]))
+
+    def test_chunks(self):
+        """Test that answers are written a chunk at a time, and all of them on close()."""
+        out = io.StringIO()
+        writer = ResultWriter.JsonlWriter(out, None, 2, chunk_size=2, max_wait_s=60)
+        writer.write(_answers())
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+        writer.close()
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+    @unittest.skipIf(pq is None, "requires pyarrow")
+    def test_parquet(self):
+        """Test that the answers are a Parquet table with list columns."""
+        table = pq.read_table(io.BytesIO(self._write("parquet", self.labels))).to_pydict()
+        self.assertEqual(table['image'], _answers().images)
+        self.assertEqual(table['names'], [["c", "a"], None, ["b"]])
+        self.assertEqual(table['label_ids'], [[2, 0], None, [1]])
+
+if __name__ == "__main__":
+    unittest.main()
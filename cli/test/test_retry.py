@@ -0,0 +1,147 @@
+"""Test the retry module, and retrying in url_open() and the ImageDownloader."""
+
+
+import os
+import sys
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from aux import retry
+from aux.retry import CircuitBreaker, RetryPolicy
+from aux.url_open import UrlOpenFatalException, UrlOpenRetryException, url_open
+from classification.ImageDownloader import ImageDownloader
+
+
+def _response(code, headers=None):
+    """Create a mock _open() response."""
+    response = MagicMock()
+    response.getcode.return_value = code
+    response.headers = headers or {}
+    return response
+
+class _Task:
+    def __init__(self, image):
+        self.image = image
+
+class RetryTestCases(unittest.TestCase):
+    """Test suite for the retry module."""
+
+    def setUp(self):
+        self.policy, self.breaker = retry.policy, retry.breaker
+        retry.policy = RetryPolicy(2, 1, 4)
+        retry.breaker = CircuitBreaker(3, 60)
+
+    def tearDown(self):
+        retry.policy, retry.breaker = self.policy, self.breaker
+
+    def test_delay_is_bounded(self):
+        """Test that delays grow with the attempt up to the maximum delay."""
+        policy = RetryPolicy(4, 100, 1000)
+        for attempt in range(8):
+            delay = policy.delay(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(0.1 * 2**attempt, 1))
+        self.assertEqual(policy.delay(0, retry_after=0.5), 0.5)
+        self.assertEqual(policy.delay(0, retry_after=60), 1)
+
+    def test_breaker_opens_and_recovers(self):
+        """Test that a host is down after failed requests, and up after a request succeeds."""
+        breaker = CircuitBreaker(2, 60)
+        breaker.record("a", False)
+        self.assertTrue(breaker.allow("a"))
+        breaker.record("a", False)
+        self.assertFalse(breaker.allow("a"))
+        self.assertTrue(breaker.allow("b"))
+        self.assertEqual(breaker.nm_fast_failures, 1)
+        breaker.reset_s = 0
+        breaker.record("a", False)
+        self.assertTrue(breaker.allow("a"))
+        breaker.record("a", True)
+        self.assertTrue(breaker.allow("a"))
+
+    @patch("aux.url_open._open")
+    def test_retry_without_blocking(self, mock_open):
+        """Test that a retry is left to the caller when not blocking, until retries run out."""
+        mock_open.return_value = _response(503)
+        with self.assertRaises(UrlOpenRetryException) as cm:
+            url_open("http://a/1.jpg", block=False)
+        self.assertEqual(cm.exception.attempt, 1)
+        with self.assertRaises(UrlOpenFatalException):
+            url_open("http://a/1.jpg", attempt=2, block=False)
+
+    @patch("aux.url_open._open")
+    def test_permanent_status_is_not_retried(self, mock_open):
+        """Test that a 404 fails at once."""
+        mock_open.return_value = _response(404)
+        with self.assertRaises(UrlOpenFatalException):
+            url_open("http://a/1.jpg")
+        self.assertEqual(mock_open.call_count, 1)
+
+    @patch("aux.url_open._open")
+    def test_down_host_fails_fast(self, mock_open):
+        """Test that requests to a host that keeps failing are not made."""
+        mock_open.side_effect = ConnectionResetError
+        for _ in range(3):
+            with self.assertRaises(UrlOpenRetryException):
+                url_open("http://a/1.jpg", block=False)
+        with self.assertRaises(UrlOpenFatalException):
+            url_open("http://a/2.jpg", block=False)
+        self.assertEqual(mock_open.call_count, 3)
+
+    @patch("aux.url_open._open")
+    def test_downloader_retries(self, mock_open):
+        """Test that the ImageDownloader gets an image that fails once, along with the others."""
+        failed = set()
+        def _open(url, headers):
+            if url.endswith("0.jpg") and url not in failed:
+                failed.add(url)
+                return _response(503)
+            return MagicMock(**{'getcode.return_value': 200, 'read.return_value': url.encode()})
+        mock_open.side_effect = _open
+        downloader = ImageDownloader(2)
+        tasks = [ _Task("http://a/{}.jpg".format(i)) for i in range(4) ]
+        downloaded = { task.image: data for task, data in downloader.download(tasks) }
+        self.assertEqual(downloaded, { task.image: task.image.encode() for task in tasks })
+        self.assertEqual(downloader.nm_retries, 1)
+
+        got = {}
+        failed.clear()
+        downloader.download_to(tasks, lambda task, data: got.update({task.image: data}))
+        self.assertEqual(got, downloaded)
+
+    @patch("aux.url_open._open")
+    def test_downloader_finishes(self, mock_open):
+        """Test that downloads always finish, with and without retries."""
+        failed = set()
+        def _open(url, headers):
+            if url.endswith(("1.jpg", "3.jpg")) and url not in failed:
+                failed.add(url)
+                return _response(503)
+            return MagicMock(**{'getcode.return_value': 200, 'read.return_value': b"image"})
+        mock_open.side_effect = _open
+        errors = []
+        def _run():
+            try:
+                _download()
+            except Exception as e:
+                errors.append(e)
+        def _download():
+            for _ in range(100):
+                tasks = [ _Task("http://a/{}.jpg".format(i)) for i in range(5) ]
+                got = []
+                failed.clear()
+                ImageDownloader(2).download_to(tasks, lambda task, data: got.append(data))
+                self.assertEqual(got, [b"image"] * 5)
+                failed.clear()
+                got = [ data for task, data in ImageDownloader(2).download(tasks) ]
+                self.assertEqual(got, [b"image"] * 5)
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(errors, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+"""Test the BirdClassifierService module against a local client."""
+
+
+import json
+import os
+import sys
+import threading
+import types
+import unittest
+import urllib.request
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+try:
+    import cv2
+    import numpy as np
+    from classification.BirdClassifierService import BirdClassifierService
+    from classification.classification import Classification
+except ImportError:
+    BirdClassifierService = None
+
+
+class _Tensor:
+    """Array with the numpy() method of a tensor."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def numpy(self):
+        """Get the tensor as an array."""
+        return self.array
+
+# What the module uses of TensorFlow once the model input is made without it.
+_tf = types.SimpleNamespace(errors=types.SimpleNamespace(InvalidArgumentError=ValueError))
+
+class _FakeModel:
+    """Model scoring images by their mean red, green and blue values."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def call(self, image_tensor):
+        """Score a batch of images."""
+        images = image_tensor.numpy()
+        self.batch_sizes += [len(images)]
+        return _Tensor(images.mean(axis=(1, 2)))
+
+def _args():
+    return {
+            'nm_top_results': 2,
+            'score_softmax': False,
+            'score_threshold': None,
+            'batch_size': 8,
+            'max_batch_wait_ms': 50,
+            'nm_downloads': 4,
+            'max_request_images': 4,
+            'url_model': "fake",
+            'url_labels': "fake",
+            'model_dir': None,
+            'dedup_perceptual': False,
+            'backend': "tensorflow",
+            'inference': "graph",
+            'tf_intra_op_threads': None,
+            'tf_inter_op_threads': None,
+            'time': False,
+            'profile_dir': None,
+            'tfhub_cache_dir': "",
+            'labels_ttl': 0,
+            }
+
+def _image(bgr):
+    return cv2.imencode(".png", np.full((32, 32, 3), bgr, dtype=np.uint8))[1].tobytes()
+
+@unittest.skipIf(BirdClassifierService is None, "requires numpy and opencv")
+class BirdClassifierServiceTestCases(unittest.TestCase):
+    """Test suite for the BirdClassifierService module."""
+
+    def setUp(self):
+        self.model = _FakeModel()
+        generate_tensor = lambda images, out=None: _Tensor(Classification.fill_batch(images, out))
+        self.patches = [
+                patch("classification.classification.Classification.load_model",
+                    return_value=self.model),
+                patch("classification.classification.Classification.load_labels",
+                    return_value=np.array(["red", "green", "blue"])),
+                patch("classification.classification.Classification.generate_tensor",
+                    generate_tensor),
+                patch("classification.classification.Tf.get", return_value=_tf),
+                patch("classification.classification.Tf.set_threads"),
+                ]
+        for p in self.patches:
+            p.start()
+        self.service = BirdClassifierService(_args(), "127.0.0.1", 0)
+        self.thread = threading.Thread(target=self.service.serve_forever)
+        self.thread.start()
+        self.url = "http://{}:{}".format(*self.service.address)
+
+    def tearDown(self):
+        self.service.shutdown()
+        self.thread.join()
+        for p in self.patches:
+            p.stop()
+
+    def _post(self, body, content_type):
+        request = urllib.request.Request(self.url + "/classify", data=body,
+                headers={'Content-Type': content_type})
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    def test_health(self):
+        """Test that the health endpoint answers."""
+        with urllib.request.urlopen(self.url + "/health") as response:
+            self.assertEqual(json.loads(response.read()), {'status': "ok"})
+
+    def test_classify_raw_image(self):
+        """Test that an image sent as the request body is classified."""
+        results = self._post(_image([0, 0, 255]), "image/png")['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['classifications'][0]['name'], "red")
+        self.assertEqual(len(results[0]['classifications']), 2)
+
+    def test_classify_undecodable_image(self):
+        """Test that an image that cannot be decoded gets no classifications."""
+        results = self._post(b"not an image", "image/png")['results']
+        self.assertIsNone(results[0]['classifications'])
+
+    def test_concurrent_requests_are_batched(self):
+        """Test that concurrent requests share model calls."""
+        results = [None] * 8
+        def post(i):
+            results[i] = self._post(_image([255, 0, 0]), "image/png")['results']
+        threads = [ threading.Thread(target=post, args=(i,)) for i in range(len(results)) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(x[0]['classifications'][0]['name'] == "blue" for x in results))
+        self.assertEqual(sum(self.model.batch_sizes), len(results))
+        self.assertLess(len(self.model.batch_sizes), len(results))
+
+    def test_invalid_request(self):
+        """Test that a malformed JSON request is rejected."""
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self._post(b'{"urls": "not a list"}', "application/json")
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_local_path_rejected(self):
+        """Test that a request for a local file of the server is rejected."""
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self._post(b'{"urls": ["/etc/passwd"]}', "application/json")
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_metrics(self):
+        """Test that the metrics endpoint exposes the latency histograms."""
+        self._post(_image([0, 255, 0]), "image/png")
+        with urllib.request.urlopen(self.url + "/metrics") as response:
+            metrics = response.read().decode('utf-8')
+        self.assertIn("classifier_request_seconds_count 1", metrics)
+        self.assertIn("# TYPE classifier_inference_seconds histogram", metrics)
+        self.assertIn("classifier_decode_seconds_count 1", metrics)
+        self.assertIn("classifier_model_seconds_count 1", metrics)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Test the stage_metrics and profiling modules."""
+
+
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "classifier"))
+from aux.profiling import merge_profiles, run_profiled
+from aux.stage_metrics import StageMetrics
+
+
+def _work():
+    return sum(range(1000))
+
+class StageMetricsTestCases(unittest.TestCase):
+    """Test suite for the stage_metrics and profiling modules."""
+
+    def test_time(self):
+        """Test that a stage is timed in its histogram, also when it raises."""
+        metrics = StageMetrics()
+        with metrics.time('decode'):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.time('decode'):
+                raise ValueError
+        self.assertEqual(metrics.histograms['decode'].count, 2)
+        self.assertEqual(metrics.histograms['model'].count, 0)
+
+    def test_merge_pickled(self):
+        """Test that the metrics of another process are summed in after being pickled."""
+        metrics, other = StageMetrics(), StageMetrics()
+        metrics.histograms['fetch'].observe(0.02)
+        other.histograms['fetch'].observe(0.3)
+        other.histograms['model'].observe(0.0002)
+        metrics.merge(pickle.loads(pickle.dumps(other)))
+        self.assertEqual(metrics.histograms['fetch'].count, 2)
+        self.assertAlmostEqual(metrics.histograms['fetch'].sum, 0.32)
+        self.assertEqual(metrics.histograms['fetch'].quantile(1), 0.5)
+        self.assertEqual(metrics.histograms['model'].quantile(0.5), 0.00025)
+        metrics.histograms['model'].observe(0.1)
+        self.assertEqual(metrics.histograms['model'].count, 2)
+
+    def test_write_and_table(self):
+        """Test that the metrics are written in the Prometheus format and summarized."""
+        metrics = StageMetrics()
+        metrics.histograms['scoring'].observe(0.004)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "classifier.prom")
+            metrics.write(path)
+            with open(path) as f:
+                text = f.read()
+            self.assertEqual(os.listdir(directory), ["classifier.prom"])
+        self.assertIn("# TYPE classifier_scoring_seconds histogram", text)
+        self.assertIn('classifier_scoring_seconds_bucket{le="0.005"} 1', text)
+        lines = metrics.table().splitlines()
+        self.assertEqual(len(lines), 1 + len(StageMetrics.STAGES))
+        self.assertEqual(lines[6].split(), ["scoring", "1", "0.004", "4.000", "5.00", "5.00",
+            "5.00"])
+
+    def test_merge_profiles(self):
+        """Test that the profiles of several processes are merged into one."""
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(merge_profiles(directory))
+            for name in ["a", "b"]:
+                self.assertEqual(run_profiled(_work, directory, name), 499500)
+            stats = merge_profiles(directory)
+        calls = [ x[0] for key, x in stats.stats.items() if key[2] == "_work" ]
+        self.assertEqual(calls, [2])
+
+if __name__ == "__main__":
+    unittest.main()